@@ -1,17 +1,26 @@
-import json
-import sys
 import numpy as np
 from pathlib import Path
 import pandas as pd
 from typing import Optional
-from pandas.core.series import Series
 import os
-from ytdlp_download import download_audio_section
-import time
-from multiprocessing.managers import DictProxy
+from backends import DownloadBackend, YtdlpBackend
+from metrics import DownloadMetrics, MetricsServer
 import multiprocessing as mp
 from tqdm import tqdm
-from worker import Worker
+from worker import Worker, WorkerSettings, run_worker
+from progress import ProgressAggregator, ProgressEvent, STATUS_DOWNLOADED
+from journal import StatusJournal
+from scheduler import WorkScheduler
+from clip_index import ClipIndex
+from csv_setup import SegmentColumns
+from features import FeatureExtractor
+from plan import DownloadPlan, build_plan, release_plan, share_plan
+from rate_limit import AdaptiveRateLimiter
+from storage import LINK_HARDLINK
+from shards import OUTPUT_CLIPS, OUTPUT_SHARDS, ShardWriter
+from ledger import LeaseLedger, LedgerFeeder
+from ordering import ORDER_CSV, order_rows
+from state_store import StateStore
 
 """
 Script to define a class for downloading AudioSet data in parallel
@@ -31,6 +40,29 @@ class MultiPartDownloader:
         total_num_files: int,
         existing_files: list[str],
         excluded_files: list[str],
+        batch_size: int = 16,
+        concurrency: int = 1,
+        clip_index: Optional[ClipIndex] = None,
+        max_retries: int = 5,
+        rate_limiter: Optional[AdaptiveRateLimiter] = None,
+        backend: Optional[DownloadBackend] = None,
+        link_mode: str = LINK_HARDLINK,
+        output_mode: str = OUTPUT_CLIPS,
+        shard_writer: Optional[ShardWriter] = None,
+        codec_type: str = "wav",
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+        ledger: Optional[LeaseLedger] = None,
+        state_store: Optional[StateStore] = None,
+        metrics_port: Optional[int] = None,
+        metrics_file: Optional[Path] = None,
+        order: str = ORDER_CSV,
+        done_label_counts: Optional[np.ndarray] = None,
+        order_target: Optional[int] = None,
+        transcoders: int = 0,
+        spool_size: int = 0,
+        feature_extractor: Optional[FeatureExtractor] = None,
+        columns: Optional[SegmentColumns] = None,
     ):
         """Main function to initiate parallel downloads with progress tracking."""
         # if not os.path.exists(download_dir):
@@ -45,6 +77,52 @@ class MultiPartDownloader:
         self.start_existing_files: list[str] = existing_files
         self.start_excluded_files: list[str] = excluded_files
         self.total_num_files: int = total_num_files
+        self.batch_size: int = batch_size
+        self.concurrency: int = concurrency
+        self.clip_index: Optional[ClipIndex] = clip_index
+        self.max_retries: int = max_retries
+        # shared by every worker, so they back off together when throttled
+        self.rate_limiter: AdaptiveRateLimiter = rate_limiter or AdaptiveRateLimiter()
+        assert num_jobs <= self.rate_limiter.max_jobs, f"The rate limiter counts downloads for at most {self.rate_limiter.max_jobs} jobs"
+        self.backend: DownloadBackend = backend or YtdlpBackend()
+        self.link_mode: str = link_mode
+        self.output_mode: str = output_mode
+        # only used by the parent process, which packs the clips as they finish
+        self.shard_writer: Optional[ShardWriter] = shard_writer
+        assert output_mode == OUTPUT_CLIPS or shard_writer is not None, f"Output mode {output_mode} needs a shard writer"
+        # format the clips are decoded to, None keeps the rate/channels of the source
+        self.codec_type: str = codec_type
+        self.sample_rate: Optional[int] = sample_rate
+        self.channels: Optional[int] = channels
+        # when set, rows are leased from a ledger shared with other nodes and
+        # filtered_split_df holds the whole split, indexed by split row
+        self.ledger: Optional[LeaseLedger] = ledger
+        # only used by the parent process, which records every finished row
+        self.state_store: Optional[StateStore] = state_store
+        # live metrics, served over HTTP if a port is given and written to a
+        # JSON file every few seconds if a file is given
+        self.metrics_port: Optional[int] = metrics_port
+        self.metrics_file: Optional[Path] = metrics_file
+        # order the rows are handed out in, see ordering.py. done_label_counts
+        # holds how many clips of each label were downloaded by earlier runs
+        self.order: str = order
+        self.done_label_counts: Optional[np.ndarray] = done_label_counts
+        self.order_target: Optional[int] = order_target
+        # transcode threads per job and fetched rows each job may hold waiting
+        # for them, no transcoders fetches and transcodes every row in one go
+        self.transcoders: int = transcoders
+        self.spool_size: int = spool_size
+        # only used by the parent process, which submits every clip that
+        # finishes to the extractor's pool
+        self.feature_extractor: Optional[FeatureExtractor] = feature_extractor
+        assert feature_extractor is None or output_mode != OUTPUT_SHARDS, "Features are computed from the clip files, which aren't kept in shards output mode"
+        assert ledger is None or order == ORDER_CSV, "Rows leased from a ledger are downloaded in CSV order"
+        # the columns filtered_split_df was loaded from, which hold its labels
+        self.columns: Optional[SegmentColumns] = columns
+
+        # clips are written here and moved into their label directory once they
+        # check out, the leading dot keeps the clip index from scanning it
+        self.staging_dir: Path = self.download_dir / Path(".partial")
 
         self.last_update_total : int = 0
 
@@ -58,176 +136,251 @@ class MultiPartDownloader:
             zip(self.class_labels_df["mid"], self.class_labels_df["display_name"])
         )
 
-    def split_ids(self, metadata_df: pd.DataFrame, n_splits: int) -> list[pd.DataFrame]:
-        return np.array_split(metadata_df, n_splits)
-
-    def worker(
-        self, meta_df: pd.DataFrame, dict: DictProxy, job_id: int, lock: mp.Lock
-    ) -> None:
-        """Main function to download a set of rows from the metadata CSV."""
-        for index, row in meta_df.iterrows():
-            self.download_yt_row(index, row, dict, job_id, lock)
+        # the workers only go through the plan, never through the DataFrame
+        self.plan: DownloadPlan = build_plan(
+            self.filtered_split_df, self.class_labels_df, self.download_dir, self.codec_type, self.columns
+        )
 
     def percentage_fmt(num: float) -> str:
         return "{:.2%}".format(num)
 
-    def logger(self, worker_processes: list[Worker], total_num_files: int) -> None:
-        """Main function to log the progress of the downloads."""
-        downloaded_ids: list[str] = []
-        errored_ids: list[str] = []
-
-        with tqdm(total=total_num_files) as pbar:
-            while len(downloaded_ids) + len(errored_ids) < total_num_files:
-                downloaded_ids = []
-                errored_ids = []
-
-                last_status: dict = {x.job_id: {} for x in worker_processes}
-
-                for w in worker_processes:
-                    with w.lock:
-                        dict_prox: DictProxy = w.dict_proxy
-
-                        job_download_ids: list[str] = dict_prox["Downloaded_Ids"]
-                        job_error_ids: list[str] = dict_prox["Error_Ids"]
-                        # contains error messages for each job
-                        job_errors: list[str] = dict_prox["Errors"]
-
-                        downloaded_ids.extend(job_download_ids)
-                        errored_ids.extend(job_error_ids)
-
-                        last_status[w.job_id] = {
-                            "NumDownloaded": len(job_download_ids),
-                            "NumErrored": len(job_error_ids),
-                            "Total": len(job_download_ids) + len(job_error_ids),
-                            "Downloaded": job_download_ids,
-                            "Errored": job_error_ids,
-                            "Errors": job_errors,
-                            "UpdateTimestamp": time.time(),
-                        }
-
-                with open( self.current_download_info / Path("download_status.json"), "w") as f:
-                    last_status["TotalNumDownloaded"] = len(downloaded_ids) + len( self.start_existing_files)
-                    last_status["TotalNumErrored"] = len(errored_ids) + len( self.start_excluded_files)
-
-                    last_status["StartExistingFiles"] = self.start_existing_files
-                    last_status["StartExcludedFiles"] = self.start_excluded_files
-
-                    last_status["command"] = ( str(sys.executable) + " " + " ".join(sys.argv))
-                    json.dump(last_status, f, indent=4)
+    def logger(
+        self,
+        worker_processes: list[Worker],
+        scheduler: WorkScheduler,
+        progress_queue: mp.Queue,
+        total_num_files: int,
+        feeder: Optional[LedgerFeeder] = None,
+    ) -> None:
+        """
+        Main function to log the progress of the downloads. Runs in the parent
+        process and is the only place where the running state is held; workers
+        only send it small completion events. Also drives the scheduler, handing
+        out more rows as they finish and requeueing the rows of dead workers.
+        """
+        aggregator: ProgressAggregator = ProgressAggregator(
+            [w.job_id for w in worker_processes]
+        )
 
-                with open( self.current_download_info / Path("split_current_ytids.txt"), "w") as f:
-                    f.write("\n".join(downloaded_ids))
+        journal: StatusJournal = StatusJournal(self.current_download_info)
+        num_existing: int = len(self.start_existing_files)
+        num_excluded: int = len(self.start_excluded_files)
+        split_rows: np.ndarray = self.filtered_split_df.index.to_numpy()
 
-                with open( self.current_download_info / Path("unavailable_ids.txt"), "w") as f:
-                    f.write("\n".join(self.start_excluded_files) + "\n".join(errored_ids))
+        metrics: DownloadMetrics = DownloadMetrics()
+        metrics_server: Optional[MetricsServer] = None
+        if self.metrics_port is not None:
+            metrics_server = MetricsServer(metrics, self.metrics_port)
+            metrics_server.start()
 
-                # print(f"{len(downloaded_ids)=}")
-                current_total : int = len(downloaded_ids) + len(errored_ids) + len(self.start_existing_files) + len(self.start_excluded_files)
+        with tqdm(total=total_num_files) as pbar:
+            while True:
+                # workers are checked before draining, so that every event a
+                # dead worker managed to send is applied before its rows are
+                # given back to the scheduler
+                dead_workers: list[Worker] = [w for w in worker_processes if not w.process.is_alive()]
+                workers_alive: bool = len(dead_workers) < len(worker_processes)
+                events: list[ProgressEvent] = aggregator.drain(progress_queue, timeout=1)
+
+                # the state store goes first, the feeder asks it whether the
+                # rows of a finished ledger batch still need retrying
+                if self.state_store is not None:
+                    self.state_store.record(events, split_rows)
+                for event in events:
+                    scheduler.complete(event.job_id, event.row_idx)
+                    if feeder is not None:
+                        feeder.complete(event.row_idx, event.status)
+                for w in dead_workers:
+                    num_requeued: int = scheduler.release(w.job_id)
+                    if num_requeued > 0:
+                        print(f"Job number {w.job_id} died, requeued {num_requeued} rows")
+                    # a killed worker never releases its downloads in flight,
+                    # which would otherwise lower the cap for the others for good
+                    num_inflight: int = self.rate_limiter.forget_job(w.job_id)
+                    if num_inflight > 0:
+                        print(f"Job number {w.job_id} died with {num_inflight} downloads in flight, freed their slots")
+                if feeder is not None:
+                    feeder.tick()
+                scheduler.dispatch()
+
+                # only the new events are written out, the full state goes into
+                # a compacted snapshot every so often
+                journal.append(events)
+                metrics.record(events)
+                metrics.set_gauges(
+                    rate_limit_per_second=self.rate_limiter.current_rate,
+                    inflight_limit=self.rate_limiter.current_inflight_limit,
+                    rows_pending=sum(len(batch.rows) for batch in scheduler.pending),
+                    rows_outstanding=scheduler.num_outstanding,
+                    workers_alive=len(worker_processes) - len(dead_workers),
+                )
+                self.extract_features(events, split_rows)
+                if self.feature_extractor is not None:
+                    metrics.set_gauges(features_pending=self.feature_extractor.num_pending)
+                if self.metrics_file is not None:
+                    metrics.maybe_write(self.metrics_file)
+                self.pack_clips(events)
+                self.index_clips(events)
+                if journal.maybe_snapshot(aggregator, num_existing, num_excluded) and self.clip_index is not None:
+                    self.clip_index.save()
+
+                num_downloaded: int = len(aggregator.downloaded_ids)
+                num_errored: int = len(aggregator.errored_ids)
+                num_deferred: int = len(aggregator.deferred_ids)
+
+                current_total : int = num_downloaded + num_errored + num_deferred + num_existing + num_excluded
                 pbar.update(current_total - self.last_update_total)
                 self.last_update_total = current_total
-                
-                # print(f"{len(downloaded_ids) + len(errored_ids)=}")
+
                 pbar.set_postfix(
-                    {"Downloaded": len(downloaded_ids) + len(self.start_existing_files), "Errored": len(errored_ids), "Excluded" : len(self.start_excluded_files), "Existing" : len(self.start_existing_files)}
+                    {"Downloaded": num_downloaded + num_existing, "Errored": num_errored, "Deferred": num_deferred, "Excluded" : num_excluded, "Existing" : num_existing, "Rate": f"{self.rate_limiter.current_rate:.2f}/s"}
                 )
-                time.sleep(1)
 
-    def download_yt_row(
-        self, index: int, meta_row: Series, dict: DictProxy, job_id: int, lock: mp.Lock
-    ) -> None:
-        """Downloads a file from a URL and saves it to the specified directory."""
-
-        ytid: str = meta_row["YTID"]
-        start_time: str = meta_row["start_seconds"]
-        end_time: str = meta_row["end_seconds"]
-        positive_labels: list[str] = [
-            self.machine_to_display_mapping[x]
-            for x in meta_row["positive_labels"].split(",")
-        ]
-
-        download_paths: list[Path] = [
-            Path(
-                self.download_dir / label / Path(f"{ytid}_{start_time}-{end_time}.wav")
+                # a worker flushes its side of the queue before it exits, so
+                # once every worker is gone and the queue has been drained
+                # there are no more events to wait for
+                if not workers_alive and progress_queue.empty():
+                    break
+
+        if not scheduler.done:
+            print(f"All workers exited with {len(scheduler.pending)} batches left undownloaded")
+
+        journal.maybe_snapshot(aggregator, num_existing, num_excluded, force=True)
+        journal.close()
+        if self.metrics_file is not None:
+            metrics.maybe_write(self.metrics_file, force=True)
+        if metrics_server is not None:
+            metrics_server.close()
+        if self.clip_index is not None:
+            self.clip_index.save()
+        if self.shard_writer is not None:
+            self.shard_writer.close()
+        if self.feature_extractor is not None:
+            self.feature_extractor.close()
+
+    def pack_clips(self, events: list[ProgressEvent]) -> None:
+        """
+        Streams the clips written by successful downloads into the packed shards,
+        removing the per clip files afterwards if only shards are kept. They are
+        only removed once the shards and their index are flushed, so a crash
+        never loses a clip.
+        """
+        if self.output_mode == OUTPUT_CLIPS:
+            return
+
+        mids: np.ndarray = self.class_labels_df["mid"].to_numpy()
+        packed: list[ProgressEvent] = []
+        for event in events:
+            if event.status != STATUS_DOWNLOADED or not os.path.exists(event.paths[0]):
+                continue
+
+            label_ids: np.ndarray = self.plan.row_labels(event.row_idx)
+            self.shard_writer.add(
+                Path(event.paths[0]),
+                {
+                    "ytid": event.ytid,
+                    "start_seconds": float(self.plan.start_seconds[event.row_idx]),
+                    "end_seconds": float(self.plan.end_seconds[event.row_idx]),
+                    "labels": mids[label_ids].tolist(),
+                    "label_ids": label_ids.tolist(),
+                },
             )
-            for label in positive_labels
-        ]
-        # print(f"Downloading {ytid} from {start_time} to {end_time} to {download_paths}")
-        for paths in download_paths:
-            paths.parent.mkdir(exist_ok=True)
-
-        ret_pair: tuple[int, Optional[Exception]] = download_audio_section(
-            ytid, start_time, end_time, download_paths, "wav", True
-        )
+            packed.append(event)
+
+        self.shard_writer.flush()
+
+        if self.output_mode == OUTPUT_SHARDS:
+            for event in packed:
+                for path in event.paths:
+                    if os.path.lexists(path):
+                        os.remove(path)
+
+    def extract_features(self, events: list[ProgressEvent], split_rows: np.ndarray) -> None:
+        """Submits the clips written by successful downloads to the feature stage."""
+        if self.feature_extractor is None:
+            return
+
+        for event in events:
+            if event.status == STATUS_DOWNLOADED:
+                self.feature_extractor.submit(int(split_rows[event.row_idx]), Path(event.paths[0]))
+        self.feature_extractor.poll()
+
+    def index_clips(self, events: list[ProgressEvent]) -> None:
+        """Adds the clips written by successful downloads to the clip index."""
+        if self.clip_index is None or self.output_mode == OUTPUT_SHARDS:
+            return
+
+        for event in events:
+            if event.status != STATUS_DOWNLOADED:
+                continue
+            for path in event.paths:
+                if os.path.exists(path):
+                    self.clip_index.add(Path(path))
 
-        assert (
-            ret_pair is not None
-        ), f"Error downloading {ytid} from {start_time} to {end_time}"
-
-        # print(f"{ret_pair=}")
-        # while we still keep getting bot sniped, try again
-        while ret_pair[
-            0
-        ] == 1 and "Sign in to confirm you\u2019re not a bot. This helps protect our community. Learn more" in str(
-            ret_pair[1]
-        ):
-            print(
-                f"Job number {job_id} got bot sniped. Retrying download for ytid={ytid} after sleeping for {self.sleep_amount} seconds"
+    def init_multipart_download(self):
+
+        # rows are handed out to the workers in small batches as they need them,
+        # with one batch in hand for every download thread plus one spare
+        if self.ledger is None:
+            scheduler: WorkScheduler = WorkScheduler(
+                0, self.batch_size, prefetch=self.concurrency + 1
             )
-            time.sleep(self.sleep_amount)
-            ret_pair = download_audio_section(
-                ytid, start_time, end_time, download_paths, "wav", True
+            rows: np.ndarray = order_rows(
+                self.plan, self.order, len(self.class_labels_df), self.done_label_counts, self.order_target
             )
+            scheduler.submit(rows.tolist())
+            print(f"Handing out {len(rows)} rows in {self.order} order")
+            feeder: Optional[LedgerFeeder] = None
+        else:
+            scheduler: WorkScheduler = WorkScheduler(
+                0, self.batch_size, prefetch=self.concurrency + 1
+            )
+            feeder: Optional[LedgerFeeder] = LedgerFeeder(
+                self.ledger, scheduler, self.filtered_split_df.index.to_numpy(),
+                target_pending=2 * self.num_jobs * self.concurrency * self.batch_size,
+                state_store=self.state_store,
+            )
+            feeder.tick()
+
+        self.plan.make_label_dirs()
+        self.staging_dir.mkdir(exist_ok=True)
+
+        # the workers map the plan from shared memory and only get these
+        # settings, rather than a pickled (or forked) copy of the whole downloader
+        plan_handle, plan_memories = share_plan(self.plan)
+        settings: WorkerSettings = WorkerSettings(
+            self.concurrency, self.max_retries, self.sleep_amount, self.codec_type,
+            self.sample_rate, self.channels, self.link_mode, self.staging_dir,
+            self.rate_limiter, self.backend, self.transcoders, self.spool_size,
+        )
 
-        assert (
-            ret_pair is not None
-        ), f"Error downloading {ytid} from {start_time} to {end_time}"
-
-        with lock:
-            if ret_pair[0] == 1 or ret_pair[1] is not None:
-                # print(f"{dict['Errors']=}")
-                # print(f"{dict['Error_Ids']=}")
-                dict["Errors"] += [str(ret_pair[1])]
-                dict["Error_Ids"] += [ytid]
-            elif ret_pair[0] == 0:
-                # print(f"{dict['Downloaded_Ids']}")
-                dict["Downloaded_Ids"] += [ytid]
-
-    def init_multipart_download(self):
+        progress_queue: mp.Queue = mp.Queue()
+        worker_processes: list[Worker] = []
 
-        with mp.Manager() as manager:
+        for job_id in range(self.num_jobs):
+            inbox: mp.Queue = scheduler.add_worker(job_id)
+            # daemonic, so a parent that exits on an error takes its workers
+            # with it, and workers of a parent that was killed stop on their own
+            process: mp.Process = mp.Process(
+                target=run_worker, args=(settings, plan_handle, inbox, progress_queue, job_id), daemon=True
+            )
 
-            # Split URLs across workers
+            worker_processes.append(Worker(job_id, process))
 
-            metadata_list: list[pd.DataFrame] = self.split_ids(
-                self.filtered_split_df, self.num_jobs
-            )
-            print(f"{metadata_list=}")
-
-            worker_processes: list[Worker] = []
-
-            for job_id, meta_slice in enumerate(metadata_list):
-                dict_prox: DictProxy = manager.dict()
-                dict_prox["Errors"] = []
-                dict_prox["Error_Ids"] = []
-                dict_prox["Downloaded_Ids"] = []
-                lock: mp.Lock = manager.Lock()
-                process: mp.Process = mp.Process(
-                    target=self.worker, args=(meta_slice, dict_prox, job_id, lock)
-                )
+        scheduler.dispatch()
 
-                worker_processes.append(Worker(dict_prox, lock, job_id, process))
+        # Start worker processes
+        for i, w in enumerate(worker_processes):
+            print(f"Starting process {i}")
+            w.process.start()
 
-            logger_process: mp.Process = mp.Process( target=self.logger, args=(worker_processes, self.total_num_files))
-            logger_process.start()
+        print("Started all processes")
 
-            # Start worker processes
-            for i, w in enumerate(worker_processes):
-                print(f"Starting process {i}")
-                w.process.start()
+        try:
+            # the parent process aggregates progress until every worker is done
+            self.logger(worker_processes, scheduler, progress_queue, self.total_num_files, feeder)
 
-            print("Started all processes")
-            # Wait for all workers to finish
             for w in worker_processes:
                 w.process.join()
-
-            logger_process.close()
+        finally:
+            release_plan(plan_memories, unlink=True)
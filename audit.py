@@ -0,0 +1,223 @@
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+import os
+import time
+import numpy as np
+import pandas as pd
+from clip_index import ClipIndex
+from csv_setup import CsvDownloader
+from downloader import current_download_info_dir, get_existing_ytids, split_names
+from plan import DownloadPlan, build_plan
+from progress import STATUS_DOWNLOADED
+from shards import read_shard_index
+from state_store import StateStore
+from validation import DURATION_TOLERANCE, ClipHeader, InvalidClipError, validate_clip
+
+"""
+Script to audit the clips of a split after downloading it. Every clip on disk is
+checked against its segment in the CSV by reading its header only, in a pool of
+processes, and rows whose clip is missing, short or corrupt are written to a
+report and put back to pending in the state store, so the next run of
+downloader.py downloads them again.
+
+Example:
+    python audit.py --data_dir data --split eval_segments
+    python audit.py --data_dir data --split eval_segments --dry_run
+"""
+
+# rows the state store says were downloaded but that have no clip on disk
+PROBLEM_MISSING: str = "missing"
+# clips more than DURATION_TOLERANCE seconds shorter than their segment
+PROBLEM_SHORT: str = "short"
+# clips that are truncated, can't be read, or are longer than their segment
+PROBLEM_CORRUPT: str = "corrupt"
+
+
+def check_clips(
+    paths: list[str], expected_durations: list[float]
+) -> list[tuple[Optional[str], float, Optional[str]]]:
+    """
+    Checks the headers of a chunk of clips, in a pool process. Returns the
+    problem (None if the clip is fine), duration and error of every clip.
+    """
+    results: list[tuple[Optional[str], float, Optional[str]]] = []
+    for path, expected_duration in zip(paths, expected_durations):
+        try:
+            header: ClipHeader = validate_clip(Path(path), expected_duration)
+        except (InvalidClipError, OSError) as e:
+            results.append((PROBLEM_CORRUPT, 0.0, str(e)))
+            continue
+
+        if header.duration < expected_duration - DURATION_TOLERANCE:
+            results.append((PROBLEM_SHORT, header.duration, None))
+        else:
+            results.append((None, header.duration, None))
+    return results
+
+
+def audit_split(
+    plan: DownloadPlan,
+    split_rows: np.ndarray,
+    clip_index: ClipIndex,
+    downloaded: np.ndarray,
+    packed_ytids: set[str],
+    num_jobs: int,
+    chunk_size: int = 4096,
+) -> pd.DataFrame:
+    """
+    Audits the rows of a plan against the clips in the index. `downloaded` tells
+    which rows the state store counts as downloaded, and `packed_ytids` holds the
+    videos whose clips only live in the shards. Returns the report, one line per
+    missing row or bad clip.
+    """
+    # clip file name -> the label directories it was found in
+    found: dict[str, list[str]] = {}
+    for label, entry in clip_index.entries.items():
+        for name in entry["clips"]:
+            found.setdefault(name, []).append(label)
+
+    report: list[dict] = []
+    paths: list[str] = []
+    path_rows: list[int] = []
+    expected_durations: list[float] = []
+    for row_idx in range(len(plan)):
+        labels: Optional[list[str]] = found.get(str(plan.file_names[row_idx]))
+        if labels is None:
+            if downloaded[row_idx] and str(plan.ytid[row_idx]) not in packed_ytids:
+                report.append({"row_idx": row_idx, "problem": PROBLEM_MISSING, "path": None, "duration": 0.0, "error": None})
+            continue
+
+        expected_duration: float = float(plan.end_seconds[row_idx] - plan.start_seconds[row_idx])
+        for label in labels:
+            paths.append(str(clip_index.split_dir / label / str(plan.file_names[row_idx])))
+            path_rows.append(row_idx)
+            expected_durations.append(expected_duration)
+
+    # reading a header is a couple of small reads, so the clips are handed out
+    # in chunks to keep the pool's overhead per clip low
+    starts: range = range(0, len(paths), chunk_size)
+    with ProcessPoolExecutor(max_workers=num_jobs) as executor:
+        chunk_results = executor.map(
+            check_clips,
+            [paths[start : start + chunk_size] for start in starts],
+            [expected_durations[start : start + chunk_size] for start in starts],
+        )
+        position: int = 0
+        for results in chunk_results:
+            for problem, duration, error in results:
+                if problem is not None:
+                    report.append(
+                        {"row_idx": path_rows[position], "problem": problem, "path": paths[position], "duration": duration, "error": error}
+                    )
+                position += 1
+
+    report_df: pd.DataFrame = pd.DataFrame(report, columns=["row_idx", "problem", "path", "duration", "error"])
+    row_idx: np.ndarray = report_df["row_idx"].to_numpy(dtype=np.int64)
+    report_df.insert(0, "row", split_rows[row_idx])
+    report_df.insert(1, "ytid", plan.ytid[row_idx])
+    report_df.insert(2, "start_seconds", plan.start_seconds[row_idx])
+    report_df.insert(3, "end_seconds", plan.end_seconds[row_idx])
+    print(f"Checked {len(paths)} clips of {len(plan)} rows")
+    return report_df.drop(columns=["row_idx"]).sort_values(["row", "path"], na_position="first")
+
+
+def row_problems(report_df: pd.DataFrame) -> pd.Series:
+    """Returns the worst problem of every row in a report, corrupt before short."""
+    rank: dict[str, int] = {PROBLEM_MISSING: 0, PROBLEM_CORRUPT: 1, PROBLEM_SHORT: 2}
+    ranked: pd.DataFrame = report_df.assign(rank=report_df["problem"].map(rank)).sort_values("rank", kind="stable")
+    return ranked.groupby("row", sort=True)["problem"].first()
+
+
+def remove_clips(plan: DownloadPlan, row_idx: np.ndarray) -> int:
+    """
+    Removes every copy of the clips of the given rows, so the next run neither
+    counts them as existing nor keeps a broken copy next to the new clip.
+    Returns the number of files removed.
+    """
+    num_removed: int = 0
+    for i in row_idx:
+        for path in plan.output_paths(int(i)):
+            if os.path.lexists(path):
+                os.remove(path)
+                num_removed += 1
+    return num_removed
+
+
+def args_checks(args: Namespace):
+    assert args.split in split_names, f"Invalid split name: {args.split}"
+    assert args.n_splits >= 1, "Number of splits must be at least 1"
+    assert 0 <= args.split_idx < args.n_splits, "Split index must be at least 0 and less than the number of splits"
+    assert args.audit_jobs >= 1, "Number of audit jobs must be at least 1"
+    assert args.chunk_size >= 1, "Chunk size must be at least 1"
+
+
+if __name__ == "__main__":
+
+    argparser: ArgumentParser = ArgumentParser()
+
+    argparser.add_argument( "--data_dir", type=str, required=True, help="Directory the split directories were downloaded to")
+    argparser.add_argument( "--split", type=str, required=True, choices=split_names, help="The split to audit")
+    argparser.add_argument( "--n_splits", type=int, default=1, help="The number of splits the split was downloaded in")
+    argparser.add_argument( "--split_idx", type=int, default=0, help="The index of the split to audit")
+    argparser.add_argument( "--cache_dir", type=str, default="./cache", help="Directory where CSV files are cached")
+    argparser.add_argument( "--codec", type=str, default="wav", choices=["wav", "flac"], help="Codec the clips were stored in")
+    argparser.add_argument( "--state_db", type=str, default=None, help="SQLite state store of the split, defaults to current_download_info/<split>_state.db")
+    argparser.add_argument( "--shard_dir", type=str, default=None, help="Directory of the packed shards, whose clips don't count as missing, defaults to <data_dir>/<split>_shards")
+    argparser.add_argument( "--report", type=str, default=None, help="CSV file the report is written to, defaults to current_download_info/<split>_audit.csv")
+    argparser.add_argument( "--audit_jobs", type=int, default=os.cpu_count() or 1, help="Number of processes reading clip headers")
+    argparser.add_argument( "--chunk_size", type=int, default=4096, help="Number of clips handed to an audit process at a time")
+    argparser.add_argument( "--scan_threads", type=int, default=8, help="Number of threads used to rescan changed label directories")
+    argparser.add_argument( "--keep_short", action="store_true", help="Only report short clips, e.g. of videos that end before their segment does, instead of downloading them again")
+    argparser.add_argument( "--dry_run", action="store_true", help="Only write the report, without removing bad clips or requeueing their rows")
+
+    args: Namespace = argparser.parse_args()
+    args_checks(args)
+
+    data_dir: Path = Path(args.data_dir)
+    split_dir: Path = data_dir / Path(args.split)
+    assert split_dir.exists(), f"{split_dir} does not exist"
+    current_download_info_dir.mkdir(exist_ok=True)
+
+    csvDownloader: CsvDownloader = CsvDownloader(args.split, args.cache_dir)
+    print("Loading CSVs...")
+    split_df: pd.DataFrame = csvDownloader.load_segment_csv_url(args.n_splits, args.split_idx, CsvDownloader.split_quantities[args.split])
+    class_mapping_df: pd.DataFrame = csvDownloader.load_class_mapping_csv()
+
+    existing_ytids, clip_index = get_existing_ytids(split_dir, args.scan_threads)
+    shard_dir: Path = Path(args.shard_dir) if args.shard_dir is not None else data_dir / Path(f"{args.split}_shards")
+    packed_ytids: set[str] = {entry["ytid"] for entry in read_shard_index(shard_dir)}
+
+    # the same import of the clips on disk a download starts with, so the store
+    # is current before it is compared against the clips
+    state_db: Path = Path(args.state_db) if args.state_db is not None else current_download_info_dir / Path(f"{args.split}_state.db")
+    state_store: StateStore = StateStore(state_db)
+    state_store.add_segments(split_df)
+    state_store.mark_ytids(existing_ytids | packed_ytids, STATUS_DOWNLOADED)
+
+    split_rows: np.ndarray = split_df.index.to_numpy(dtype=np.int64)
+    row_start, row_stop = int(split_rows[0]), int(split_rows[-1]) + 1
+    downloaded: np.ndarray = np.isin(split_rows, state_store.rows_with_status(STATUS_DOWNLOADED, row_start, row_stop))
+    plan: DownloadPlan = build_plan(split_df, class_mapping_df, split_dir, args.codec, csvDownloader.columns)
+
+    start: float = time.time()
+    report_df: pd.DataFrame = audit_split(plan, split_rows, clip_index, downloaded, packed_ytids, args.audit_jobs, args.chunk_size)
+    print(f"Audited {args.split} in {time.time() - start:.1f} seconds")
+
+    report_file: Path = Path(args.report) if args.report is not None else current_download_info_dir / Path(f"{args.split}_audit.csv")
+    report_df.to_csv(report_file, index=False)
+    problems: pd.Series = row_problems(report_df)
+    print(f"Row problems: {problems.value_counts().to_dict()}, written to {report_file}")
+
+    if args.keep_short:
+        problems = problems[problems != PROBLEM_SHORT]
+    if args.dry_run:
+        print(f"Dry run, leaving the {len(problems)} rows to requeue alone")
+    elif len(problems) > 0:
+        row_idx: np.ndarray = np.searchsorted(split_rows, problems.index.to_numpy(dtype=np.int64))
+        num_removed: int = remove_clips(plan, row_idx)
+        state_store.requeue_rows(problems.index.tolist(), [f"audit: {problem}" for problem in problems])
+        # the label directories the clips were removed from are rescanned on the next start
+        print(f"Removed {num_removed} clip files and requeued {len(problems)} rows in {state_db}")
+    state_store.close()
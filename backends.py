@@ -0,0 +1,269 @@
+from pathlib import Path
+from typing import Optional
+import random
+import struct
+import time
+import wave
+from metrics import STAGE_FETCH, STAGE_POSTPROCESS, timed_stage
+
+"""
+Script to define the backends that actually fetch a clip. The default one goes
+through yt-dlp, the synthetic one generates silent WAVs locally with configurable
+latency and failure rates, so the rest of the pipeline can be run and profiled
+without a network.
+"""
+
+BOT_CHECK_MESSAGE: str = "Sign in to confirm you\u2019re not a bot. This helps protect our community. Learn more"
+
+
+class DownloadBackend:
+    """
+    Interface of a download backend. `download` writes the section of a video's
+    audio to `dwnld_paths[0]` and returns the same (return code, exception) pair
+    as `ytdlp_download.download_audio_section`. A sample rate or channel count of
+    None keeps the one of the source.
+
+    A backend that can split a download into a fetch of the raw audio and a
+    separate transcode sets `supports_pipeline`, which lets the workers run the
+    two in separate stages.
+    """
+
+    name: str = ""
+    supports_pipeline: bool = False
+
+    def download(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        dwnld_paths: list[Path],
+        codec_type: str = "wav",
+        quiet: bool = True,
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        raise NotImplementedError
+
+    def fetch(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        spool_stem: Path,
+        quiet: bool = True,
+    ) -> tuple[int, Optional[Exception], Optional[Path]]:
+        """
+        Writes the section of a video's audio, as is, to `spool_stem` plus an
+        extension. Returns the return code, the error and the path it went to.
+        """
+        raise NotImplementedError
+
+    def transcode(
+        self,
+        raw_path: Path,
+        dwnld_path: Path,
+        codec_type: str = "wav",
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        """Transcodes audio written by `fetch` into the clip at `dwnld_path`."""
+        raise NotImplementedError
+
+
+class YtdlpBackend(DownloadBackend):
+    """
+    Downloads clips from YouTube with yt-dlp.
+    """
+
+    name: str = "ytdlp"
+    supports_pipeline: bool = True
+
+    def download(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        dwnld_paths: list[Path],
+        codec_type: str = "wav",
+        quiet: bool = True,
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        # imported here so that yt-dlp isn't needed to run the other backends
+        from ytdlp_download import download_audio_section
+
+        return download_audio_section(
+            ytid, start_time, end_time, dwnld_paths, codec_type, quiet, sample_rate, channels
+        )
+
+    def fetch(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        spool_stem: Path,
+        quiet: bool = True,
+    ) -> tuple[int, Optional[Exception], Optional[Path]]:
+        from ytdlp_download import fetch_audio_section
+
+        return fetch_audio_section(ytid, start_time, end_time, spool_stem, quiet)
+
+    def transcode(
+        self,
+        raw_path: Path,
+        dwnld_path: Path,
+        codec_type: str = "wav",
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        from ytdlp_download import transcode_audio
+
+        return transcode_audio(raw_path, dwnld_path, codec_type, sample_rate, channels)
+
+
+class SyntheticDownloadError(Exception):
+    """
+    Error raised by the synthetic backend, standing in for a `YoutubeDLError`.
+    """
+
+
+class SyntheticBackend(DownloadBackend):
+    """
+    Generates silent WAV clips of the requested duration instead of downloading
+    them, so it only supports the "wav" codec. Whether a video is unavailable is decided once per YTID, so retries
+    behave like they would against YouTube, while bot checks and transient server
+    errors are random per call.
+
+    With `sparse` the samples of a clip are left as a hole in the file, so the
+    clips have their full size and duration but take next to no disk space.
+    """
+
+    name: str = "synthetic"
+    supports_pipeline: bool = True
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_jitter: float = 0.0,
+        failure_rate: float = 0.0,
+        bot_block_rate: float = 0.0,
+        transient_rate: float = 0.0,
+        sample_rate: int = 44100,
+        channels: int = 2,
+        seed: int = 0,
+        sparse: bool = False,
+    ):
+        assert 0 <= failure_rate <= 1, "Failure rate must be between 0 and 1"
+        assert 0 <= bot_block_rate <= 1, "Bot block rate must be between 0 and 1"
+        assert 0 <= transient_rate <= 1, "Transient failure rate must be between 0 and 1"
+
+        self.latency: float = latency
+        self.latency_jitter: float = latency_jitter
+        self.failure_rate: float = failure_rate
+        self.bot_block_rate: float = bot_block_rate
+        self.transient_rate: float = transient_rate
+        # what a clip comes out as when no sample rate or channel count is asked for
+        self.sample_rate: int = sample_rate
+        self.channels: int = channels
+        self.seed: int = seed
+        self.sparse: bool = sparse
+
+    def download(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        dwnld_paths: list[Path],
+        codec_type: str = "wav",
+        quiet: bool = True,
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        error: Optional[Exception] = self._simulate_fetch(ytid)
+        if error is not None:
+            return (1, error)
+
+        with timed_stage(STAGE_POSTPROCESS):
+            self._write_silence(
+                dwnld_paths[0], end_time - start_time, sample_rate or self.sample_rate, channels or self.channels
+            )
+        return (0, None)
+
+    def fetch(
+        self,
+        ytid: str,
+        start_time: float,
+        end_time: float,
+        spool_stem: Path,
+        quiet: bool = True,
+    ) -> tuple[int, Optional[Exception], Optional[Path]]:
+        error: Optional[Exception] = self._simulate_fetch(ytid)
+        if error is not None:
+            return (1, error, None)
+
+        # the raw audio comes out at the source's rate and channel count
+        raw_path: Path = Path(str(spool_stem) + ".wav")
+        self._write_silence(raw_path, end_time - start_time, self.sample_rate, self.channels)
+        return (0, None, raw_path)
+
+    def transcode(
+        self,
+        raw_path: Path,
+        dwnld_path: Path,
+        codec_type: str = "wav",
+        sample_rate: Optional[int] = None,
+        channels: Optional[int] = None,
+    ) -> tuple[int, Optional[Exception]]:
+        with timed_stage(STAGE_POSTPROCESS):
+            with wave.open(str(raw_path), "rb") as f:
+                duration: float = f.getnframes() / f.getframerate()
+            self._write_silence(dwnld_path, duration, sample_rate or self.sample_rate, channels or self.channels)
+        return (0, None)
+
+    def _simulate_fetch(self, ytid: str) -> Optional[Exception]:
+        """Waits out the latency of a fetch and returns the error it fails with, if any."""
+        with timed_stage(STAGE_FETCH):
+            time.sleep(max(0.0, self.latency + random.uniform(-1, 1) * self.latency_jitter))
+
+        if random.random() < self.bot_block_rate:
+            return SyntheticDownloadError(f"ERROR: [youtube] {ytid}: {BOT_CHECK_MESSAGE}")
+
+        if random.Random(f"{self.seed}-{ytid}").random() < self.failure_rate:
+            return SyntheticDownloadError(f"ERROR: [youtube] {ytid}: Video unavailable")
+
+        if random.random() < self.transient_rate:
+            return SyntheticDownloadError(f"ERROR: [youtube] {ytid}: HTTP Error 503: Service Unavailable")
+        return None
+
+    def _write_silence(self, path: Path, duration: float, sample_rate: int, channels: int) -> None:
+        num_frames: int = int(round(duration * sample_rate))
+        if self.sparse:
+            # the 44 byte header of a 16-bit PCM WAV, then a hole up to the end of its data
+            data_size: int = num_frames * channels * 2
+            with open(path, "wb") as f:
+                f.write(
+                    struct.pack(
+                        "<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, channels,
+                        sample_rate, sample_rate * channels * 2, channels * 2, 16, b"data", data_size,
+                    )
+                )
+                f.truncate(44 + data_size)
+            return
+
+        with wave.open(str(path), "wb") as f:
+            f.setnchannels(channels)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(bytes(num_frames * channels * 2))
+
+
+BACKENDS: dict[str, type[DownloadBackend]] = {
+    YtdlpBackend.name: YtdlpBackend,
+    SyntheticBackend.name: SyntheticBackend,
+}
+
+
+def get_backend(name: str, **kwargs) -> DownloadBackend:
+    """Creates the backend registered under `name`."""
+    assert name in BACKENDS, f"Invalid backend name: {name}"
+    return BACKENDS[name](**kwargs)
@@ -0,0 +1,302 @@
+from argparse import ArgumentParser, Namespace
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Callable, Optional
+import json
+import multiprocessing as mp
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from backends import SyntheticBackend
+from clip_index import ClipIndex
+from csv_setup import CsvDownloader
+from journal import StatusJournal
+from MultiPartDownloader import MultiPartDownloader
+from plan import DownloadPlan, build_plan
+from progress import ProgressAggregator, ProgressEvent, STATUS_DOWNLOADED
+from rate_limit import AdaptiveRateLimiter
+from scheduler import WorkScheduler
+
+"""
+Script to benchmark the parts of the download pipeline that don't touch the
+network: loading the metadata, scanning the split directory, planning and
+scheduling a shard, the progress channel, and a full run against the synthetic
+backend. Everything runs on synthetic CSVs, and every benchmark runs in its own
+process so its peak RSS, and that of the processes it starts, can be reported.
+
+Example:
+    python benchmark.py --scales eval_segments balanced_train_segments
+    python benchmark.py --compare bench_results/<commit>.json
+"""
+
+scale_names: list[str] = list(CsvDownloader.split_quantities)
+
+
+def make_synthetic_split(cache_dir: Path, split_name: str, num_rows: int, seed: int = 0) -> None:
+    """
+    Writes a class labels CSV and a segment CSV cache with `num_rows` rows, in
+    the same "|" separated format CsvDownloader caches the real ones in. Label
+    frequencies are skewed like AudioSet's, a few labels cover half the rows.
+    """
+    rng: np.random.Generator = np.random.default_rng(seed)
+    num_labels: int = CsvDownloader.class_to_label_csv_length
+    mids: np.ndarray = np.array([f"/m/{i:05d}" for i in range(num_labels)])
+
+    pd.DataFrame(
+        {"index": range(num_labels), "mid": mids, "display_name": [f"Label {i}" for i in range(num_labels)]}
+    ).to_csv(cache_dir / Path("class_labels_indices.csv"), index=False)
+
+    label_probs: np.ndarray = 1.0 / np.arange(1, num_labels + 1)
+    label_probs /= label_probs.sum()
+    num_row_labels: np.ndarray = rng.integers(1, 4, num_rows)
+    flat_labels: np.ndarray = mids[rng.choice(num_labels, size=num_row_labels.sum(), p=label_probs)]
+    offsets: np.ndarray = np.concatenate([[0], np.cumsum(num_row_labels)])
+    positive_labels: list[str] = [
+        '"' + ",".join(dict.fromkeys(flat_labels[offsets[i] : offsets[i + 1]])) + '"' for i in range(num_rows)
+    ]
+
+    start_seconds: np.ndarray = rng.integers(0, 300, num_rows).astype(np.float64)
+    pd.DataFrame(
+        {
+            "YTID": [f"Y{i:010d}" for i in range(num_rows)],
+            "start_seconds": start_seconds,
+            "end_seconds": start_seconds + 10.0,
+            "positive_labels": positive_labels,
+        }
+    ).to_csv(cache_dir / Path(f"{split_name}.csv"), sep="|")
+
+
+def timed(func: Callable, *args, **kwargs) -> tuple[float, object]:
+    start: float = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_csv_load(work_dir: Path, split_name: str, num_rows: int) -> dict:
+    """Time to build the columnar cache, and to load a shard from it afterwards."""
+    csv_downloader: CsvDownloader = CsvDownloader(split_name, work_dir / Path("cache"))
+    cold, _ = timed(csv_downloader.load_segment_csv_url, 1, 0, num_rows)
+    warm_full, _ = timed(csv_downloader.load_segment_csv_url, 1, 0, num_rows)
+    warm_shard, _ = timed(csv_downloader.load_segment_csv_url, 8, 7, num_rows)
+    return {
+        "cold_load_s": cold,
+        "warm_load_s": warm_full,
+        "warm_shard_load_s": warm_shard,
+        "rows_per_s": num_rows / warm_full,
+    }
+
+
+def bench_scan(work_dir: Path, split_name: str, num_rows: int, max_files: int) -> dict:
+    """Time to index the clips under a split directory, without and with a manifest."""
+    csv_downloader: CsvDownloader = CsvDownloader(split_name, work_dir / Path("cache"))
+    metadata: pd.DataFrame = csv_downloader.load_segment_csv_url(1, 0, num_rows).iloc[:max_files]
+    plan: DownloadPlan = build_plan(
+        metadata, csv_downloader.load_class_mapping_csv(), work_dir / Path("data"), columns=csv_downloader.columns
+    )
+
+    (work_dir / Path("data")).mkdir(exist_ok=True)
+    plan.make_label_dirs()
+    for row_idx in range(len(plan)):
+        plan.output_paths(row_idx)[0].touch()
+
+    clip_index: ClipIndex = ClipIndex(work_dir / Path("data"))
+    cold, _ = timed(clip_index.scan)
+    clip_index.save()
+
+    clip_index = ClipIndex(work_dir / Path("data"))
+    warm, _ = timed(lambda: (clip_index.load(), clip_index.scan(), clip_index.ytids()))
+    return {"num_files": len(plan), "cold_scan_s": cold, "warm_scan_s": warm, "files_per_s": len(plan) / cold}
+
+
+def bench_plan(work_dir: Path, split_name: str, num_rows: int, num_jobs: int, batch_size: int) -> dict:
+    """Time to plan a shard and to hand all of its rows out through the scheduler."""
+    csv_downloader: CsvDownloader = CsvDownloader(split_name, work_dir / Path("cache"))
+    metadata: pd.DataFrame = csv_downloader.load_segment_csv_url(1, 0, num_rows)
+    class_labels: pd.DataFrame = csv_downloader.load_class_mapping_csv()
+    plan_s, plan = timed(build_plan, metadata, class_labels, work_dir / Path("data"), columns=csv_downloader.columns)
+
+    def schedule_all() -> None:
+        scheduler: WorkScheduler = WorkScheduler(len(plan), batch_size)
+        for job_id in range(num_jobs):
+            # nobody reads the inboxes, so the process mustn't wait on exit
+            # for their batches to be flushed into the pipes
+            scheduler.add_worker(job_id).cancel_join_thread()
+        while not scheduler.done:
+            scheduler.dispatch()
+            for slot in scheduler.slots.values():
+                for row_idx in list(slot.row_batches):
+                    scheduler.complete(slot.job_id, row_idx)
+
+    schedule_s, _ = timed(schedule_all)
+    return {"plan_s": plan_s, "schedule_s": schedule_s, "rows_per_s": num_rows / (plan_s + schedule_s)}
+
+
+def send_events(queue: mp.Queue, job_id: int, num_events: int) -> None:
+    for i in range(num_events):
+        queue.put(ProgressEvent(job_id, f"Y{i:010d}", STATUS_DOWNLOADED, None, 0.0, i, [f"Label 0/Y{i:010d}_0.0-10.0.wav"]))
+
+
+def bench_progress(work_dir: Path, num_events: int, num_jobs: int) -> dict:
+    """Cost per completed clip of sending, aggregating and journaling its event."""
+    queue: mp.Queue = mp.Queue()
+    per_job: int = num_events // num_jobs
+    senders: list[mp.Process] = [
+        mp.Process(target=send_events, args=(queue, job_id, per_job)) for job_id in range(num_jobs)
+    ]
+
+    aggregator: ProgressAggregator = ProgressAggregator(list(range(num_jobs)))
+    journal: StatusJournal = StatusJournal(work_dir, snapshot_interval=1.0)
+
+    start: float = time.perf_counter()
+    for p in senders:
+        p.start()
+    while aggregator.num_finished < per_job * num_jobs:
+        journal.append(aggregator.drain(queue, timeout=1))
+        journal.maybe_snapshot(aggregator, 0, 0)
+    elapsed: float = time.perf_counter() - start
+
+    for p in senders:
+        p.join()
+    journal.close()
+    return {"num_events": per_job * num_jobs, "total_s": elapsed, "us_per_event": 1e6 * elapsed / (per_job * num_jobs)}
+
+
+def bench_end_to_end(work_dir: Path, split_name: str, num_rows: int, e2e_rows: int, num_jobs: int, concurrency: int, latency: float) -> dict:
+    """Rows per second of a full MultiPartDownloader run against the synthetic backend."""
+    csv_downloader: CsvDownloader = CsvDownloader(split_name, work_dir / Path("cache"))
+    metadata: pd.DataFrame = csv_downloader.load_segment_csv_url(1, 0, num_rows).iloc[:e2e_rows]
+    class_labels: pd.DataFrame = csv_downloader.load_class_mapping_csv()
+
+    data_dir: Path = work_dir / Path("e2e_data")
+    info_dir: Path = work_dir / Path("e2e_info")
+    data_dir.mkdir(exist_ok=True)
+    info_dir.mkdir(exist_ok=True)
+
+    start: float = time.perf_counter()
+    downloader: MultiPartDownloader = MultiPartDownloader(
+        num_jobs, metadata, class_labels, data_dir, 0, info_dir, len(metadata), [], [],
+        concurrency=concurrency,
+        rate_limiter=AdaptiveRateLimiter(initial_rate=1e6, min_rate=1e6, max_rate=1e6, initial_inflight=num_jobs * concurrency),
+        # the clips only hold a header, 10 s of full size audio per row would
+        # need gigabytes of disk for the default number of rows
+        backend=SyntheticBackend(latency=latency, failure_rate=0.1, sparse=True),
+        columns=csv_downloader.columns,
+    )
+    startup_s: float = time.perf_counter() - start
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+        downloader.init_multipart_download()
+    elapsed: float = time.perf_counter() - start
+    return {"num_rows": len(metadata), "startup_s": startup_s, "total_s": elapsed, "rows_per_s": len(metadata) / elapsed}
+
+
+def run_isolated(result_queue: mp.Queue, func: Callable, args: tuple) -> None:
+    result: dict = func(*args)
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    # the largest of the processes the benchmark started and waited for, e.g. the download workers
+    result["peak_children_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    result_queue.put(result)
+
+
+def isolated(func: Callable, *args) -> dict:
+    """Runs a benchmark in a fresh process, so it gets its own peak RSS."""
+    result_queue: mp.Queue = mp.Queue()
+    process: mp.Process = mp.Process(target=run_isolated, args=(result_queue, func, args))
+    process.start()
+    result: dict = result_queue.get()
+    process.join()
+    return result
+
+
+def get_commit() -> str:
+    result: subprocess.CompletedProcess = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+    )
+    return result.stdout.strip() or "unknown"
+
+
+def compare_results(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns a line for every metric that got worse than the baseline by more than
+    `threshold`. Throughputs should go up, everything else should go down.
+    """
+    regressions: list[str] = []
+    for scale, benches in current["results"].items():
+        for bench, metrics in benches.items():
+            base_metrics: Optional[dict] = baseline["results"].get(scale, {}).get(bench)
+            if base_metrics is None:
+                continue
+            for metric, value in metrics.items():
+                base_value = base_metrics.get(metric)
+                if not base_value or metric.startswith("num_"):
+                    continue
+                higher_is_better: bool = metric.endswith("_per_s")
+                change: float = (value - base_value) / base_value
+                if (higher_is_better and change < -threshold) or (not higher_is_better and change > threshold):
+                    regressions.append(f"{scale}/{bench}/{metric}: {base_value:.4g} -> {value:.4g} ({change:+.1%})")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    argparser: ArgumentParser = ArgumentParser()
+
+    argparser.add_argument( "--scales", type=str, nargs="+", default=["eval_segments", "balanced_train_segments"], choices=scale_names, help="Split sizes to benchmark at")
+    argparser.add_argument( "--n_jobs", type=int, default=4, help="Number of jobs for the scheduling, progress and end to end benchmarks")
+    argparser.add_argument( "--concurrency", type=int, default=8, help="Downloads in flight per job for the end to end benchmark")
+    argparser.add_argument( "--batch_size", type=int, default=16, help="Scheduler batch size")
+    argparser.add_argument( "--max_scan_files", type=int, default=200000, help="Upper bound on the clip files created for the scan benchmark")
+    argparser.add_argument( "--e2e_rows", type=int, default=5000, help="Number of rows downloaded in the end to end benchmark")
+    argparser.add_argument( "--e2e_latency", type=float, default=0.0, help="Seconds each synthetic download takes in the end to end benchmark")
+    argparser.add_argument( "--results_dir", type=str, default="./bench_results", help="Directory the results are written to, one file per commit")
+    argparser.add_argument( "--compare", type=str, default=None, help="Results file of an earlier commit to check for regressions against")
+    argparser.add_argument( "--threshold", type=float, default=0.1, help="Relative slowdown that counts as a regression")
+
+    args: Namespace = argparser.parse_args()
+
+    results: dict = {}
+    for split_name in args.scales:
+        num_rows: int = CsvDownloader.split_quantities[split_name]
+        work_dir: Path = Path(tempfile.mkdtemp(prefix=f"bench_{split_name}_"))
+        (work_dir / Path("cache")).mkdir()
+        print(f"Benchmarking {split_name} ({num_rows} rows) in {work_dir}")
+
+        try:
+            make_synthetic_split(work_dir / Path("cache"), split_name, num_rows)
+            results[split_name] = {}
+            results[split_name]["csv_load"] = isolated(bench_csv_load, work_dir, split_name, num_rows)
+            results[split_name]["scan"] = isolated(bench_scan, work_dir, split_name, num_rows, args.max_scan_files)
+            results[split_name]["plan"] = isolated(bench_plan, work_dir, split_name, num_rows, args.n_jobs, args.batch_size)
+            results[split_name]["progress"] = isolated(bench_progress, work_dir, min(num_rows, 200000), args.n_jobs)
+            results[split_name]["end_to_end"] = isolated(
+                bench_end_to_end, work_dir, split_name, num_rows, args.e2e_rows, args.n_jobs, args.concurrency, args.e2e_latency
+            )
+        finally:
+            shutil.rmtree(work_dir)
+
+        for bench, metrics in results[split_name].items():
+            print(f"  {bench}: " + ", ".join(f"{k}={v:.4g}" for k, v in metrics.items()))
+
+    commit: str = get_commit()
+    output: dict = {"commit": commit, "timestamp": time.time(), "args": vars(args), "results": results}
+
+    results_dir: Path = Path(args.results_dir)
+    results_dir.mkdir(exist_ok=True)
+    results_file: Path = results_dir / Path(f"{commit}.json")
+    with open(results_file, "w") as f:
+        json.dump(output, f, indent=4)
+    print(f"Saved results to {results_file}")
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            baseline: dict = json.load(f)
+        regressions: list[str] = compare_results(output, baseline, args.threshold)
+        print(f"Compared against {baseline['commit']}: {len(regressions)} regressions")
+        for line in regressions:
+            print(f"  {line}")
+        if regressions:
+            raise SystemExit(1)
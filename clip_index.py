@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional
+import json
+import os
+import re
+
+"""
+Script to define an index of the clips already present under a split directory.
+The index is kept in a manifest next to the clips, so a restart only has to
+rescan the label directories whose mtime changed since the manifest was written.
+"""
+
+# matches clip file names of the form "{ytid}_{start}-{end}.{wav,flac}"
+CLIP_NAME_RE: re.Pattern = re.compile(
+    r"^(?P<ytid>.+)_(?P<start>\d+(?:\.\d+)?)[-_](?P<end>\d+(?:\.\d+)?)\.(?:wav|flac)$"
+)
+
+
+def parse_clip_name(name: str) -> Optional[tuple[str, float, float]]:
+    """Returns the (ytid, start, end) of a clip file name, or None if it isn't one."""
+    match: Optional[re.Match] = CLIP_NAME_RE.match(name)
+    if match is None:
+        return None
+    return match["ytid"], float(match["start"]), float(match["end"])
+
+
+def scan_clip_dir(dir_path: str) -> list[str]:
+    """Lists the names of the clip files directly inside a directory."""
+    with os.scandir(dir_path) as it:
+        return [
+            entry.name
+            for entry in it
+            if CLIP_NAME_RE.match(entry.name) is not None and entry.is_file()
+        ]
+
+
+class ClipIndex:
+    """
+    Index of the clips under a split directory, one entry per label directory
+    holding the directory's mtime and the clip file names found in it.
+    """
+
+    manifest_name: str = ".clip_manifest.json"
+
+    def __init__(self, split_dir: Path, num_threads: int = 8):
+        self.split_dir: Path = Path(split_dir)
+        self.manifest_file: Path = self.split_dir / Path(self.manifest_name)
+        self.num_threads: int = num_threads
+        # label dir name -> {"mtime_ns": int, "clips": set of file names}
+        self.entries: dict[str, dict] = {}
+        self.dirty: bool = False
+
+    def load(self) -> None:
+        """Loads the manifest written by a previous run, if there is one."""
+        if not self.manifest_file.exists():
+            return
+
+        try:
+            with open(self.manifest_file, "r") as f:
+                manifest: dict = json.load(f)
+        except json.JSONDecodeError:
+            print(f"Ignoring unreadable clip manifest {self.manifest_file}")
+            return
+
+        self.entries = {
+            label: {"mtime_ns": entry["mtime_ns"], "clips": set(entry["clips"])}
+            for label, entry in manifest.items()
+        }
+
+    def save(self) -> None:
+        """Atomically writes the manifest, if anything changed since the last save."""
+        if not self.dirty:
+            return
+
+        manifest: dict = {
+            label: {"mtime_ns": entry["mtime_ns"], "clips": sorted(entry["clips"])}
+            for label, entry in self.entries.items()
+        }
+        tmp_file: Path = self.manifest_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file, self.manifest_file)
+        self.dirty = False
+
+    def scan(self) -> int:
+        """
+        Brings the index up to date with the split directory, only rescanning the
+        label directories that are new or whose mtime changed. Returns the number
+        of directories that were rescanned.
+        """
+        label_dirs: dict[str, int] = {}
+        with os.scandir(self.split_dir) as it:
+            for entry in it:
+                if entry.is_dir() and not entry.name.startswith("."):
+                    label_dirs[entry.name] = entry.stat().st_mtime_ns
+
+        stale: list[str] = [
+            label
+            for label, mtime_ns in label_dirs.items()
+            if label not in self.entries or self.entries[label]["mtime_ns"] != mtime_ns
+        ]
+        removed: list[str] = [label for label in self.entries if label not in label_dirs]
+
+        for label in removed:
+            del self.entries[label]
+
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            dir_paths: list[str] = [str(self.split_dir / label) for label in stale]
+            for label, clips in zip(stale, executor.map(scan_clip_dir, dir_paths)):
+                self.entries[label] = {"mtime_ns": label_dirs[label], "clips": set(clips)}
+
+        self.dirty = self.dirty or len(stale) > 0 or len(removed) > 0
+        return len(stale)
+
+    def add(self, clip_path: Path) -> None:
+        """Records a clip that was just written under one of the label directories."""
+        clip_path = Path(clip_path)
+        label: str = clip_path.parent.name
+        entry: dict = self.entries.setdefault(label, {"mtime_ns": 0, "clips": set()})
+        entry["clips"].add(clip_path.name)
+        # the directory's mtime now can't tell whether the clip is the only thing
+        # that changed in it, so the entry is rescanned on the next scan
+        entry["mtime_ns"] = 0
+        self.dirty = True
+
+    def ytids(self) -> set[str]:
+        """Returns the IDs of every clip in the index."""
+        ytids: set[str] = set()
+        for entry in self.entries.values():
+            for name in entry["clips"]:
+                ytids.add(CLIP_NAME_RE.match(name)["ytid"])
+        return ytids
@@ -1,8 +1,112 @@
+from dataclasses import dataclass
 from pathlib import Path
+from typing import Optional
+import json
+import os
+import numpy as np
 import pandas as pd
 import time
 
 
+def split_bounds(num_rows: int, n_splits: int, split_idx: int) -> tuple[int, int]:
+    """
+    Returns the [start, stop) row range of shard `split_idx` out of `n_splits`,
+    using the same boundaries as np.array_split so no rows are left over.
+    """
+    q, r = divmod(num_rows, n_splits)
+    start: int = split_idx * q + min(split_idx, r)
+    stop: int = start + q + (1 if split_idx < r else 0)
+    return start, stop
+
+
+def split_labels(positive_labels: pd.Series) -> tuple[np.ndarray, pd.Series]:
+    """
+    Splits comma joined labels into CSR form: the labels of row i are
+    labels[offsets[i]:offsets[i + 1]] of the returned flat Series.
+    """
+    labels: pd.Series = positive_labels.str.split(",")
+    offsets: np.ndarray = np.zeros(len(labels) + 1, dtype=np.int64)
+    np.cumsum(labels.str.len().to_numpy(dtype=np.int64), out=offsets[1:])
+    return offsets, labels.explode(ignore_index=True)
+
+
+@dataclass
+class SegmentColumns:
+    """
+    Column arrays for the rows of a single shard of a segment CSV. The arrays are
+    usually read-only memory maps of the columnar cache.
+    """
+    ytid: np.ndarray
+    start_seconds: np.ndarray
+    end_seconds: np.ndarray
+    # CSR layout, the labels of row i are label_ids[label_offsets[i]:label_offsets[i + 1]]
+    label_offsets: np.ndarray
+    label_ids: np.ndarray
+    # maps a label ID to its machine label (MID)
+    label_vocab: list[str]
+    row_start: int
+    row_stop: int
+    num_total_rows: int
+
+    def __len__(self) -> int:
+        return self.row_stop - self.row_start
+
+    def take_labels(self, rows: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the label IDs of the given split rows, which have to belong to
+        this shard, in CSR form with offsets starting at 0.
+        """
+        positions: np.ndarray = np.asarray(rows, dtype=np.int64) - self.row_start
+        starts: np.ndarray = np.asarray(self.label_offsets[positions])
+        counts: np.ndarray = np.asarray(self.label_offsets[positions + 1]) - starts
+        offsets: np.ndarray = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # every label's place in label_ids is its row's start plus its place in the row
+        flat: np.ndarray = np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1])
+        return offsets, np.asarray(self.label_ids)[flat]
+
+    def class_indices(self, class_labels_df: pd.DataFrame) -> np.ndarray:
+        """
+        Maps every label ID to its row position in the class labels CSV, -1 for
+        labels that aren't in it. Only the vocabulary is looked up, so indexing
+        the result with label_ids maps the labels of any number of rows.
+        """
+        return pd.Index(class_labels_df["mid"]).get_indexer(self.label_vocab)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        Builds the metadata DataFrame indexed by the rows' position in the whole
+        split. The labels stay in the columns, see `take_labels`, rather than
+        being joined back into strings row by row.
+        """
+        return pd.DataFrame(
+            {
+                "YTID": np.asarray(self.ytid).astype(object),
+                "start_seconds": np.asarray(self.start_seconds),
+                "end_seconds": np.asarray(self.end_seconds),
+            },
+            index=np.arange(self.row_start, self.row_stop),
+        )
+
+
+def label_csr(
+    metadata_df: pd.DataFrame, class_labels_df: pd.DataFrame, columns: Optional[SegmentColumns] = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the labels of the metadata rows in CSR form, as row positions in the
+    class labels CSV (-1 for labels that aren't in it). They are taken from the
+    columns the rows were loaded from if given, and parsed out of their
+    positive_labels otherwise.
+    """
+    if columns is not None:
+        offsets, label_ids = columns.take_labels(metadata_df.index.to_numpy(dtype=np.int64))
+        return offsets, columns.class_indices(class_labels_df)[label_ids]
+
+    offsets, mids = split_labels(metadata_df["positive_labels"])
+    return offsets, pd.Index(class_labels_df["mid"]).get_indexer(mids)
+
+
 class CsvDownloader:
     """
     Class for downloading the CSVs required for the AudioSet dataset
@@ -31,6 +135,7 @@ class CsvDownloader:
     def __init__(self, split_name: str, cache_dir: Path):
 
         self.split_name: str = split_name
+        cache_dir = Path(cache_dir)
         self.segments_file: Path = cache_dir /  Path(f"{self.split_name}.csv")
         self.class_labels_file: str = cache_dir / Path("class_labels_indices.csv")
 
@@ -47,21 +152,58 @@ class CsvDownloader:
 
         self.cache_dir: Path = cache_dir
 
+        # columnar copy of the segment CSV, see write_columnar_cache
+        self.columns_dir: Path = cache_dir / Path(f"{self.split_name}_columns")
+        self.columns_complete_file: Path = self.columns_dir / Path("COMPLETE")
+
     def load_segment_csv_url(self, n_splits : int, split_idx : int, dataset_nrows : int) -> pd.DataFrame:
-        """Downloads the segment URL based off the 'download_type' and foregoes the download if the metadata is present in the cache directory"""
+        """
+        Loads rows of the segment CSV belonging to shard `split_idx` out of
+        `n_splits`. The first time around the CSV is downloaded (or read from the
+        CSV cache) and converted into a columnar cache, after which any shard is a
+        direct row range read out of memory mapped arrays.
+
+        The labels of the rows are not in the returned DataFrame, they are in
+        `self.columns`, which is what the plan and the label counts are built from.
+        """
         print("Loading metadata CSV...")
+        if not self.columns_complete_file.exists():
+            full_metadata: pd.DataFrame = self.read_segment_csv()
+
+            start : float = time.time()
+            self.write_columnar_cache(full_metadata)
+            end : float = time.time()
+            print(f"Wrote columnar cache to {self.columns_dir} in {end-start} seconds")
+
+        start : float = time.time()
+        self.columns: SegmentColumns = self.read_columnar_cache(n_splits, split_idx)
+        self.metadata: pd.DataFrame = self.columns.to_dataframe()
+        end : float = time.time()
+        print(f"Loaded {self.split_name} segment rows {self.columns.row_start}-{self.columns.row_stop} from columnar cache in {end-start} seconds")
+
+        # even though the CSV metadata file might be cached, we check to make sure
+        # the number of segments in the CSV matches the expected number of
+        # segments
+        if self.columns.num_total_rows != dataset_nrows:
+            print(f"Warning: cached {self.split_name} has {self.columns.num_total_rows} segments, expected {dataset_nrows}")
+
+        return self.metadata
+
+    def read_segment_csv(self) -> pd.DataFrame:
+        """Reads the whole segment CSV, downloading and caching it if it isn't cached yet."""
         if not self.segments_file.exists():
             # Load the metadata
             print("Cached csv file not detected.")
             print(f"Downloading from {self.segment_csv_url}")
 
             start : float = time.time()
-            self.metadata: pd.DataFrame = pd.read_csv(
+            metadata: pd.DataFrame = pd.read_csv(
                 self.segment_csv_url,
                 sep=", ",
                 skiprows=3,
                 header=None,
                 names=["YTID", "start_seconds", "end_seconds", "positive_labels"],
+                dtype={"YTID": str},
                 engine="python",
             )
             end : float = time.time()
@@ -71,43 +213,87 @@ class CsvDownloader:
             # Why "|", instead of ","?
             # it's because of there being a quoted comma separated string inside the CSV containing all the labels
             # frustratingly enough, the separator can only be a one-character string
-            self.metadata.to_csv(str(self.segments_file), sep="|")
+            # renamed into place, so another process never reads it half written
+            tmp_file: Path = self.segments_file.with_name(f"{self.segments_file.name}.{os.getpid()}.tmp")
+            metadata.to_csv(str(tmp_file), sep="|")
+            os.replace(tmp_file, self.segments_file)
             print(f"Saved to {self.segments_file}")
 
         else:
+            print(f"Cached csv file detected at {self.segments_file}")
 
             start : float = time.time()
-            # we only need to load the split part of the CSV
-            # means loading only rows from 1 + split_idx * dataset_nrows to 1 + (split_idx + 1) * dataset_nrows
-
-            start_idx : int = 3 + split_idx * int(dataset_nrows / n_splits)
-            self.metadata: pd.DataFrame = pd.read_csv(
+            metadata: pd.DataFrame = pd.read_csv(
                 str(self.segments_file),
                 sep="|",
-                skiprows= start_idx,
-                nrows=int(dataset_nrows / n_splits),
-                header=None,
-                names=["YTID", "start_seconds", "end_seconds", "positive_labels"],
-                engine="python",
+                index_col=0,
+                dtype={"YTID": str},
             )
             end : float = time.time()
             print(f"Loaded {self.split_name} segment CSV from cache in {end-start} seconds")
 
-            print(f"Cached csv file detected at {self.segments_file}")
+        metadata["positive_labels"] = metadata["positive_labels"].str.replace('"', "")
+        return metadata.reset_index(drop=True)
 
-        # even though the CSV metadata file might be cached, we check to make sure
-        # the number of segments in the CSV matches the expected number of
-        # segments
-        # assert (
-        #     self.metadata.shape[0] == self.split_quantities[self.split_name]
-        # ), f"Number of segments in the cached metadata CSV does not match the expected number of segments for the split {self.split_name}"
+    def write_columnar_cache(self, metadata: pd.DataFrame) -> None:
+        """
+        Stores the segment metadata as one .npy array per column. The labels are
+        interned into integer IDs and stored in CSR form: the labels of row i are
+        label_ids[label_offsets[i]:label_offsets[i + 1]].
 
-        self.metadata["positive_labels"] = self.metadata["positive_labels"].apply(
-            lambda x: x.replace('"', "")
-        )
-        self.metadata = self.metadata.reset_index(drop=True)
+        Several processes may build the cache at once, e.g. the shards of a split
+        started together, so every file is written under a name of its own and
+        renamed into place. Each of them then holds the same, complete contents.
+        """
+        self.columns_dir.mkdir(exist_ok=True)
 
-        return self.metadata
+        label_offsets, mids = split_labels(metadata["positive_labels"])
+        label_codes, label_vocab = pd.factorize(mids)
+
+        self.save_array("ytid.npy", metadata["YTID"].to_numpy(dtype=str))
+        self.save_array("start_seconds.npy", metadata["start_seconds"].to_numpy(dtype=np.float64))
+        self.save_array("end_seconds.npy", metadata["end_seconds"].to_numpy(dtype=np.float64))
+        self.save_array("label_offsets.npy", label_offsets)
+        self.save_array("label_ids.npy", label_codes.astype(np.int32))
+        tmp_file: Path = self.columns_dir / Path(f"label_vocab.json.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(list(label_vocab), f)
+        os.replace(tmp_file, self.columns_dir / Path("label_vocab.json"))
+
+        # written last, so a half written cache is never picked up
+        self.columns_complete_file.touch()
+
+    def save_array(self, name: str, array: np.ndarray) -> None:
+        """Writes an array of the columnar cache to a temporary file, then renames it into place."""
+        tmp_file: Path = self.columns_dir / Path(f"{name}.{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_file, self.columns_dir / Path(name))
+
+    def read_columnar_cache(self, n_splits : int, split_idx : int) -> "SegmentColumns":
+        """Memory maps the columnar cache and slices out the rows of a single shard."""
+        ytid: np.ndarray = np.load(self.columns_dir / Path("ytid.npy"), mmap_mode="r")
+        row_start, row_stop = split_bounds(len(ytid), n_splits, split_idx)
+
+        label_offsets: np.ndarray = np.load(self.columns_dir / Path("label_offsets.npy"), mmap_mode="r")
+        label_ids: np.ndarray = np.load(self.columns_dir / Path("label_ids.npy"), mmap_mode="r")
+        with open(self.columns_dir / Path("label_vocab.json"), "r") as f:
+            label_vocab: list[str] = json.load(f)
+
+        # the offsets of a shard are rebased so they index into its own slice of label_ids
+        shard_offsets: np.ndarray = np.asarray(label_offsets[row_start : row_stop + 1])
+
+        return SegmentColumns(
+            ytid=ytid[row_start:row_stop],
+            start_seconds=np.load(self.columns_dir / Path("start_seconds.npy"), mmap_mode="r")[row_start:row_stop],
+            end_seconds=np.load(self.columns_dir / Path("end_seconds.npy"), mmap_mode="r")[row_start:row_stop],
+            label_offsets=shard_offsets - shard_offsets[0],
+            label_ids=label_ids[shard_offsets[0] : shard_offsets[-1]],
+            label_vocab=label_vocab,
+            row_start=row_start,
+            row_stop=row_stop,
+            num_total_rows=len(ytid),
+        )
 
     def load_class_mapping_csv(self) -> pd.DataFrame:
         """
@@ -1,12 +1,21 @@
 from argparse import ArgumentParser, Namespace
 import time
-import yt_dlp
-import subprocess
-from subprocess import CompletedProcess
+from backends import BACKENDS, DownloadBackend, SyntheticBackend, get_backend
+from clip_index import ClipIndex
+from features import FeatureExtractor, FeatureStore, MelSettings
 from csv_setup import CsvDownloader
 import pandas as pd
 from pandas import DataFrame
 from MultiPartDownloader import MultiPartDownloader
+from rate_limit import AdaptiveRateLimiter
+from storage import LINK_HARDLINK, LINK_NONE, link_label_copies, link_modes
+from shards import OUTPUT_CLIPS, OUTPUT_SHARDS, ShardWriter, output_modes, read_shard_index
+from ledger import LeaseLedger
+from ordering import ORDER_CSV, count_labels, order_modes
+from plan import DownloadPlan, build_plan
+from state_store import StateStore
+from progress import STATUS_DOWNLOADED, STATUS_ERRORED
+from typing import Optional
 from pathlib import Path
 import numpy as np
 
@@ -23,41 +32,55 @@ split_names: list[str] = [
 current_download_info_dir: Path = Path("./current_download_info")
 
 
-def get_existing_ytids(split_dir: Path) -> set[str]:
+def get_existing_ytids(split_dir: Path, num_threads: int = 8) -> tuple[set[str], ClipIndex]:
     print(f"Checking how many files are under {split_dir}")
 
-    command: str = f"ls -1r {split_dir} | wc -l"
-    result: CompletedProcess = subprocess.run(
-        command, shell=True, capture_output=True, text=True
-    )
+    # only the label directories that changed since the last run are rescanned
+    clip_index: ClipIndex = ClipIndex(split_dir, num_threads)
+    clip_index.load()
+    num_rescanned: int = clip_index.scan()
+    clip_index.save()
+    print(f"Rescanned {num_rescanned} label directories under {split_dir}")
 
-    output: str = result.stdout
-    # print(f"{output=}")
+    existing_ytids: set[str] = clip_index.ytids()
 
-    if int(output) == 0:
+    if len(existing_ytids) == 0:
         print("No existing wav files found.")
-        return []
-
-    # Execute the command and capture the output
-    # grep command to only fetch the IDs of the file
-    # matches only the ID part of any file with this format: "ID_dd.d-dd.d.wav"
-    command: str = f"ls -1R {split_dir} | grep -o -P '.*(?=_\d+\.\d+[-_]\d+\.\d.wav)'"
-    result: CompletedProcess = subprocess.run(
-        command, shell=True, capture_output=True, text=True
-    )
-    assert isinstance(result, CompletedProcess)
-
-    assert result.returncode == 0, "Was unable to determine the IDs of the files"
-    # print(f"{result=}")
-
-    # Get the output as a string
-    output: str = result.stdout
-
-    # Split the output into lines
-    existing_ytids: list[str] = set(output.strip().split("\n"))
-    # print(f"{existing_ytids=}")
-    print(f"Found {len(existing_ytids)} existing wav files under {split_dir}.")
-    return existing_ytids
+    else:
+        print(f"Found {len(existing_ytids)} existing wav files under {split_dir}.")
+    return existing_ytids, clip_index
+
+
+def relink_label_copies(plan: DownloadPlan, clip_index: ClipIndex, link_mode: str) -> int:
+    """
+    Links the clips on disk into the label directories of their row that lack
+    them. A worker killed after moving a clip into its first label directory but
+    before linking it into the others leaves it in only some of them, and the
+    row counts as downloaded from then on. Returns the number of links made.
+    """
+    # clip file name -> the label directories it was found in
+    found: dict[str, set[str]] = {}
+    for label, entry in clip_index.entries.items():
+        for name in entry["clips"]:
+            found.setdefault(name, set()).add(label)
+
+    num_links: int = 0
+    label_counts: np.ndarray = np.diff(plan.label_offsets)
+    for row_idx in np.flatnonzero(label_counts > 1).tolist():
+        labels: Optional[set[str]] = found.get(str(plan.file_names[row_idx]))
+        if labels is None or len(labels) >= label_counts[row_idx]:
+            continue
+
+        paths: list[Path] = plan.output_paths(row_idx)
+        primary_path: Path = next(path for path in paths if path.parent.name in labels)
+        missing_paths: list[Path] = [path for path in paths if path.parent.name not in labels]
+        for path in missing_paths:
+            path.parent.mkdir(exist_ok=True)
+        link_label_copies(primary_path, missing_paths, link_mode)
+        for path in missing_paths:
+            clip_index.add(path)
+        num_links += len(missing_paths)
+    return num_links
 
 
 def get_excluded_ytids(exclusion_ids_file) -> list[str]:
@@ -65,8 +88,9 @@ def get_excluded_ytids(exclusion_ids_file) -> list[str]:
         print(f"Creating {exclusion_ids_file}")
         exclusion_ids_file.touch()
 
+    # strip the newlines, otherwise no ID would ever match the split's
     with open(str(exclusion_ids_file), "r") as f:
-        excluded_files: list[str] = f.readlines()
+        excluded_files: list[str] = [line.strip() for line in f if line.strip()]
     return excluded_files
 
 def args_checks(args : Namespace):
@@ -74,23 +98,80 @@ def args_checks(args : Namespace):
     assert args.n_splits >= 1, "Number of splits must be at least 1"
     assert args.split_idx >= 0, "Split index must be at least 0"
     assert args.n_jobs >= 1, "Number of jobs must be at least 1"
+    assert args.concurrency >= 1, "Concurrency must be at least 1"
+    assert args.batch_size >= 1, "Batch size must be at least 1"
     assert args.sleep_amount >= 0, "Sleep amount must be at least 0"
+    assert args.sample_rate is None or args.sample_rate > 0, "Sample rate must be positive"
+    assert args.channels is None or args.channels > 0, "Number of channels must be positive"
+    assert args.backend != "synthetic" or args.codec == "wav", "The synthetic backend only writes wav clips"
+    assert args.transcoders >= 0, "Number of transcoders must be at least 0"
+    assert args.spool_size is None or args.spool_size >= 1, "Spool size must be at least 1"
+    assert not args.features or args.codec == "wav", "Features can only be computed from wav clips"
+    assert not args.features or args.output_mode != OUTPUT_SHARDS, "Features are computed from the clip files, which aren't kept in shards output mode"
+    assert args.feature_jobs >= 1, "Number of feature jobs must be at least 1"
+    assert args.n_mels >= 1, "Number of mel bins must be at least 1"
+    assert args.max_retries >= 0, "Max retries must be at least 0"
+    assert args.retry_base >= 0, "Retry base must be at least 0"
+    assert args.max_attempts >= 1, "Max attempts must be at least 1"
+    assert args.ledger is None or args.order == ORDER_CSV, "Rows leased from a ledger are downloaded in CSV order, --order can't be used with it"
+    assert args.order_target is None or args.order_target >= 1, "Order target must be at least 1"
+    assert args.metrics_port is None or 0 < args.metrics_port < 65536, "Metrics port must be a valid port number"
+    assert 0 < args.initial_rate <= args.max_rate, "Initial rate must be positive and at most the max rate"
     assert (
         args.split_idx < args.n_splits
     ), "Split index must be less than the number of splits"
+    assert args.ledger is None or (args.n_splits == 1 and args.split_idx == 0), "The ledger hands out rows of the whole split, --n_splits and --split_idx can't be used with it"
+    assert args.lease_seconds > 0, "Lease length must be positive"
+    assert args.ledger_batch_size >= 1, "Ledger batch size must be at least 1"
 
 if __name__ == "__main__":
 
     argparser: ArgumentParser = ArgumentParser()
 
     argparser.add_argument( "--data_dir", type=str, required=True, help="Directory to store the downloaded CSV metadata files",)
-    argparser.add_argument( "--n_splits", type=int, required=True, help="The number of splits to download")
-    argparser.add_argument( "--split_idx", type=int, required=True, help="The index of the split to download",)
+    argparser.add_argument( "--n_splits", type=int, default=1, help="The number of splits to download")
+    argparser.add_argument( "--split_idx", type=int, default=0, help="The index of the split to download",)
+    argparser.add_argument( "--ledger", type=str, default=None, help="Lease ledger on a shared file system, to download the whole split together with other nodes instead of a fixed split")
+    argparser.add_argument( "--node_id", type=str, default=None, help="Name of this node in the ledger, defaults to <hostname>-<pid>")
+    argparser.add_argument( "--lease_seconds", type=float, default=600, help="How long a node's claim on a ledger batch lasts without being renewed")
+    argparser.add_argument( "--ledger_batch_size", type=int, default=256, help="Number of split rows in each ledger batch")
     argparser.add_argument( "--n_jobs", type=int, default=1, help="Number of jobs to run in parallel")
-    argparser.add_argument( "--sleep_amount", type=int, default=10, help="Amount of time to sleep between downloads",)
+    argparser.add_argument( "--concurrency", type=int, default=1, help="Number of downloads each job keeps in flight at once")
+    argparser.add_argument( "--transcoders", type=int, default=0, help="Number of transcode threads across all jobs, each driving one ffmpeg process. When set, the concurrency threads only fetch the raw audio and hand it over through a bounded spool, 0 fetches and transcodes every row in one go")
+    argparser.add_argument( "--spool_size", type=int, default=None, help="Number of fetched rows each job may hold waiting for a transcoder, defaults to twice the concurrency")
+    argparser.add_argument( "--batch_size", type=int, default=16, help="Number of rows handed to a job at a time")
+    argparser.add_argument( "--sleep_amount", type=int, default=10, help="Base amount of time to back off for after getting bot sniped, doubled on every retry",)
+    argparser.add_argument( "--max_retries", type=int, default=5, help="Number of times a bot sniped download is retried before it is deferred to a later run")
+    argparser.add_argument( "--initial_rate", type=float, default=5.0, help="Downloads per second across all jobs to start at, adapted while running")
+    argparser.add_argument( "--max_rate", type=float, default=100.0, help="Upper bound on the adaptive download rate")
     argparser.add_argument( "--split", type=str, required=True, choices=split_names, help="The split to download, one of 'eval_segments', 'balanced_train_segments', 'unbalanced_train_segments'",)
     argparser.add_argument("--debug", action="store_true")
     argparser.add_argument( "--cache_dir", type=str, default="./cache", help="Directory to store the downloaded CSV metadata files",)
+    argparser.add_argument( "--backend", type=str, default="ytdlp", choices=list(BACKENDS), help="Backend used to fetch the clips, 'synthetic' generates them locally for offline benchmarking")
+    argparser.add_argument( "--synthetic_latency", type=float, default=0.0, help="Seconds each synthetic download takes")
+    argparser.add_argument( "--synthetic_failure_rate", type=float, default=0.0, help="Fraction of videos the synthetic backend reports as unavailable")
+    argparser.add_argument( "--synthetic_bot_block_rate", type=float, default=0.0, help="Fraction of synthetic downloads that get bot sniped")
+    argparser.add_argument( "--synthetic_transient_rate", type=float, default=0.0, help="Fraction of synthetic downloads that fail with a transient server error")
+    argparser.add_argument( "--synthetic_sparse", action="store_true", help="Write synthetic clips as sparse files that take next to no disk space")
+    argparser.add_argument( "--link_mode", type=str, default=LINK_HARDLINK, choices=link_modes, help="How a clip with several labels shows up in its other label directories, it is only written once")
+    argparser.add_argument( "--codec", type=str, default="wav", choices=["wav", "flac"], help="Codec the clips are stored in")
+    argparser.add_argument( "--sample_rate", type=int, default=None, help="Sample rate to decode the clips to in a single ffmpeg pass, e.g. 16000, defaults to the source's")
+    argparser.add_argument( "--channels", type=int, default=None, help="Number of channels to decode the clips to, e.g. 1, defaults to the source's")
+    argparser.add_argument( "--output_mode", type=str, default=OUTPUT_CLIPS, choices=output_modes, help="Write one WAV per clip, pack the clips into tar shards, or both")
+    argparser.add_argument( "--shard_dir", type=str, default=None, help="Directory the packed shards are written to, defaults to <data_dir>/<split>_shards")
+    argparser.add_argument( "--max_shard_mb", type=int, default=1024, help="Size after which a new shard is started")
+    argparser.add_argument( "--scan_threads", type=int, default=8, help="Number of threads used to scan the split directory for existing clips")
+    argparser.add_argument( "--state_db", type=str, default=None, help="SQLite database holding the status of every segment of the split, defaults to current_download_info/<split>_state.db")
+    argparser.add_argument( "--retry_base", type=float, default=600, help="Seconds a row that failed transiently waits before its next attempt, doubled on every failure")
+    argparser.add_argument( "--max_attempts", type=int, default=8, help="Number of transient failures after which a row is given up on")
+    argparser.add_argument( "--order", type=str, default=ORDER_CSV, choices=order_modes, help="Order to download the rows in: the CSV's, rows of rare labels first, or round robin over the labels so a partial run is balanced")
+    argparser.add_argument( "--order_target", type=int, default=None, help="Number of clips per label the balanced order fills up to before downloading the rest")
+    argparser.add_argument( "--metrics_port", type=int, default=None, help="Port to serve live Prometheus metrics on at /metrics, off by default")
+    argparser.add_argument( "--metrics_file", type=str, default=f"{current_download_info_dir}/metrics.json", help="JSON file the live metrics are written to every few seconds")
+    argparser.add_argument( "--features", action="store_true", help="Compute log-mel spectrograms of the clips as they finish, into memory-mapped arrays indexed by split row")
+    argparser.add_argument( "--feature_dir", type=str, default=None, help="Directory of the feature arrays, defaults to <data_dir>/<split>_features")
+    argparser.add_argument( "--feature_jobs", type=int, default=2, help="Number of processes computing features")
+    argparser.add_argument( "--n_mels", type=int, default=64, help="Number of mel bins of the features")
     argparser.add_argument( "--exclusion_ids_file", type=str, default=f"{current_download_info_dir}/unavailable_ids.txt", help="File containing the IDs of the videos that are unavailable",)
 
     args: Namespace = argparser.parse_args()
@@ -125,7 +206,21 @@ if __name__ == "__main__":
     class_mapping_df: DataFrame = csvDownloader.load_class_mapping_csv()
 
     print("Fetching existing IDs...")
-    existing_ytids: list[str] = get_existing_ytids(split_dir)
+    existing_ytids, clip_index = get_existing_ytids(split_dir, args.scan_threads)
+    if args.link_mode != LINK_NONE and existing_ytids:
+        split_plan: DownloadPlan = build_plan(split_df, class_mapping_df, split_dir, args.codec, csvDownloader.columns)
+        num_links: int = relink_label_copies(split_plan, clip_index, args.link_mode)
+        clip_index.save()
+        print(f"Linked {num_links} clips into label directories they were missing from")
+
+    shard_writer: Optional[ShardWriter] = None
+    if args.output_mode != OUTPUT_CLIPS:
+        shard_dir: Path = Path(args.shard_dir) if args.shard_dir is not None else data_dir / Path(f"{args.split}_shards")
+        # clips that only live in the shards count as existing too
+        packed_ytids: set[str] = {entry["ytid"] for entry in read_shard_index(shard_dir)}
+        print(f"Found {len(packed_ytids)} clips packed under {shard_dir}")
+        existing_ytids = existing_ytids | packed_ytids
+        shard_writer = ShardWriter(shard_dir, args.max_shard_mb * 1024 * 1024)
 
     # make the download info dir 
     current_download_info_dir.mkdir(exist_ok=True)
@@ -150,16 +245,91 @@ if __name__ == "__main__":
     
     print("Filtering out for already downloaded YTIds")
 
+    # the state store remembers every segment of the split across runs, the
+    # clips on disk and the exclusions are imported into it on every start
+    state_db: Path = Path(args.state_db) if args.state_db is not None else current_download_info_dir / Path(f"{args.split}_state.db")
+    state_store: StateStore = StateStore(state_db, retry_base=args.retry_base, max_attempts=args.max_attempts)
+    num_new_rows: int = state_store.add_segments(split_df)
+    print(f"Added {num_new_rows} new rows to {state_db}")
+    state_store.mark_ytids(existing_ytids, STATUS_DOWNLOADED)
+    # videos given up on for errors that no longer count as permanent, e.g. a
+    # 403 on an expired stream URL, are tried again and leave the exclusions
+    forgiven_ytids: set[str] = state_store.forgive_unavailable()
+    if forgiven_ytids:
+        excluded_files = [ytid for ytid in excluded_files if ytid not in forgiven_ytids]
+        with open(exclusion_ids_file, "w") as f:
+            f.write("".join(f"{ytid}\n" for ytid in excluded_files))
+        print(f"Trying {len(forgiven_ytids)} videos from the negative cache again")
+    state_store.mark_ytids(excluded_files, STATUS_ERRORED)
+
     # # already_downloaded_from_split : list[str] = chosen_df["YTID"]()
-    filtered_split_df : pd.DataFrame = split_df[~split_df["YTID"].isin(existing_ytids) & ~split_df["YTID"].isin(excluded_files)]
+    # videos in the negative cache and rows whose retry isn't due yet are left out
+    row_start, row_stop = int(split_df.index[0]), int(split_df.index[-1]) + 1
+    pending_rows: np.ndarray = state_store.pending_rows(row_start, row_stop)
+    filtered_split_df : pd.DataFrame = split_df.loc[pending_rows]
+    print(f"Row statuses: {state_store.count_statuses(row_start, row_stop)}")
+    # the clips earlier runs downloaded count towards the labels being balanced
+    done_label_counts: Optional[np.ndarray] = None
+    if args.order != ORDER_CSV:
+        done_rows: np.ndarray = state_store.rows_with_status(STATUS_DOWNLOADED, row_start, row_stop)
+        done_label_counts = count_labels(split_df.loc[done_rows], class_mapping_df, csvDownloader.columns)
+    print(f"Skipping {state_store.num_unavailable()} permanently unavailable videos and {state_store.num_waiting(row_start, row_stop)} rows waiting to be retried")
     # assert len(filtered_split_df) + len(existing_ytids) + len(excluded_files) == len(split_df), "Length of filtered dataframe plus existing files should sum up to original length of split dataframe"
 
     # print(f"Found {len(excluded_files)} file exclusions")
     # print(f"Downloading {len(filtered_split_df)} files")
     # self, num_jobs : int, metadata_df: pd.DataFrame, class_labels_df : pd.DataFrame, download_dir: Path, sleep_amount: int
+    if args.backend == SyntheticBackend.name:
+        backend: DownloadBackend = get_backend(
+            args.backend,
+            latency=args.synthetic_latency,
+            failure_rate=args.synthetic_failure_rate,
+            bot_block_rate=args.synthetic_bot_block_rate,
+            transient_rate=args.synthetic_transient_rate,
+            sparse=args.synthetic_sparse,
+        )
+    else:
+        backend: DownloadBackend = get_backend(args.backend)
+
+    ledger: Optional[LeaseLedger] = None
+    if args.ledger is not None:
+        ledger = LeaseLedger(Path(args.ledger), args.node_id, args.lease_seconds)
+        ledger.initialize(args.split, len(split_df), args.ledger_batch_size)
+        print(f"Leasing rows from {args.ledger} as {ledger.node_id}, {ledger.remaining()} batches left")
+
+    feature_extractor: Optional[FeatureExtractor] = None
+    if args.features:
+        # every shard of the split writes into the same arrays, so they are
+        # sized for the whole split
+        feature_dir: Path = Path(args.feature_dir) if args.feature_dir is not None else data_dir / Path(f"{args.split}_features")
+        feature_store: FeatureStore = FeatureStore(
+            feature_dir, max(CsvDownloader.split_quantities[args.split], row_stop), len(class_mapping_df), MelSettings(n_mels=args.n_mels)
+        )
+        feature_store.set_labels(split_df, class_mapping_df, csvDownloader.columns)
+        feature_extractor = FeatureExtractor(feature_store, args.feature_jobs)
+
+        # clips downloaded by earlier runs get their features too
+        backfill_rows: np.ndarray = feature_store.pending_rows(state_store.rows_with_status(STATUS_DOWNLOADED, row_start, row_stop))
+        backfill_plan: DownloadPlan = build_plan(split_df.loc[backfill_rows], class_mapping_df, split_dir, args.codec, csvDownloader.columns)
+        for i, row in enumerate(backfill_rows):
+            clip_paths: list[Path] = [path for path in backfill_plan.output_paths(i) if path.exists()]
+            if clip_paths:
+                feature_extractor.submit(int(row), clip_paths[0])
+        print(f"Computing features into {feature_dir}, {feature_extractor.num_pending} clips from earlier runs")
+
     multi_part_downloader: MultiPartDownloader = MultiPartDownloader(
         args.n_jobs, filtered_split_df, class_mapping_df, split_dir,
-        args.sleep_amount, current_download_info_dir, len(split_df), list(excluded_files), list(existing_ytids)
+        args.sleep_amount, current_download_info_dir, len(split_df), list(existing_ytids), list(excluded_files),
+        args.batch_size, args.concurrency, clip_index, args.max_retries,
+        AdaptiveRateLimiter(initial_rate=args.initial_rate, max_rate=args.max_rate, initial_inflight=args.n_jobs * args.concurrency),
+        backend, args.link_mode, args.output_mode, shard_writer,
+        args.codec, args.sample_rate, args.channels, ledger, state_store,
+        args.metrics_port, Path(args.metrics_file) if args.metrics_file else None,
+        args.order, done_label_counts, args.order_target,
+        # the transcoders are split over the jobs, each job gets at least one
+        -(-args.transcoders // args.n_jobs), args.spool_size or 2 * args.concurrency,
+        feature_extractor, csvDownloader.columns,
     )
 
     multi_part_downloader.init_multipart_download()
+    state_store.close()
@@ -0,0 +1,92 @@
+from typing import Optional
+import re
+from backends import BOT_CHECK_MESSAGE
+
+"""
+Script to define how download errors are classified. yt-dlp reports everything
+as a `YoutubeDLError` (usually a `DownloadError` wrapping the extractor's
+message), so the class is decided from the message: a video that is private,
+deleted or blocked will never download, a timeout or a 5xx might on a later
+try, and a bot check or a 429 means we are going too fast.
+"""
+
+# the video is gone for good, it goes into the negative cache
+ERROR_PERMANENT: str = "permanent"
+# a network or server hiccup, the row is retried on a schedule
+ERROR_TRANSIENT: str = "transient"
+# YouTube is rate limiting us, the rate limiter backs off
+ERROR_THROTTLED: str = "throttled"
+
+error_classes: list[str] = [ERROR_PERMANENT, ERROR_TRANSIENT, ERROR_THROTTLED]
+
+THROTTLED_RE: re.Pattern = re.compile(
+    "|".join(
+        [
+            re.escape(BOT_CHECK_MESSAGE),
+            r"confirm you.re not a bot",
+            r"HTTP Error 429",
+            r"Too Many Requests",
+            r"rate.limited",
+        ]
+    ),
+    re.IGNORECASE,
+)
+
+PERMANENT_RE: re.Pattern = re.compile(
+    "|".join(
+        [
+            r"Video unavailable",
+            r"Private video",
+            r"This video is private",
+            r"This video has been removed",
+            r"This video is no longer available",
+            r"account associated with this video has been terminated",
+            r"removed for violating",
+            r"copyright (?:claim|grounds)",
+            r"not made this video available in your country",
+            r"not available in your country",
+            r"blocked it in your country",
+            r"members.only",
+            r"Join this channel to get access",
+            r"confirm your age",
+            r"inappropriate for some users",
+            r"Incomplete YouTube ID",
+            r"HTTP Error 404",
+        ]
+    ),
+    re.IGNORECASE,
+)
+
+# errors that usually come from stale info rather than from the video: a 403 on
+# a stream URL that expired or is bound to another IP, or formats that are
+# missing from an old probe. They are transient, and worth one fresh probe
+STALE_INFO_RE: re.Pattern = re.compile(
+    "|".join(
+        [
+            r"HTTP Error 403",
+            r"403 Forbidden",
+            r"Requested format is not available",
+        ]
+    ),
+    re.IGNORECASE,
+)
+
+
+def classify_error(error: Optional[object]) -> str:
+    """
+    Returns the class of a download error, or of its message. Anything that is
+    not recognised is taken to be transient, so an unknown message never ends up
+    in the negative cache.
+    """
+    message: str = str(error)
+    # the bot check wins, YouTube shows it in place of any other message
+    if THROTTLED_RE.search(message) is not None:
+        return ERROR_THROTTLED
+    if PERMANENT_RE.search(message) is not None:
+        return ERROR_PERMANENT
+    return ERROR_TRANSIENT
+
+
+def is_stale_info_error(error: Optional[object]) -> bool:
+    """Tells whether a download error may go away with a fresh probe of the video."""
+    return error is not None and STALE_INFO_RE.search(str(error)) is not None
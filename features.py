@@ -0,0 +1,264 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Optional
+import json
+import wave
+import numpy as np
+import pandas as pd
+from csv_setup import SegmentColumns, label_csr
+
+"""
+Script to define the optional feature stage of a download. As clips finish, a
+pool of processes computes their log-mel spectrograms with NumPy and writes them
+straight into a memory-mapped .npy array indexed by split row, next to an array
+with the multi-hot labels of every row, so the split is ready to train on when
+the download ends instead of every clip being read back from disk first.
+
+Window and hop are given in seconds and the mel filterbank is built for each
+clip's own sample rate, so clips kept at their source's rate still give the
+same frames and mel bins without resampling them.
+"""
+
+# added to the mel energies before taking the log, and the value of the frames
+# past the end of a clip that is shorter than the segment
+LOG_OFFSET: float = 1e-6
+
+
+@dataclass
+class MelSettings:
+    """
+    Parameters of the log-mel spectrograms, stored next to the arrays so they
+    can't be appended to with different ones.
+    """
+    n_mels: int = 64
+    window_seconds: float = 0.025
+    hop_seconds: float = 0.010
+    fmin: float = 0.0
+    # None goes up to half the clip's sample rate
+    fmax: Optional[float] = 8000.0
+    clip_seconds: float = 10.0
+
+    @property
+    def num_frames(self) -> int:
+        return int(round(self.clip_seconds / self.hop_seconds))
+
+
+def hz_to_mel(hz: np.ndarray) -> np.ndarray:
+    return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+
+def mel_to_hz(mel: np.ndarray) -> np.ndarray:
+    return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
+
+
+# (sample rate, FFT size, settings) -> filterbank, every pool process builds
+# the few it needs once
+_filterbanks: dict[tuple, np.ndarray] = {}
+
+
+def mel_filterbank(sample_rate: int, n_fft: int, settings: MelSettings) -> np.ndarray:
+    """Returns the (n_mels, n_fft // 2 + 1) matrix of triangular HTK mel filters."""
+    key: tuple = (sample_rate, n_fft, settings.n_mels, settings.fmin, settings.fmax)
+    if key in _filterbanks:
+        return _filterbanks[key]
+
+    fmax: float = min(settings.fmax or sample_rate / 2, sample_rate / 2)
+    fft_freqs: np.ndarray = np.linspace(0.0, sample_rate / 2, n_fft // 2 + 1)
+    mel_edges: np.ndarray = mel_to_hz(
+        np.linspace(hz_to_mel(np.float64(settings.fmin)), hz_to_mel(np.float64(fmax)), settings.n_mels + 2)
+    )
+
+    lower: np.ndarray = mel_edges[:-2, None]
+    center: np.ndarray = mel_edges[1:-1, None]
+    upper: np.ndarray = mel_edges[2:, None]
+    rising: np.ndarray = (fft_freqs[None, :] - lower) / (center - lower)
+    falling: np.ndarray = (upper - fft_freqs[None, :]) / (upper - center)
+    filterbank: np.ndarray = np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32)
+
+    _filterbanks[key] = filterbank
+    return filterbank
+
+
+def read_wav(path: Path) -> tuple[np.ndarray, int]:
+    """Reads a 16-bit PCM WAV clip as mono float32 samples in [-1, 1], and its sample rate."""
+    with wave.open(str(path), "rb") as f:
+        if f.getsampwidth() != 2:
+            raise ValueError(f"{path} is not 16-bit PCM")
+        sample_rate: int = f.getframerate()
+        channels: int = f.getnchannels()
+        data: bytes = f.readframes(f.getnframes())
+
+    audio: np.ndarray = np.frombuffer(data, dtype="<i2").astype(np.float32)
+    audio *= 1.0 / 32768.0
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1)
+    return audio, sample_rate
+
+
+def log_mel(audio: np.ndarray, sample_rate: int, settings: MelSettings) -> np.ndarray:
+    """
+    Returns the (num_frames, n_mels) log-mel spectrogram of a clip, cut or
+    padded to the number of frames of a full segment.
+    """
+    win_length: int = int(round(settings.window_seconds * sample_rate))
+    hop_length: int = int(round(settings.hop_seconds * sample_rate))
+    n_fft: int = 1 << (win_length - 1).bit_length()
+
+    if len(audio) < win_length:
+        audio = np.pad(audio, (0, win_length - len(audio)))
+    # every frame at once, as a strided view of the samples
+    frames: np.ndarray = np.lib.stride_tricks.sliding_window_view(audio, win_length)[::hop_length]
+    frames = frames[: settings.num_frames] * np.hanning(win_length).astype(np.float32)
+    power: np.ndarray = np.abs(np.fft.rfft(frames, n=n_fft)) ** 2
+
+    mel: np.ndarray = power.astype(np.float32) @ mel_filterbank(sample_rate, n_fft, settings).T
+    features: np.ndarray = np.full((settings.num_frames, settings.n_mels), np.log(LOG_OFFSET), dtype=np.float32)
+    features[: len(mel)] = np.log(mel + LOG_OFFSET)
+    return features
+
+
+class FeatureStore:
+    """
+    The arrays of a split's features in `feature_dir`, as .npy files memory
+    mapped by every process that writes to them:
+    - log_mel.npy, (num_rows, num_frames, n_mels) log-mel spectrograms
+    - labels.npy, (num_rows, num_labels) multi-hot labels
+    - done.npy, (num_rows,) set once a row's spectrogram was written
+    Rows are split rows, so the shards of a split all write into the same arrays.
+    Only the parent process writes the labels and done flags.
+    """
+
+    features_name: str = "log_mel.npy"
+    labels_name: str = "labels.npy"
+    done_name: str = "done.npy"
+    settings_name: str = "mel_settings.json"
+
+    def __init__(
+        self,
+        feature_dir: Path,
+        num_rows: int,
+        num_labels: int,
+        settings: MelSettings,
+        dtype: str = "float16",
+    ):
+        self.feature_dir: Path = Path(feature_dir)
+        self.feature_dir.mkdir(parents=True, exist_ok=True)
+        self.settings: MelSettings = settings
+
+        settings_file: Path = self.feature_dir / Path(self.settings_name)
+        if settings_file.exists():
+            with open(settings_file, "r") as f:
+                stored: dict = json.load(f)
+            assert stored == asdict(settings), f"{self.feature_dir} holds features computed with {stored}"
+        else:
+            with open(settings_file, "w") as f:
+                json.dump(asdict(settings), f, indent=4)
+
+        self.features_file: Path = self.feature_dir / Path(self.features_name)
+        self.features: np.memmap = self.open_array(self.features_file, (num_rows, settings.num_frames, settings.n_mels), dtype)
+        self.labels: np.memmap = self.open_array(self.feature_dir / Path(self.labels_name), (num_rows, num_labels), "uint8")
+        self.done: np.memmap = self.open_array(self.feature_dir / Path(self.done_name), (num_rows,), "uint8")
+
+    @staticmethod
+    def open_array(path: Path, shape: tuple[int, ...], dtype: str) -> np.memmap:
+        """Maps an existing array, or preallocates it (sparsely) filled with zeros."""
+        if path.exists():
+            array: np.memmap = np.load(path, mmap_mode="r+")
+            assert array.shape[1:] == shape[1:] and array.shape[0] >= shape[0], f"{path} has shape {array.shape}, expected {shape}"
+            return array
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def set_labels(
+        self, metadata_df: pd.DataFrame, class_labels_df: pd.DataFrame, columns: Optional[SegmentColumns] = None
+    ) -> None:
+        """
+        Writes the multi-hot labels of the metadata rows, indexed by split row,
+        taking them from the columns the rows were loaded from if given.
+        """
+        label_offsets, label_ids = label_csr(metadata_df, class_labels_df, columns)
+        rows: np.ndarray = np.repeat(metadata_df.index.to_numpy(dtype=np.int64), np.diff(label_offsets))
+        self.labels[rows[label_ids >= 0], label_ids[label_ids >= 0]] = 1
+        self.labels.flush()
+
+    def pending_rows(self, rows: np.ndarray) -> np.ndarray:
+        """Returns the given split rows that have no features yet."""
+        return rows[self.done[rows] == 0]
+
+    def mark_done(self, rows: list[int]) -> None:
+        self.done[rows] = 1
+
+    def flush(self) -> None:
+        self.features.flush()
+        self.done.flush()
+
+
+# the features array as mapped by a pool process
+_worker_features: Optional[np.memmap] = None
+_worker_settings: Optional[MelSettings] = None
+
+
+def init_feature_worker(features_file: Path, settings: MelSettings) -> None:
+    global _worker_features, _worker_settings
+    _worker_features = np.load(features_file, mmap_mode="r+")
+    _worker_settings = settings
+
+
+def compute_features(split_row: int, clip_path: str) -> int:
+    """Computes the features of a clip into its row of the features array, in a pool process."""
+    audio, sample_rate = read_wav(Path(clip_path))
+    _worker_features[split_row] = log_mel(audio, sample_rate, _worker_settings)
+    return split_row
+
+
+class FeatureExtractor:
+    """
+    Runs the feature stage of a download: clips are submitted from the parent
+    process as they finish, and their rows are marked done as the pool gets
+    through them. Rows whose clip can't be read are left without features.
+    """
+
+    def __init__(self, store: FeatureStore, num_workers: int):
+        self.store: FeatureStore = store
+        self.executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=init_feature_worker,
+            initargs=(store.features_file, store.settings),
+        )
+        self.futures: list[Future] = []
+        self.num_done: int = 0
+        self.num_failed: int = 0
+
+    def submit(self, split_row: int, clip_path: Path) -> None:
+        self.futures.append(self.executor.submit(compute_features, int(split_row), str(clip_path)))
+
+    @property
+    def num_pending(self) -> int:
+        return len(self.futures)
+
+    def poll(self, wait: bool = False) -> int:
+        """Marks the rows whose features are written as done. Returns how many there were."""
+        finished: list[Future] = [future for future in self.futures if wait or future.done()]
+        if not finished:
+            return 0
+        finished_ids: set[int] = {id(future) for future in finished}
+        self.futures = [future for future in self.futures if id(future) not in finished_ids]
+
+        done_rows: list[int] = []
+        for future in finished:
+            try:
+                done_rows.append(future.result())
+            except Exception as e:
+                self.num_failed += 1
+                print(f"Failed to compute features: {e}")
+
+        self.store.mark_done(done_rows)
+        self.num_done += len(done_rows)
+        return len(done_rows)
+
+    def close(self) -> None:
+        """Waits for the submitted clips and flushes the arrays."""
+        self.poll(wait=True)
+        self.executor.shutdown()
+        self.store.flush()
+        print(f"Computed features of {self.num_done} clips, {self.num_failed} failed")
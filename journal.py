@@ -0,0 +1,154 @@
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterator, Optional
+import json
+import os
+import sys
+import time
+from progress import ProgressAggregator, ProgressEvent, STATUS_DEFERRED, STATUS_DOWNLOADED
+
+"""
+Script to define the append-only status journal of a download. Every progress
+event is appended once as a JSON line, and a small compacted snapshot is
+rewritten every so often, so the status I/O grows with the event rate rather
+than with the size of the dataset.
+"""
+
+
+class StatusJournal:
+    """
+    Appends progress events to `download_status.jsonl` and keeps the plain text
+    ID lists up to date by appending to them, instead of rewriting them.
+    """
+
+    journal_name: str = "download_status.jsonl"
+    snapshot_name: str = "download_status.json"
+    downloaded_ids_name: str = "split_current_ytids.txt"
+    unavailable_ids_name: str = "unavailable_ids.txt"
+    deferred_ids_name: str = "deferred_ids.txt"
+
+    def __init__(self, info_dir: Path, snapshot_interval: float = 60.0):
+        self.info_dir: Path = Path(info_dir)
+        self.snapshot_interval: float = snapshot_interval
+        self.last_snapshot: float = 0.0
+
+        self.journal_file: Path = self.info_dir / Path(self.journal_name)
+        self.snapshot_file: Path = self.info_dir / Path(self.snapshot_name)
+
+        self.journal = self._open_append(self.journal_file)
+        self.downloaded_ids = self._open_append(self.info_dir / Path(self.downloaded_ids_name))
+        self.unavailable_ids = self._open_append(self.info_dir / Path(self.unavailable_ids_name))
+        self.deferred_ids = self._open_append(self.info_dir / Path(self.deferred_ids_name))
+
+    @staticmethod
+    def _open_append(path: Path):
+        """Opens a file for appending, making sure new lines start on a fresh line."""
+        needs_newline: bool = False
+        if path.exists() and path.stat().st_size > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+
+        f = open(path, "a")
+        if needs_newline:
+            f.write("\n")
+        return f
+
+    def append(self, events: list[ProgressEvent]) -> None:
+        """Appends a batch of events to the journal and the ID lists."""
+        if not events:
+            return
+
+        for event in events:
+            self.journal.write(json.dumps(asdict(event)) + "\n")
+            if event.status == STATUS_DOWNLOADED:
+                self.downloaded_ids.write(event.ytid + "\n")
+            elif event.status == STATUS_DEFERRED:
+                # deferred rows are not excluded, so the next run picks them up again
+                self.deferred_ids.write(event.ytid + "\n")
+            else:
+                self.unavailable_ids.write(event.ytid + "\n")
+
+        self.journal.flush()
+        self.downloaded_ids.flush()
+        self.unavailable_ids.flush()
+        self.deferred_ids.flush()
+
+    def maybe_snapshot(
+        self,
+        aggregator: ProgressAggregator,
+        num_existing: int,
+        num_excluded: int,
+        force: bool = False,
+    ) -> bool:
+        """Writes a compacted snapshot if `snapshot_interval` seconds have passed."""
+        now: float = time.time()
+        if not force and now - self.last_snapshot < self.snapshot_interval:
+            return False
+
+        # the snapshot records how far into the journal it is valid, so it has
+        # to be on disk before we point at it
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+        snapshot: dict = {
+            "Jobs": {
+                job_id: {
+                    "NumDownloaded": job.num_downloaded,
+                    "NumErrored": job.num_errored,
+                    "NumDeferred": job.num_deferred,
+                    "Total": job.total,
+                    "UpdateTimestamp": job.update_timestamp,
+                }
+                for job_id, job in aggregator.jobs.items()
+            },
+            "TotalNumDownloaded": len(aggregator.downloaded_ids) + num_existing,
+            "TotalNumErrored": len(aggregator.errored_ids) + num_excluded,
+            "TotalNumDeferred": len(aggregator.deferred_ids),
+            "NumStartExistingFiles": num_existing,
+            "NumStartExcludedFiles": num_excluded,
+            "JournalFile": self.journal_name,
+            "JournalOffset": self.journal.tell(),
+            "SnapshotTimestamp": now,
+            "command": str(sys.executable) + " " + " ".join(sys.argv),
+        }
+
+        tmp_file: Path = self.snapshot_file.with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(snapshot, f, indent=4)
+        os.replace(tmp_file, self.snapshot_file)
+
+        self.last_snapshot = now
+        return True
+
+    def close(self) -> None:
+        self.journal.close()
+        self.downloaded_ids.close()
+        self.unavailable_ids.close()
+        self.deferred_ids.close()
+
+
+def replay_journal(journal_file: Path, offset: int = 0) -> Iterator[ProgressEvent]:
+    """
+    Yields the events stored in a journal, starting at byte `offset`. Lines cut
+    short by a crash are skipped instead of raising.
+    """
+    with open(journal_file, "r") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                yield ProgressEvent(**json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+
+def load_status(info_dir: Path, job_ids: Optional[list[int]] = None) -> ProgressAggregator:
+    """Rebuilds the running state of a download by replaying its journal."""
+    aggregator: ProgressAggregator = ProgressAggregator(job_ids or [])
+    journal_file: Path = Path(info_dir) / Path(StatusJournal.journal_name)
+
+    if journal_file.exists():
+        for event in replay_journal(journal_file):
+            aggregator.apply(event)
+
+    return aggregator
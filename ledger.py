@@ -0,0 +1,254 @@
+from pathlib import Path
+from typing import Optional
+import os
+import socket
+import sqlite3
+import time
+import numpy as np
+from progress import STATUS_DEFERRED, STATUS_DOWNLOADED
+from scheduler import WorkScheduler
+from state_store import StateStore
+
+"""
+Script to define the lease ledger that lets several nodes download one split
+together. The ledger is a SQLite database on a shared file system holding the
+split's rows in fixed batches. Nodes claim batches with expiring leases, renew
+them while they work, and mark them done, so the batches of a node that died
+or stalled are picked up by the others once their leases run out. Batches
+with rows waiting to be retried are put back instead, to be leased again
+once those rows are due.
+"""
+
+
+class LeaseLedger:
+    """
+    Connection to a lease ledger. SQLite's file locking is what serializes the
+    nodes, so the default rollback journal is used rather than WAL, which does
+    not work over network file systems.
+    """
+
+    def __init__(self, ledger_file: Path, node_id: Optional[str] = None, lease_seconds: float = 600.0):
+        self.ledger_file: Path = Path(ledger_file)
+        self.node_id: str = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_seconds: float = lease_seconds
+
+        self.conn: sqlite3.Connection = sqlite3.connect(
+            str(self.ledger_file), timeout=60, isolation_level=None
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS batches (
+                batch_id INTEGER PRIMARY KEY,
+                row_start INTEGER NOT NULL,
+                row_stop INTEGER NOT NULL,
+                owner TEXT,
+                lease_expires REAL NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0,
+                num_downloaded INTEGER NOT NULL DEFAULT 0,
+                num_errored INTEGER NOT NULL DEFAULT 0,
+                finished_by TEXT
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS batches_pending ON batches (done, lease_expires)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def initialize(self, split_name: str, num_rows: int, batch_size: int) -> None:
+        """Creates the batches of the split, unless another node already did."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            meta: dict[str, str] = dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+            if meta:
+                assert meta["split"] == split_name and int(meta["num_rows"]) == num_rows, (
+                    f"Ledger {self.ledger_file} was made for {meta['split']} with {meta['num_rows']} rows"
+                )
+            else:
+                self.conn.executemany(
+                    "INSERT INTO meta (key, value) VALUES (?, ?)",
+                    [("split", split_name), ("num_rows", str(num_rows)), ("batch_size", str(batch_size))],
+                )
+                self.conn.executemany(
+                    "INSERT INTO batches (row_start, row_stop) VALUES (?, ?)",
+                    [(start, min(start + batch_size, num_rows)) for start in range(0, num_rows, batch_size)],
+                )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def claim(self, max_batches: int) -> list[tuple[int, int, int]]:
+        """
+        Leases up to `max_batches` batches that are neither done nor leased by a
+        live node. Returns their (batch_id, row_start, row_stop).
+        """
+        now: float = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            batches: list[tuple[int, int, int]] = self.conn.execute(
+                """SELECT batch_id, row_start, row_stop FROM batches
+                WHERE done = 0 AND lease_expires < ?
+                ORDER BY batch_id LIMIT ?""",
+                (now, max_batches),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE batches SET owner = ?, lease_expires = ? WHERE batch_id = ?",
+                [(self.node_id, now + self.lease_seconds, batch[0]) for batch in batches],
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return batches
+
+    def renew(self, batch_ids: list[int]) -> None:
+        """Extends the leases this node holds on the given batches."""
+        expires: float = time.time() + self.lease_seconds
+        self.conn.executemany(
+            "UPDATE batches SET lease_expires = ? WHERE batch_id = ? AND owner = ? AND done = 0",
+            [(expires, batch_id, self.node_id) for batch_id in batch_ids],
+        )
+
+    def release(self, batch_id: int, not_before: float) -> None:
+        """Gives back a batch this node holds, so that nobody leases it before `not_before`."""
+        self.conn.execute(
+            "UPDATE batches SET owner = NULL, lease_expires = ? WHERE batch_id = ? AND owner = ? AND done = 0",
+            (not_before, batch_id, self.node_id),
+        )
+
+    def complete(self, batch_id: int, num_downloaded: int, num_errored: int) -> None:
+        """Marks a batch as done. Whoever finishes a batch first records its counts."""
+        self.conn.execute(
+            """UPDATE batches SET done = 1, num_downloaded = ?, num_errored = ?, finished_by = ?
+            WHERE batch_id = ? AND done = 0""",
+            (num_downloaded, num_errored, self.node_id, batch_id),
+        )
+
+    def remaining(self) -> int:
+        """Returns the number of batches that are not done yet, leased or not."""
+        return self.conn.execute("SELECT COUNT(*) FROM batches WHERE done = 0").fetchone()[0]
+
+    def num_open(self) -> int:
+        """
+        Returns the number of batches that are not done and are either leased or
+        free to lease now, leaving out the ones put back to wait for retries.
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM batches WHERE done = 0 AND (owner IS NOT NULL OR lease_expires < ?)",
+            (time.time(),),
+        ).fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class LedgerFeeder:
+    """
+    Keeps a node's local WorkScheduler supplied with rows leased from the ledger.
+    Ledger batches are ranges of rows of the whole split, while the scheduler
+    works on positions into the node's filtered rows, so `split_rows` gives the
+    split row of every position (sorted, as filtering keeps the order).
+
+    A batch is only marked done once none of its rows still needs downloading,
+    which the state store knows for the rows outside the plan too. Otherwise
+    it is put back with the time its first row is due for a retry.
+    """
+
+    def __init__(
+        self,
+        ledger: LeaseLedger,
+        scheduler: WorkScheduler,
+        split_rows: np.ndarray,
+        target_pending: int,
+        state_store: Optional[StateStore] = None,
+    ):
+        self.ledger: LeaseLedger = ledger
+        self.scheduler: WorkScheduler = scheduler
+        self.split_rows: np.ndarray = split_rows
+        self.target_pending: int = target_pending
+        self.state_store: Optional[StateStore] = state_store
+
+        # ledger batch ID -> positions not finished yet, and the reverse mapping
+        self.held: dict[int, set[int]] = {}
+        self.position_batches: dict[int, int] = {}
+        self.ranges: dict[int, tuple[int, int]] = {}
+        # counts are kept over every lease of a batch, and the positions
+        # finished here are not handed out again when a batch is leased again
+        self.counts: dict[int, list[int]] = {}
+        self.deferred: set[int] = set()
+        self.finished: set[int] = set()
+        self.last_renewal: float = time.time()
+
+        # nothing is handed out until the ledger has nothing left to give
+        self.scheduler.exhausted = False
+
+    def complete(self, row_idx: int, status: str) -> None:
+        """
+        Records a position the workers are done with, finishing its ledger batch
+        if it was the last. Must be called after the state store recorded it.
+        """
+        batch_id: Optional[int] = self.position_batches.pop(row_idx, None)
+        if batch_id is None:
+            return
+
+        if status == STATUS_DEFERRED:
+            self.deferred.add(batch_id)
+        else:
+            self.counts[batch_id][0 if status == STATUS_DOWNLOADED else 1] += 1
+            self.finished.add(row_idx)
+        self.held[batch_id].discard(row_idx)
+        if not self.held[batch_id]:
+            self._finish(batch_id)
+
+    def _retry_at(self, batch_id: int) -> Optional[float]:
+        """Returns when the first row of a batch that still needs downloading is due, if any."""
+        if self.state_store is not None:
+            return self.state_store.next_attempt_at(*self.ranges[batch_id])
+        return time.time() if batch_id in self.deferred else None
+
+    def _finish(self, batch_id: int) -> None:
+        del self.held[batch_id]
+        retry_at: Optional[float] = self._retry_at(batch_id)
+        del self.ranges[batch_id]
+        self.deferred.discard(batch_id)
+        if retry_at is None:
+            num_downloaded, num_errored = self.counts.pop(batch_id)
+            self.ledger.complete(batch_id, num_downloaded, num_errored)
+        else:
+            # at least a lease later, so that rows this node can't hand out
+            # (those that were not due when the plan was made) don't make it
+            # claim the batch back straight away
+            self.ledger.release(batch_id, max(retry_at, time.time() + self.ledger.lease_seconds))
+
+    def tick(self) -> None:
+        """Renews the held leases and claims more batches when the local queue runs low."""
+        now: float = time.time()
+        if self.held and now - self.last_renewal > self.ledger.lease_seconds / 3:
+            self.ledger.renew(list(self.held))
+            self.last_renewal = now
+
+        num_pending: int = sum(len(batch.rows) for batch in self.scheduler.pending)
+        if num_pending < self.target_pending:
+            for batch_id, row_start, row_stop in self.ledger.claim(max_batches=4):
+                # rows that were already downloaded never made it into the plan,
+                # and those finished here before the batch was put back are skipped
+                lo, hi = np.searchsorted(self.split_rows, [row_start, row_stop])
+                positions: list[int] = [
+                    row_idx for row_idx in range(int(lo), int(hi)) if row_idx not in self.finished
+                ]
+
+                self.held[batch_id] = set(positions)
+                self.ranges[batch_id] = (row_start, row_stop)
+                self.counts.setdefault(batch_id, [0, 0])
+                for row_idx in positions:
+                    self.position_batches[row_idx] = batch_id
+                if positions:
+                    self.scheduler.submit(positions)
+                else:
+                    self._finish(batch_id)
+
+        # other nodes may still hold leases that run out, so only stop once
+        # every batch in the ledger is done or waiting for retries, which are
+        # left to a later run like they are without a ledger
+        if not self.held and not self.scheduler.exhausted and self.ledger.num_open() == 0:
+            self.scheduler.exhausted = True
+            num_waiting: int = self.ledger.remaining()
+            if num_waiting > 0:
+                print(f"Leaving {num_waiting} ledger batches with rows waiting to be retried")
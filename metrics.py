@@ -0,0 +1,253 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator
+import json
+import os
+import threading
+import time
+from progress import ProgressEvent, STATUS_DOWNLOADED
+
+"""
+Script to define the live metrics of a download. Workers time the stages of
+every row (waiting on the rate limiter, probing the video, fetching the audio,
+ffmpeg postprocessing, writing the clip) and send the timings along with their
+progress events. The parent folds them into counters, served in the Prometheus
+text format over HTTP and written to a JSON file every few seconds, which is
+enough to tell whether a node is bound by the network, by ffmpeg or by
+YouTube throttling it.
+"""
+
+STAGE_WAIT: str = "wait"
+STAGE_PROBE: str = "probe"
+STAGE_FETCH: str = "fetch"
+STAGE_POSTPROCESS: str = "postprocess"
+STAGE_WRITE: str = "write"
+
+stages: list[str] = [STAGE_WAIT, STAGE_PROBE, STAGE_FETCH, STAGE_POSTPROCESS, STAGE_WRITE]
+
+METRIC_PREFIX: str = "audioset_download"
+
+
+# each download thread times the row it is working on
+_stage_times: threading.local = threading.local()
+
+
+def record_stage(stage: str, seconds: float) -> None:
+    """Adds time spent in a stage to the calling thread's current row."""
+    if not hasattr(_stage_times, "times"):
+        _stage_times.times = {}
+    _stage_times.times[stage] = _stage_times.times.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed_stage(stage: str) -> Iterator[None]:
+    """Times the body of a with statement as part of a stage of the current row."""
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def take_stage_times() -> dict[str, float]:
+    """Returns the stage timings of the calling thread's row and starts a new one."""
+    times: dict[str, float] = getattr(_stage_times, "times", {})
+    _stage_times.times = {}
+    return times
+
+
+class DownloadMetrics:
+    """
+    Counters and gauges of a running download, only updated by the parent
+    process. A lock guards them since the HTTP server reads them from its own
+    threads.
+    """
+
+    def __init__(self, window: float = 30.0):
+        self.lock: threading.Lock = threading.Lock()
+        self.start_time: float = time.time()
+        self.window: float = window
+
+        self.rows: dict[str, int] = {}
+        self.error_classes: dict[str, int] = {}
+        self.num_bytes: int = 0
+        self.num_attempts: int = 0
+        self.num_throttled: int = 0
+        self.stage_seconds: dict[str, float] = {stage: 0.0 for stage in stages}
+        self.stage_counts: dict[str, int] = {stage: 0 for stage in stages}
+        # job ID -> [rows, bytes]
+        self.workers: dict[int, list[int]] = {}
+        self.gauges: dict[str, float] = {}
+
+        # (timestamp, rows, bytes, attempts, throttled) of the recent events,
+        # for the rates over the last `window` seconds
+        self.recent: list[tuple[float, int, int, int, int]] = []
+
+        self.last_write: float = 0.0
+
+    def record(self, events: list[ProgressEvent]) -> None:
+        """Folds a batch of progress events into the counters."""
+        if not events:
+            return
+
+        now: float = time.time()
+        with self.lock:
+            for event in events:
+                self.rows[event.status] = self.rows.get(event.status, 0) + 1
+                if event.error_class is not None:
+                    self.error_classes[event.error_class] = self.error_classes.get(event.error_class, 0) + 1
+                self.num_bytes += event.num_bytes
+                self.num_attempts += event.num_attempts
+                self.num_throttled += event.num_throttled
+                for stage, seconds in event.stage_times.items():
+                    self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+                    self.stage_counts[stage] = self.stage_counts.get(stage, 0) + 1
+
+                worker: list[int] = self.workers.setdefault(event.job_id, [0, 0])
+                worker[0] += 1
+                worker[1] += event.num_bytes
+
+                self.recent.append(
+                    (now, int(event.status == STATUS_DOWNLOADED), event.num_bytes, event.num_attempts, event.num_throttled)
+                )
+
+            self.recent = [entry for entry in self.recent if now - entry[0] <= self.window]
+
+    def set_gauges(self, **gauges: float) -> None:
+        with self.lock:
+            self.gauges.update(gauges)
+
+    def snapshot(self) -> dict:
+        """Returns the counters, plus the rates over the last window, as a JSON-able dict."""
+        now: float = time.time()
+        with self.lock:
+            elapsed: float = max(now - self.start_time, 1e-9)
+            recent: list[tuple[float, int, int, int, int]] = [
+                entry for entry in self.recent if now - entry[0] <= self.window
+            ]
+            span: float = min(self.window, elapsed)
+            recent_attempts: int = sum(entry[3] for entry in recent)
+            total_stage_seconds: float = sum(self.stage_seconds.values())
+
+            return {
+                "timestamp": now,
+                "elapsed": elapsed,
+                "rows": dict(self.rows),
+                "error_classes": dict(self.error_classes),
+                "bytes": self.num_bytes,
+                "attempts": self.num_attempts,
+                "throttled": self.num_throttled,
+                "bot_block_rate": self.num_throttled / self.num_attempts if self.num_attempts else 0.0,
+                "downloads_per_second": sum(entry[1] for entry in recent) / span,
+                "bytes_per_second": sum(entry[2] for entry in recent) / span,
+                "recent_bot_block_rate": sum(entry[4] for entry in recent) / recent_attempts if recent_attempts else 0.0,
+                "stage_seconds": dict(self.stage_seconds),
+                "stage_mean_seconds": {
+                    stage: self.stage_seconds[stage] / self.stage_counts[stage] if self.stage_counts.get(stage) else 0.0
+                    for stage in self.stage_seconds
+                },
+                # where the download threads spend their time, the largest share
+                # is what limits the node
+                "stage_share": {
+                    stage: seconds / total_stage_seconds if total_stage_seconds else 0.0
+                    for stage, seconds in self.stage_seconds.items()
+                },
+                "workers": {
+                    str(job_id): {"rows": rows, "bytes": num_bytes, "rows_per_second": rows / elapsed, "bytes_per_second": num_bytes / elapsed}
+                    for job_id, (rows, num_bytes) in sorted(self.workers.items())
+                },
+                "gauges": dict(self.gauges),
+            }
+
+    def render_prometheus(self) -> str:
+        """Renders the counters and gauges in the Prometheus text exposition format."""
+        with self.lock:
+            lines: list[str] = []
+
+            def metric(name: str, kind: str, help_text: str, samples: list[tuple[str, float]]) -> None:
+                lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{METRIC_PREFIX}_{name}{labels} {value}")
+
+            metric("rows_total", "counter", "Rows finished, by status.", [
+                (f'{{status="{status}"}}', count) for status, count in sorted(self.rows.items())
+            ])
+            metric("errors_total", "counter", "Rows that failed, by error class.", [
+                (f'{{error_class="{error_class}"}}', count) for error_class, count in sorted(self.error_classes.items())
+            ])
+            metric("bytes_total", "counter", "Bytes of clips written.", [("", self.num_bytes)])
+            metric("attempts_total", "counter", "Download attempts, retries included.", [("", self.num_attempts)])
+            metric("throttled_total", "counter", "Attempts that were bot checked or rate limited.", [("", self.num_throttled)])
+            metric("stage_seconds", "summary", "Time spent in each stage of a row.", [
+                sample
+                for stage in self.stage_seconds
+                for sample in [
+                    (f'_sum{{stage="{stage}"}}', self.stage_seconds[stage]),
+                    (f'_count{{stage="{stage}"}}', self.stage_counts.get(stage, 0)),
+                ]
+            ])
+            metric("worker_rows_total", "counter", "Rows finished by each worker.", [
+                (f'{{job="{job_id}"}}', rows) for job_id, (rows, _) in sorted(self.workers.items())
+            ])
+            metric("worker_bytes_total", "counter", "Bytes written by each worker.", [
+                (f'{{job="{job_id}"}}', num_bytes) for job_id, (_, num_bytes) in sorted(self.workers.items())
+            ])
+            for name, value in sorted(self.gauges.items()):
+                metric(name, "gauge", name.replace("_", " ").capitalize() + ".", [("", value)])
+
+        return "\n".join(lines) + "\n"
+
+    def maybe_write(self, metrics_file: Path, interval: float = 10.0, force: bool = False) -> bool:
+        """Atomically rewrites the metrics file if `interval` seconds have passed since the last write."""
+        now: float = time.time()
+        if not force and now - self.last_write < interval:
+            return False
+
+        tmp_file: Path = Path(metrics_file).with_suffix(".json.tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+        os.replace(tmp_file, metrics_file)
+        self.last_write = now
+        return True
+
+
+class MetricsServer:
+    """
+    Serves a DownloadMetrics at /metrics in the Prometheus text format, and as
+    JSON at /metrics.json, from a daemon thread of the parent process.
+    """
+
+    def __init__(self, metrics: DownloadMetrics, port: int, host: str = "127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path == "/metrics":
+                    body: bytes = metrics.render_prometheus().encode()
+                    content_type: str = "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                # scrapes would otherwise be printed over the progress bar
+                pass
+
+        self.server: ThreadingHTTPServer = ThreadingHTTPServer((host, port), Handler)
+        self.thread: threading.Thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+        print(f"Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,103 @@
+from typing import Optional
+import numpy as np
+import pandas as pd
+from csv_setup import SegmentColumns, label_csr
+from plan import DownloadPlan
+
+"""
+Script to define the order in which the rows of a download plan are handed out.
+Going through the CSV in order means a run that is cut short is skewed towards
+whatever labels happen to come first, so the rows can instead be ordered to
+cover the rare labels first, or to fill every label up evenly towards a target
+count, so that a partial run already is a usable, balanced subset.
+"""
+
+# the order of the segment CSV
+ORDER_CSV: str = "csv"
+# rows whose rarest label is rarest in the split first
+ORDER_RARE_FIRST: str = "rare_first"
+# round robin over the labels, counting the clips already downloaded
+ORDER_BALANCED: str = "balanced"
+
+order_modes: list[str] = [ORDER_CSV, ORDER_RARE_FIRST, ORDER_BALANCED]
+
+
+def count_labels(
+    metadata_df: pd.DataFrame, class_labels_df: pd.DataFrame, columns: Optional[SegmentColumns] = None
+) -> np.ndarray:
+    """
+    Returns how many of the metadata rows carry each label of the class labels
+    CSV, taking the labels from the columns the rows were loaded from if given.
+    """
+    counts: np.ndarray = np.zeros(len(class_labels_df), dtype=np.int64)
+    if len(metadata_df) == 0:
+        return counts
+
+    _, label_ids = label_csr(metadata_df, class_labels_df, columns)
+    return np.bincount(label_ids[label_ids >= 0], minlength=len(class_labels_df))
+
+
+def rarest_labels(plan: DownloadPlan, label_frequency: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the rarest label of every row of the plan and how often it occurs,
+    ties going to the lower label ID. Rows without labels get label -1 and an
+    infinite frequency.
+    """
+    num_rows: int = len(plan)
+    num_labels: int = len(label_frequency)
+    counts: np.ndarray = np.diff(plan.label_offsets)
+    has_labels: np.ndarray = counts > 0
+
+    # one key per (row, label) orders by frequency, then label, so the minimum
+    # over a row's keys tells both its rarest label and its frequency
+    keys: np.ndarray = label_frequency[plan.label_ids].astype(np.int64) * num_labels + plan.label_ids
+    row_keys: np.ndarray = np.full(num_rows, -1, dtype=np.int64)
+    if has_labels.any():
+        row_keys[has_labels] = np.minimum.reduceat(keys, plan.label_offsets[:-1][has_labels])
+
+    labels: np.ndarray = np.where(has_labels, row_keys % num_labels, -1)
+    frequency: np.ndarray = np.where(has_labels, row_keys // num_labels, np.iinfo(np.int64).max)
+    return labels, frequency
+
+
+def order_rows(
+    plan: DownloadPlan,
+    order: str,
+    num_labels: int,
+    done_counts: Optional[np.ndarray] = None,
+    target: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Returns the row positions of the plan in the order they should be
+    downloaded. `done_counts` holds the number of clips of every label that
+    were already downloaded, and `target` the number of clips per label the
+    balanced order aims for before going on with the rest.
+    """
+    assert order in order_modes, f"Invalid order: {order}"
+    num_rows: int = len(plan)
+    if order == ORDER_CSV or num_rows == 0:
+        return np.arange(num_rows)
+
+    if done_counts is None:
+        done_counts = np.zeros(num_labels, dtype=np.int64)
+    # how common a label is in the split, the clips that are already there included
+    label_frequency: np.ndarray = np.bincount(plan.label_ids, minlength=num_labels) + done_counts
+    labels, frequency = rarest_labels(plan, label_frequency)
+
+    if order == ORDER_RARE_FIRST:
+        return np.argsort(frequency, kind="stable")
+
+    # every row is queued under its rarest label, and its place in that queue
+    # plus the clips the label already has says how far along the label is once
+    # the row is downloaded. Taking the rows by that, across every queue at once,
+    # goes round robin over the labels
+    by_label: np.ndarray = np.argsort(labels, kind="stable")
+    sorted_labels: np.ndarray = labels[by_label]
+    group_starts: np.ndarray = np.searchsorted(sorted_labels, sorted_labels, side="left")
+    rank: np.ndarray = np.empty(num_rows, dtype=np.int64)
+    rank[by_label] = np.arange(num_rows) - group_starts
+    fill: np.ndarray = np.where(labels >= 0, done_counts[np.maximum(labels, 0)], 0) + rank
+
+    # rows of labels that already reached the target come last
+    over_target: np.ndarray = fill >= target if target is not None else np.zeros(num_rows, dtype=bool)
+    return np.lexsort((np.arange(num_rows), frequency, fill, over_target))
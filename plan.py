@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import pandas as pd
+from csv_setup import SegmentColumns, label_csr
+
+"""
+Script to define the download plan of a shard. The plan is built once, up front,
+with vectorized pandas/NumPy operations, so the workers only ever index into
+plain arrays instead of going through pandas rows. The arrays can be moved into
+shared memory, so every worker process maps the same copy of them instead of
+getting its own.
+"""
+
+# the array fields of a DownloadPlan
+plan_arrays: list[str] = ["ytid", "start_seconds", "end_seconds", "file_names", "label_offsets", "label_ids"]
+
+
+@dataclass
+class DownloadPlan:
+    """
+    Everything needed to download the rows of a shard, stored as flat arrays.
+    Labels are interned into row positions of the class labels CSV and stored in
+    CSR form: the labels of row i are label_ids[label_offsets[i]:label_offsets[i + 1]].
+    """
+    ytid: np.ndarray
+    start_seconds: np.ndarray
+    end_seconds: np.ndarray
+    file_names: np.ndarray
+    label_offsets: np.ndarray
+    label_ids: np.ndarray
+    # maps a label ID to the directory its clips are written to
+    label_dirs: list[str]
+
+    def __len__(self) -> int:
+        return len(self.ytid)
+
+    def row_labels(self, row_idx: int) -> np.ndarray:
+        return self.label_ids[self.label_offsets[row_idx] : self.label_offsets[row_idx + 1]]
+
+    def output_paths(self, row_idx: int) -> list[Path]:
+        """Returns the path of a row's clip in every one of its label directories."""
+        file_name: str = str(self.file_names[row_idx])
+        return [Path(self.label_dirs[label_id], file_name) for label_id in self.row_labels(row_idx)]
+
+    def make_label_dirs(self) -> None:
+        """Creates the directory of every label used in the plan, once each."""
+        for label_id in np.unique(self.label_ids):
+            Path(self.label_dirs[label_id]).mkdir(exist_ok=True)
+
+
+def format_seconds(seconds: pd.Series) -> np.ndarray:
+    """Formats segment times the way they appear in clip file names, e.g. 30.0."""
+    codes, uniques = pd.factorize(seconds)
+    return uniques.astype(str).to_numpy(dtype=str)[codes]
+
+
+def build_plan(
+    metadata_df: pd.DataFrame,
+    class_labels_df: pd.DataFrame,
+    download_dir: Path,
+    codec_type: str = "wav",
+    columns: Optional[SegmentColumns] = None,
+) -> DownloadPlan:
+    """
+    Turns the metadata rows of a shard into a download plan in a single pass.
+    With the columns the rows were loaded from, their labels are taken from the
+    cached label IDs instead of being parsed out of positive_labels.
+    """
+    label_offsets, label_ids = label_csr(metadata_df, class_labels_df, columns)
+    assert (label_ids >= 0).all(), f"{(label_ids < 0).sum()} unknown labels in metadata"
+
+    # the names are put together on fixed width arrays, and the few distinct
+    # segment times are only formatted once each
+    ytid: np.ndarray = metadata_df["YTID"].to_numpy(dtype=str)
+    file_names: np.ndarray = np.char.add(ytid, "_")
+    file_names = np.char.add(file_names, format_seconds(metadata_df["start_seconds"]))
+    file_names = np.char.add(file_names, "-")
+    file_names = np.char.add(file_names, format_seconds(metadata_df["end_seconds"]))
+    file_names = np.char.add(file_names, f".{codec_type}")
+
+    return DownloadPlan(
+        ytid=ytid,
+        start_seconds=metadata_df["start_seconds"].to_numpy(dtype=np.float64),
+        end_seconds=metadata_df["end_seconds"].to_numpy(dtype=np.float64),
+        file_names=file_names,
+        label_offsets=label_offsets,
+        label_ids=label_ids.astype(np.int32),
+        label_dirs=[str(Path(download_dir) / name) for name in class_labels_df["display_name"]],
+    )
+
+
+@dataclass
+class PlanHandle:
+    """
+    What a worker process needs to map a plan that lives in shared memory: the
+    name, shape and dtype of the block of every array, and the label directories.
+    """
+    blocks: dict[str, tuple[str, tuple[int, ...], str]]
+    label_dirs: list[str]
+
+
+def share_plan(plan: DownloadPlan) -> tuple[PlanHandle, list[SharedMemory]]:
+    """
+    Copies the arrays of a plan into shared memory blocks. Returns the handle to
+    pass to the workers, and the blocks, which the caller has to release with
+    `release_plan(..., unlink=True)` once the workers are done.
+    """
+    blocks: dict[str, tuple[str, tuple[int, ...], str]] = {}
+    memories: list[SharedMemory] = []
+    for name in plan_arrays:
+        array: np.ndarray = getattr(plan, name)
+        # a block can't be empty
+        memory: SharedMemory = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+        blocks[name] = (memory.name, array.shape, array.dtype.str)
+        memories.append(memory)
+
+    return PlanHandle(blocks, list(plan.label_dirs)), memories
+
+
+def attach_plan(handle: PlanHandle) -> tuple[DownloadPlan, list[SharedMemory]]:
+    """
+    Maps a plan shared by `share_plan`, read only. The returned blocks have to
+    stay referenced for as long as the plan is used, and can only be released
+    once it no longer is.
+    """
+    memories: list[SharedMemory] = []
+    arrays: dict[str, np.ndarray] = {}
+    for name, (block_name, shape, dtype) in handle.blocks.items():
+        memory: SharedMemory = SharedMemory(name=block_name)
+        array: np.ndarray = np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf)
+        array.flags.writeable = False
+        memories.append(memory)
+        arrays[name] = array
+    return DownloadPlan(**arrays, label_dirs=handle.label_dirs), memories
+
+
+def release_plan(memories: list[SharedMemory], unlink: bool = False) -> None:
+    """
+    Closes the shared memory blocks of a plan, and frees them if `unlink` is
+    set, which more than one process may do.
+    """
+    for memory in memories:
+        memory.close()
+        if unlink:
+            try:
+                memory.unlink()
+            except FileNotFoundError:
+                pass
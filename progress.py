@@ -0,0 +1,104 @@
+from dataclasses import dataclass, field
+import multiprocessing as mp
+from queue import Empty
+from typing import Optional
+import time
+
+"""
+Script to define the progress channel shared between the download workers and
+the aggregator. Workers only ever send small, fixed size completion events, so
+reporting a finished clip costs the same no matter how large the shard is.
+"""
+
+STATUS_DOWNLOADED: str = "downloaded"
+STATUS_ERRORED: str = "errored"
+# still throttled after the retry cap, left for a later run
+STATUS_DEFERRED: str = "deferred"
+
+
+@dataclass
+class ProgressEvent:
+    """
+    Completion event for a single clip, sent from a worker to the aggregator.
+    """
+    job_id: int
+    ytid: str
+    status: str
+    error: Optional[str] = None
+    duration: float = 0.0
+    row_idx: int = -1
+    paths: list[str] = field(default_factory=list)
+    num_bytes: int = 0
+    # one of errors.error_classes for rows that did not download
+    error_class: Optional[str] = None
+    # download attempts made for the row, and how many of them were throttled
+    num_attempts: int = 1
+    num_throttled: int = 0
+    # seconds spent in each stage of the row, see metrics.stages
+    stage_times: dict[str, float] = field(default_factory=dict)
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class JobStatus:
+    """
+    Running counters for a single worker, kept by the aggregator.
+    """
+    num_downloaded: int = 0
+    num_errored: int = 0
+    num_deferred: int = 0
+    update_timestamp: float = 0.0
+
+    @property
+    def total(self) -> int:
+        return self.num_downloaded + self.num_errored + self.num_deferred
+
+
+class ProgressAggregator:
+    """
+    Holds the running state of a download, built up from the progress events
+    sent by the workers. Only meant to live in one process.
+    """
+
+    def __init__(self, job_ids: list[int]):
+        self.downloaded_ids: list[str] = []
+        self.errored_ids: list[str] = []
+        self.errors: list[str] = []
+        self.deferred_ids: list[str] = []
+        self.jobs: dict[int, JobStatus] = {job_id: JobStatus() for job_id in job_ids}
+
+    @property
+    def num_finished(self) -> int:
+        return len(self.downloaded_ids) + len(self.errored_ids) + len(self.deferred_ids)
+
+    def apply(self, event: ProgressEvent) -> None:
+        """Folds a single event into the running state."""
+        job: JobStatus = self.jobs.setdefault(event.job_id, JobStatus())
+        job.update_timestamp = event.timestamp
+
+        if event.status == STATUS_DOWNLOADED:
+            self.downloaded_ids.append(event.ytid)
+            job.num_downloaded += 1
+        elif event.status == STATUS_DEFERRED:
+            self.deferred_ids.append(event.ytid)
+            job.num_deferred += 1
+        else:
+            self.errored_ids.append(event.ytid)
+            self.errors.append(str(event.error))
+            job.num_errored += 1
+
+    def drain(self, queue: mp.Queue, timeout: float) -> list[ProgressEvent]:
+        """
+        Applies every event currently waiting on the queue, blocking for at most
+        `timeout` seconds for the first one. Returns the events that were applied.
+        """
+        events: list[ProgressEvent] = []
+        try:
+            event: ProgressEvent = queue.get(timeout=timeout)
+            while True:
+                self.apply(event)
+                events.append(event)
+                event = queue.get_nowait()
+        except Empty:
+            pass
+        return events
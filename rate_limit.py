@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+from typing import Iterator
+import multiprocessing as mp
+import os
+import random
+import time
+
+"""
+Script to define the rate limiter shared by every download worker on a node.
+It is a token bucket whose rate, together with a cap on the number of downloads
+in flight, is adapted AIMD style: both creep up while downloads succeed and are
+cut multiplicatively as soon as YouTube starts asking whether we're a bot.
+"""
+
+# how long to wait on the shared lock before checking whether its holder died
+LOCK_TIMEOUT_SECONDS: float = 1.0
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket shared between processes through shared memory values. Must be
+    created in the parent process and handed to the workers. The downloads in
+    flight are also counted per job, so that the parent can take back those of
+    a worker that was killed with `forget_job`.
+    """
+
+    def __init__(
+        self,
+        initial_rate: float = 5.0,
+        min_rate: float = 0.05,
+        max_rate: float = 100.0,
+        initial_inflight: int = 8,
+        max_inflight: int = 1024,
+        max_jobs: int = 1024,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        decrease_cooldown: float = 5.0,
+    ):
+        assert 0 < min_rate <= initial_rate <= max_rate, "Rates must satisfy 0 < min_rate <= initial_rate <= max_rate"
+        assert 0 < multiplicative_decrease < 1, "Multiplicative decrease must be between 0 and 1"
+
+        self.min_rate: float = min_rate
+        self.max_rate: float = max_rate
+        self.max_inflight: int = max_inflight
+        self.max_jobs: int = max_jobs
+        self.additive_increase: float = additive_increase
+        self.multiplicative_decrease: float = multiplicative_decrease
+        self.decrease_cooldown: float = decrease_cooldown
+
+        self.lock: mp.Lock = mp.Lock()
+        # PID of the process holding the lock, or -1
+        self.lock_holder = mp.Value("i", -1, lock=False)
+        self.break_lock: mp.Lock = mp.Lock()
+        # tokens per second, and the tokens currently in the bucket
+        self.rate = mp.Value("d", initial_rate, lock=False)
+        self.tokens = mp.Value("d", 1.0, lock=False)
+        self.last_refill = mp.Value("d", time.time(), lock=False)
+        self.last_decrease = mp.Value("d", 0.0, lock=False)
+        # adaptive cap on the number of downloads in flight, and the actual number
+        self.inflight_limit = mp.Value("d", float(initial_inflight), lock=False)
+        self.inflight = mp.Value("i", 0, lock=False)
+        self.job_inflight = mp.Array("i", max_jobs, lock=False)
+
+    def _refill(self, now: float) -> None:
+        elapsed: float = now - self.last_refill.value
+        # at most one second worth of tokens is kept, so bursts stay small
+        self.tokens.value = min(
+            max(self.rate.value, 1.0), self.tokens.value + elapsed * self.rate.value
+        )
+        self.last_refill.value = now
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """
+        Holds the shared lock. A worker killed while holding it never releases
+        it, so waiters give up every so often to break the lock of a dead holder.
+        """
+        while not self.lock.acquire(timeout=LOCK_TIMEOUT_SECONDS):
+            self._break_dead_holder()
+        self.lock_holder.value = os.getpid()
+        try:
+            yield
+        finally:
+            self.lock_holder.value = -1
+            self.lock.release()
+
+    def _break_dead_holder(self) -> None:
+        # only one waiter may break the lock, and only if the dead process
+        # still holds it rather than whoever got it since
+        with self.break_lock:
+            holder: int = self.lock_holder.value
+            if holder <= 0:
+                return
+            try:
+                os.kill(holder, 0)
+                return
+            except ProcessLookupError:
+                pass
+            print(f"Process {holder} died holding the rate limiter lock, breaking it")
+            self.lock_holder.value = -1
+            try:
+                self.lock.release()
+            except ValueError:
+                pass
+
+    def acquire(self, job_id: int) -> None:
+        """Blocks until a download of the given job may start."""
+        while True:
+            with self._locked():
+                now: float = time.time()
+                self._refill(now)
+                if self.tokens.value >= 1.0 and self.inflight.value < int(self.inflight_limit.value):
+                    self.tokens.value -= 1.0
+                    self.inflight.value += 1
+                    self.job_inflight[job_id] += 1
+                    return
+                wait: float = max((1.0 - self.tokens.value) / self.rate.value, 0.01)
+            time.sleep(min(wait, 1.0))
+
+    def release(self, job_id: int, throttled: bool) -> None:
+        """
+        Marks a download started with `acquire` as finished. Anything that was
+        not throttled counts as a success, even if the video itself was missing,
+        since the endpoint still answered.
+        """
+        with self._locked():
+            self.inflight.value -= 1
+            self.job_inflight[job_id] -= 1
+            now: float = time.time()
+
+            if throttled:
+                # a burst of blocks is one congestion event, not one per worker
+                if now - self.last_decrease.value < self.decrease_cooldown:
+                    return
+                self.last_decrease.value = now
+                self.rate.value = max(self.min_rate, self.rate.value * self.multiplicative_decrease)
+                self.inflight_limit.value = max(1.0, self.inflight_limit.value * self.multiplicative_decrease)
+            else:
+                # spread the additive increase over a second worth of successes
+                self.rate.value = min(
+                    self.max_rate, self.rate.value + self.additive_increase / self.rate.value
+                )
+                self.inflight_limit.value = min(
+                    float(self.max_inflight),
+                    self.inflight_limit.value + 1.0 / self.inflight_limit.value,
+                )
+
+    def forget_job(self, job_id: int) -> int:
+        """
+        Takes back the downloads a dead worker had in flight, which it never
+        got to release. Returns how many there were.
+        """
+        with self._locked():
+            num_inflight: int = self.job_inflight[job_id]
+            self.inflight.value -= num_inflight
+            self.job_inflight[job_id] = 0
+        return num_inflight
+
+    @property
+    def current_rate(self) -> float:
+        return self.rate.value
+
+    @property
+    def current_inflight_limit(self) -> float:
+        return self.inflight_limit.value
+
+
+def backoff_delay(attempt: int, base: float, cap: float = 300.0) -> float:
+    """Exponential backoff with full jitter for the given (zero based) retry attempt."""
+    return random.uniform(0, min(cap, base * 2**attempt))
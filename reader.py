@@ -0,0 +1,160 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional
+import random
+import numpy as np
+import pandas as pd
+from clip_index import ClipIndex
+from csv_setup import SegmentColumns
+from features import read_wav
+from plan import DownloadPlan, build_plan
+
+"""
+Script to define a reader over a downloaded split, for training on it. Every
+segment is read once, from the first label directory its clip was found in,
+with its labels taken from the segment CSV rather than from directory names,
+and the clips on disk are found through the clip index instead of one stat per
+file. A thread pool keeps the next clips loaded ahead of the consumer, each of
+several readers (e.g. one per GPU) gets a disjoint share of the rows, and an
+optional shuffle buffer mixes them in an order that only depends on the seed
+and the epoch.
+
+Example:
+    split_df = csv_downloader.load_segment_csv_url(n_splits, split_idx, num_rows)
+    reader = SplitReader(split_dir, split_df, class_labels_df, rank=rank, world_size=world_size, shuffle_buffer=2048, columns=csv_downloader.columns)
+    for epoch in range(num_epochs):
+        reader.set_epoch(epoch)
+        for audio, labels, ytid in reader:
+            ...
+"""
+
+
+class SplitReader:
+    """
+    Iterates over the clips of a split as (audio, labels, ytid) tuples, where
+    `audio` holds the mono float32 samples of the clip in [-1, 1] and `labels`
+    its multi-hot label vector over the rows of `class_labels_df`. Segments
+    without a clip on disk are skipped. `columns` are the columns `metadata_df`
+    was loaded from, which hold its labels.
+
+    Reader `rank` out of `world_size` gets every world_size-th of the clips,
+    and with `drop_uneven` every reader gets the same number of them, so
+    readers running in lockstep all run out at the same time.
+    """
+
+    def __init__(
+        self,
+        split_dir: Path,
+        metadata_df: pd.DataFrame,
+        class_labels_df: pd.DataFrame,
+        codec_type: str = "wav",
+        rank: int = 0,
+        world_size: int = 1,
+        shuffle_buffer: int = 0,
+        seed: int = 0,
+        num_threads: int = 8,
+        prefetch: int = 64,
+        drop_uneven: bool = True,
+        columns: Optional[SegmentColumns] = None,
+    ):
+        assert codec_type == "wav", "Only wav clips can be read"
+        assert 0 <= rank < world_size, f"Invalid rank {rank} for a world size of {world_size}"
+        assert shuffle_buffer >= 0, "Shuffle buffer size must be at least 0"
+        assert num_threads >= 1 and prefetch >= 1, "Number of threads and prefetch must be at least 1"
+
+        self.split_dir: Path = Path(split_dir)
+        self.label_names: list[str] = class_labels_df["display_name"].tolist()
+        self.num_labels: int = len(class_labels_df)
+        self.rank: int = rank
+        self.world_size: int = world_size
+        self.shuffle_buffer: int = shuffle_buffer
+        self.seed: int = seed
+        self.num_threads: int = num_threads
+        self.prefetch: int = prefetch
+        self.epoch: int = 0
+
+        self.plan: DownloadPlan = build_plan(metadata_df, class_labels_df, self.split_dir, codec_type, columns)
+        self.split_rows: np.ndarray = metadata_df.index.to_numpy(dtype=np.int64)
+
+        # file name -> the first label directory it was found in, multi-label
+        # clips show up in several but are only read once
+        clip_index: ClipIndex = ClipIndex(self.split_dir, num_threads)
+        clip_index.load()
+        clip_index.scan()
+        first_label: dict[str, str] = {}
+        for label in sorted(clip_index.entries):
+            for name in clip_index.entries[label]["clips"]:
+                first_label.setdefault(name, label)
+
+        rows: list[int] = []
+        self.paths: dict[int, Path] = {}
+        for row_idx, name in enumerate(self.plan.file_names.tolist()):
+            label: Optional[str] = first_label.get(name)
+            if label is not None:
+                rows.append(row_idx)
+                self.paths[row_idx] = self.split_dir / label / name
+
+        shard: np.ndarray = np.array(rows, dtype=np.int64)
+        if drop_uneven:
+            shard = shard[: len(shard) - len(shard) % world_size]
+        # positions into the plan of the clips this reader yields
+        self.rows: np.ndarray = shard[rank::world_size]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch, which together with the seed decides the shuffle order."""
+        self.epoch = epoch
+
+    def labels(self, row_idx: int) -> np.ndarray:
+        """Returns the multi-hot label vector of a row of the plan."""
+        labels: np.ndarray = np.zeros(self.num_labels, dtype=np.float32)
+        labels[self.plan.row_labels(row_idx)] = 1.0
+        return labels
+
+    def load(self, row_idx: int) -> tuple[np.ndarray, np.ndarray, str]:
+        audio, _ = read_wav(self.paths[row_idx])
+        return audio, self.labels(row_idx), str(self.plan.ytid[row_idx])
+
+    def prefetched(self) -> Iterator[tuple[np.ndarray, np.ndarray, str]]:
+        """
+        Yields the clips of this reader in row order, with up to `prefetch` of
+        them being loaded by the thread pool ahead of the consumer. They are
+        yielded in the order they were submitted, not the order they finish,
+        which keeps the shuffle below deterministic.
+        """
+        rows: Iterator[int] = iter(self.rows.tolist())
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            inflight: deque[Future] = deque()
+            for row_idx in rows:
+                inflight.append(executor.submit(self.load, row_idx))
+                if len(inflight) >= self.prefetch:
+                    break
+            while inflight:
+                sample: tuple[np.ndarray, np.ndarray, str] = inflight.popleft().result()
+                row_idx: Optional[int] = next(rows, None)
+                if row_idx is not None:
+                    inflight.append(executor.submit(self.load, row_idx))
+                yield sample
+
+    def __iter__(self) -> Iterator[tuple[np.ndarray, np.ndarray, str]]:
+        if self.shuffle_buffer == 0:
+            yield from self.prefetched()
+            return
+
+        # a clip entering a full buffer swaps out a random one, and whatever
+        # is left at the end comes out in random order
+        rng: random.Random = random.Random(f"{self.seed}-{self.epoch}-{self.rank}")
+        buffer: list[tuple[np.ndarray, np.ndarray, str]] = []
+        for sample in self.prefetched():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i: int = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+
+        rng.shuffle(buffer)
+        yield from buffer
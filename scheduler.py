@@ -0,0 +1,134 @@
+from collections import deque
+from dataclasses import dataclass, field
+import multiprocessing as mp
+from typing import Optional
+
+"""
+Script to define the dynamic scheduler handing out rows to the download workers.
+Rows are given out in small batches as workers ask for them, so a worker stuck
+on slow videos never holds up work the others could be doing.
+"""
+
+
+@dataclass
+class WorkBatch:
+    """
+    A small batch of row positions (into the shard being downloaded).
+    """
+    batch_id: int
+    rows: list[int]
+
+
+@dataclass
+class WorkerSlot:
+    """
+    Scheduler side bookkeeping for a single worker: its inbox and the rows it
+    has been given but not yet reported back.
+    """
+    job_id: int
+    inbox: mp.Queue
+    outstanding: dict[int, set[int]] = field(default_factory=dict)
+    row_batches: dict[int, int] = field(default_factory=dict)
+    released: bool = False
+    finished: bool = False
+
+
+class WorkScheduler:
+    """
+    Hands out batches of rows to workers on demand. Every worker keeps at most
+    `prefetch` batches in its inbox, and since the scheduler itself puts the
+    batches there it knows exactly which rows a worker holds; if the worker dies
+    those rows go back to the front of the queue for the others to pick up.
+    """
+
+    def __init__(self, num_rows: int, batch_size: int, prefetch: int = 2):
+        assert batch_size >= 1, "Batch size must be at least 1"
+        assert prefetch >= 1, "Prefetch must be at least 1"
+
+        self.batch_size: int = batch_size
+        self.prefetch: int = prefetch
+        self.next_batch_id: int = 0
+        self.pending: deque[WorkBatch] = deque()
+        self.slots: dict[int, WorkerSlot] = {}
+        # set to False while more rows may still be submitted from elsewhere,
+        # e.g. from a lease ledger shared with other nodes
+        self.exhausted: bool = True
+
+        self.submit(list(range(num_rows)))
+
+    def submit(self, rows: list[int], front: bool = False) -> None:
+        """Queues rows for download, split up into batches of `batch_size`."""
+        batches: list[WorkBatch] = []
+        for i in range(0, len(rows), self.batch_size):
+            batches.append(WorkBatch(self.next_batch_id, rows[i : i + self.batch_size]))
+            self.next_batch_id += 1
+
+        if front:
+            self.pending.extendleft(reversed(batches))
+        else:
+            self.pending.extend(batches)
+
+    def add_worker(self, job_id: int) -> mp.Queue:
+        """Registers a worker and returns the inbox it should read batches from."""
+        inbox: mp.Queue = mp.Queue()
+        self.slots[job_id] = WorkerSlot(job_id, inbox)
+        return inbox
+
+    @property
+    def num_outstanding(self) -> int:
+        return sum(
+            len(rows) for slot in self.slots.values() for rows in slot.outstanding.values()
+        )
+
+    @property
+    def done(self) -> bool:
+        return self.exhausted and len(self.pending) == 0 and self.num_outstanding == 0
+
+    def complete(self, job_id: int, row_idx: int) -> None:
+        """Marks a row reported by a worker as finished."""
+        slot: Optional[WorkerSlot] = self.slots.get(job_id)
+        if slot is None or row_idx not in slot.row_batches:
+            return
+
+        batch_id: int = slot.row_batches.pop(row_idx)
+        rows: set[int] = slot.outstanding[batch_id]
+        rows.discard(row_idx)
+        if not rows:
+            del slot.outstanding[batch_id]
+
+    def release(self, job_id: int) -> int:
+        """
+        Puts every row still held by a dead worker back at the front of the
+        queue. Returns the number of rows that were requeued.
+        """
+        slot: WorkerSlot = self.slots[job_id]
+        if slot.released:
+            return 0
+        slot.released = True
+
+        rows: list[int] = sorted(slot.row_batches)
+        slot.outstanding.clear()
+        slot.row_batches.clear()
+        self.submit(rows, front=True)
+        return len(rows)
+
+    def dispatch(self) -> None:
+        """
+        Tops up the inbox of every live worker, and tells the workers to stop
+        once there is nothing left to hand out or wait for.
+        """
+        for slot in self.slots.values():
+            if slot.released:
+                continue
+            while len(slot.outstanding) < self.prefetch and self.pending:
+                batch: WorkBatch = self.pending.popleft()
+                slot.outstanding[batch.batch_id] = set(batch.rows)
+                for row_idx in batch.rows:
+                    slot.row_batches[row_idx] = batch.batch_id
+                slot.inbox.put(batch)
+
+        if self.done:
+            for slot in self.slots.values():
+                if not slot.released and not slot.finished:
+                    slot.inbox.put(None)
+                    slot.finished = True
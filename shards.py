@@ -0,0 +1,120 @@
+from pathlib import Path
+from typing import Optional
+import io
+import json
+import os
+import tarfile
+
+"""
+Script to define the packed output format. Finished clips are streamed into
+rolling tar shards laid out like WebDataset ({key}.wav next to {key}.json), with
+an index.jsonl recording where every clip's audio starts inside its shard, so a
+training job can read the shards sequentially or seek straight to a clip.
+"""
+
+# one WAV per clip per label directory, the original layout
+OUTPUT_CLIPS: str = "clips"
+# only the packed shards, per clip WAVs are removed once packed
+OUTPUT_SHARDS: str = "shards"
+OUTPUT_BOTH: str = "both"
+
+output_modes: list[str] = [OUTPUT_CLIPS, OUTPUT_SHARDS, OUTPUT_BOTH]
+
+
+class ShardWriter:
+    """
+    Appends clips to `shard-{n}.tar` files under `shard_dir`, starting a new
+    shard once the current one is larger than `max_shard_bytes`. Shards from an
+    earlier run are left alone, numbering continues after them.
+    """
+
+    index_name: str = "index.jsonl"
+
+    def __init__(self, shard_dir: Path, max_shard_bytes: int = 1 << 30):
+        self.shard_dir: Path = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.max_shard_bytes: int = max_shard_bytes
+
+        self.next_shard_idx: int = len(list(self.shard_dir.glob("shard-*.tar")))
+        self.shard: Optional[tarfile.TarFile] = None
+        self.shard_name: str = ""
+        self.index = open(self.shard_dir / Path(self.index_name), "a")
+        # index entries of the clips added since the last flush, only written
+        # once their audio is on disk so the index never points past a shard's end
+        self.pending_entries: list[dict] = []
+
+    def _roll(self) -> None:
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_name = f"shard-{self.next_shard_idx:06d}.tar"
+        self.shard = tarfile.open(self.shard_dir / Path(self.shard_name), "w")
+        self.next_shard_idx += 1
+
+    def add(self, clip_path: Path, metadata: dict) -> None:
+        """Appends a clip and its metadata to the current shard."""
+        if self.shard is None or self.shard.offset >= self.max_shard_bytes:
+            self._roll()
+
+        key: str = Path(clip_path).stem
+        # built by hand rather than with gettarinfo, which would store a clip
+        # hardlinked into several label directories as a link member
+        audio_info: tarfile.TarInfo = tarfile.TarInfo(f"{key}{Path(clip_path).suffix}")
+        stat: os.stat_result = os.stat(clip_path)
+        audio_info.size = stat.st_size
+        audio_info.mtime = int(stat.st_mtime)
+        with open(clip_path, "rb") as f:
+            self.shard.addfile(audio_info, f)
+        # addfile has just written the header, then the data padded to whole blocks
+        num_blocks: int = -(-audio_info.size // tarfile.BLOCKSIZE)
+        audio_offset: int = self.shard.offset - num_blocks * tarfile.BLOCKSIZE
+
+        metadata_bytes: bytes = json.dumps(metadata).encode()
+        metadata_info: tarfile.TarInfo = tarfile.TarInfo(f"{key}.json")
+        metadata_info.size = len(metadata_bytes)
+        metadata_info.mtime = audio_info.mtime
+        self.shard.addfile(metadata_info, io.BytesIO(metadata_bytes))
+
+        entry: dict = {
+            "key": key,
+            "shard": self.shard_name,
+            "offset": audio_offset,
+            "size": audio_info.size,
+            **metadata,
+        }
+        self.pending_entries.append(entry)
+
+    def flush(self) -> None:
+        """
+        Writes the clips added so far to disk, then appends their index entries.
+        Once it returns, the clips can be read back from the shards alone.
+        """
+        if self.shard is not None:
+            self.shard.fileobj.flush()
+            os.fsync(self.shard.fileobj.fileno())
+        self.index.write("".join(json.dumps(entry) + "\n" for entry in self.pending_entries))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.pending_entries = []
+
+    def close(self) -> None:
+        self.flush()
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+        self.index.close()
+
+
+def read_shard_index(shard_dir: Path) -> list[dict]:
+    """Reads every entry of a shard directory's index, skipping lines cut short by a crash."""
+    index_file: Path = Path(shard_dir) / Path(ShardWriter.index_name)
+    if not index_file.exists():
+        return []
+
+    entries: list[dict] = []
+    with open(index_file, "r") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return entries
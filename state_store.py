@@ -0,0 +1,258 @@
+from pathlib import Path
+from typing import Iterable, Optional
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+from progress import ProgressEvent, STATUS_DEFERRED, STATUS_DOWNLOADED, STATUS_ERRORED
+from errors import ERROR_PERMANENT, ERROR_THROTTLED, ERROR_TRANSIENT, classify_error
+
+"""
+Script to define the state store of a split: a SQLite database with one row per
+segment holding its status, number of attempts, last error and size on disk.
+Finding the rows of a shard that still need downloading is a single indexed
+query instead of building sets out of text files and directory listings.
+
+It also holds the negative cache of videos that are permanently unavailable,
+and the time at which a row that failed transiently may be tried again.
+"""
+
+STATUS_PENDING: str = "pending"
+
+# statuses of the rows a run should (re)try, deferred rows were throttled
+pending_statuses: list[str] = [STATUS_PENDING, STATUS_DEFERRED]
+
+
+class StateStore:
+    """
+    Connection to the state store of a split. Rows are keyed by their row number
+    in the split's segment CSV. Only the parent process writes to it.
+
+    A row that failed transiently waits `retry_base * 2**attempts` seconds (at
+    most `retry_cap`) before it is handed out again, and is given up on as
+    errored after `max_attempts` transient failures.
+    """
+
+    def __init__(
+        self,
+        db_file: Path,
+        retry_base: float = 600.0,
+        retry_cap: float = 86400.0,
+        max_attempts: int = 8,
+    ):
+        self.db_file: Path = Path(db_file)
+        self.retry_base: float = retry_base
+        self.retry_cap: float = retry_cap
+        self.max_attempts: int = max_attempts
+        self.conn: sqlite3.Connection = sqlite3.connect(str(self.db_file), timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS segments (
+                row INTEGER PRIMARY KEY,
+                ytid TEXT NOT NULL,
+                start_seconds REAL NOT NULL,
+                end_seconds REAL NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error_class TEXT,
+                last_error TEXT,
+                num_bytes INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0
+            )"""
+        )
+        # stores made before rows were retried on a schedule
+        columns: list[str] = [column[1] for column in self.conn.execute("PRAGMA table_info(segments)")]
+        if "next_attempt_at" not in columns:
+            self.conn.execute("ALTER TABLE segments ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS segments_status ON segments (status, row)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS segments_ytid ON segments (ytid)")
+        # the negative cache, keyed by video since every segment of a video that
+        # is gone is gone too
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS unavailable (
+                ytid TEXT PRIMARY KEY,
+                error TEXT,
+                updated REAL NOT NULL
+            )"""
+        )
+        self.conn.commit()
+
+    def add_segments(self, metadata_df: pd.DataFrame) -> int:
+        """
+        Adds the segments of a metadata DataFrame (indexed by split row) as
+        pending, leaving rows that are already known alone. Returns the number of
+        rows that were new.
+        """
+        before: int = self.conn.total_changes
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO segments (row, ytid, start_seconds, end_seconds) VALUES (?, ?, ?, ?)",
+            zip(
+                metadata_df.index.tolist(),
+                metadata_df["YTID"].tolist(),
+                metadata_df["start_seconds"].tolist(),
+                metadata_df["end_seconds"].tolist(),
+            ),
+        )
+        self.conn.commit()
+        return self.conn.total_changes - before
+
+    def mark_ytids(self, ytids: Iterable[str], status: str, only_pending: bool = True) -> None:
+        """
+        Sets the status of every segment of the given videos, e.g. to import the
+        clips found on disk or the IDs of an exclusion file.
+        """
+        query: str = "UPDATE segments SET status = ?, updated = ? WHERE ytid = ?"
+        if only_pending:
+            query += " AND status IN (%s)" % ",".join("?" * len(pending_statuses))
+
+        now: float = time.time()
+        self.conn.executemany(
+            query,
+            ((status, now, ytid, *(pending_statuses if only_pending else [])) for ytid in ytids),
+        )
+        self.conn.commit()
+
+    def pending_rows(self, row_start: int, row_stop: int, now: Optional[float] = None) -> np.ndarray:
+        """
+        Returns the split rows in [row_start, row_stop) that still need
+        downloading and are due, leaving out the videos in the negative cache.
+        """
+        rows: list[tuple[int]] = self.conn.execute(
+            """SELECT row FROM segments WHERE status IN (%s) AND row >= ? AND row < ?
+            AND next_attempt_at <= ? AND ytid NOT IN (SELECT ytid FROM unavailable)
+            ORDER BY row"""
+            % ",".join("?" * len(pending_statuses)),
+            (*pending_statuses, row_start, row_stop, now if now is not None else time.time()),
+        ).fetchall()
+        return np.array([row for (row,) in rows], dtype=np.int64)
+
+    def rows_with_status(self, status: str, row_start: int, row_stop: int) -> np.ndarray:
+        """Returns the split rows in [row_start, row_stop) with the given status."""
+        rows: list[tuple[int]] = self.conn.execute(
+            "SELECT row FROM segments WHERE status = ? AND row >= ? AND row < ? ORDER BY row",
+            (status, row_start, row_stop),
+        ).fetchall()
+        return np.array([row for (row,) in rows], dtype=np.int64)
+
+    def num_waiting(self, row_start: int, row_stop: int, now: Optional[float] = None) -> int:
+        """Returns the number of rows in [row_start, row_stop) waiting for their next attempt."""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM segments WHERE status = ? AND row >= ? AND row < ? AND next_attempt_at > ?",
+            (STATUS_DEFERRED, row_start, row_stop, now if now is not None else time.time()),
+        ).fetchone()[0]
+
+    def next_attempt_at(self, row_start: int, row_stop: int) -> Optional[float]:
+        """
+        Returns when the first row in [row_start, row_stop) that still needs
+        downloading is due, or None if none does. The videos in the negative
+        cache don't count, as they are not going to be downloaded.
+        """
+        return self.conn.execute(
+            """SELECT MIN(next_attempt_at) FROM segments WHERE status IN (%s) AND row >= ? AND row < ?
+            AND ytid NOT IN (SELECT ytid FROM unavailable)"""
+            % ",".join("?" * len(pending_statuses)),
+            (*pending_statuses, row_start, row_stop),
+        ).fetchone()[0]
+
+    def num_unavailable(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM unavailable").fetchone()[0]
+
+    def count_statuses(self, row_start: int, row_stop: int) -> dict[str, int]:
+        return dict(
+            self.conn.execute(
+                "SELECT status, COUNT(*) FROM segments WHERE row >= ? AND row < ? GROUP BY status",
+                (row_start, row_stop),
+            ).fetchall()
+        )
+
+    def record(self, events: list[ProgressEvent], split_rows: np.ndarray) -> None:
+        """
+        Applies a batch of progress events in a single transaction. `split_rows`
+        maps the row positions in the events to split rows. Permanent failures
+        put their video into the negative cache, transient ones are scheduled
+        for a later attempt.
+        """
+        if not events:
+            return
+
+        updates: list[tuple] = []
+        unavailable: list[tuple[str, Optional[str], float]] = []
+        for event in events:
+            error_class: Optional[str] = event.error_class
+            if error_class is None and event.status != STATUS_DOWNLOADED:
+                # events of runs from before errors were classified
+                error_class = ERROR_THROTTLED if event.status == STATUS_DEFERRED else ERROR_PERMANENT
+            if error_class == ERROR_PERMANENT:
+                unavailable.append((event.ytid, event.error, event.timestamp))
+
+            updates.append(
+                (
+                    int(error_class == ERROR_TRANSIENT),
+                    self.max_attempts,
+                    event.status,
+                    error_class,
+                    event.error,
+                    event.num_bytes,
+                    event.timestamp,
+                    int(error_class == ERROR_TRANSIENT),
+                    event.timestamp,
+                    self.retry_cap,
+                    self.retry_base,
+                    int(split_rows[event.row_idx]),
+                )
+            )
+
+        # the backoff is worked out from the attempts already in the store, the
+        # exponent is clamped so the shift can't overflow
+        self.conn.executemany(
+            f"""UPDATE segments SET
+            status = CASE WHEN ? AND attempts + 1 >= ? THEN '{STATUS_ERRORED}' ELSE ? END,
+            last_error_class = ?, last_error = ?, num_bytes = ?, updated = ?,
+            next_attempt_at = CASE WHEN ? THEN ? + MIN(?, ? * (1 << MIN(attempts, 32))) ELSE 0 END,
+            attempts = attempts + 1
+            WHERE row = ?""",
+            updates,
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO unavailable (ytid, error, updated) VALUES (?, ?, ?)",
+            unavailable,
+        )
+        self.conn.commit()
+
+    def forgive_unavailable(self) -> set[str]:
+        """
+        Takes the videos whose stored error no longer counts as permanent out of
+        the negative cache, e.g. after the classification of an error changed,
+        and makes their errored segments due again. Returns their IDs.
+        """
+        forgiven: list[str] = [
+            ytid
+            for ytid, error in self.conn.execute("SELECT ytid, error FROM unavailable").fetchall()
+            if classify_error(error) != ERROR_PERMANENT
+        ]
+        self.conn.executemany("DELETE FROM unavailable WHERE ytid = ?", ((ytid,) for ytid in forgiven))
+        self.conn.executemany(
+            "UPDATE segments SET status = ?, last_error_class = ?, next_attempt_at = 0 WHERE ytid = ? AND status = ?",
+            ((STATUS_DEFERRED, ERROR_TRANSIENT, ytid, STATUS_ERRORED) for ytid in forgiven),
+        )
+        self.conn.commit()
+        return set(forgiven)
+
+    def requeue_rows(self, rows: Iterable[int], reasons: Iterable[str]) -> None:
+        """
+        Puts rows back to pending so the next run downloads them again, e.g.
+        the rows whose clip an audit found missing or broken. They are due right
+        away, and their attempts are kept.
+        """
+        now: float = time.time()
+        self.conn.executemany(
+            """UPDATE segments SET status = ?, last_error_class = NULL, last_error = ?,
+            num_bytes = 0, updated = ?, next_attempt_at = 0 WHERE row = ?""",
+            ((STATUS_PENDING, reason, now, int(row)) for row, reason in zip(rows, reasons)),
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
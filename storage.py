@@ -0,0 +1,40 @@
+from pathlib import Path
+import os
+
+"""
+Script to define how a clip with several positive labels is stored. The clip is
+only ever written once, to the directory of its first label, and every other
+label directory gets a link to it, so multi-label clips cost no extra disk space
+or write bandwidth.
+"""
+
+LINK_HARDLINK: str = "hardlink"
+LINK_SYMLINK: str = "symlink"
+# only the first label directory gets the clip, like before
+LINK_NONE: str = "none"
+
+link_modes: list[str] = [LINK_HARDLINK, LINK_SYMLINK, LINK_NONE]
+
+
+def link_label_copies(primary_path: Path, other_paths: list[Path], link_mode: str = LINK_HARDLINK) -> None:
+    """
+    Makes the clip at `primary_path` show up at every path in `other_paths`.
+    Hardlinks fall back to symlinks when the file system doesn't allow them.
+    """
+    assert link_mode in link_modes, f"Invalid link mode: {link_mode}"
+    if link_mode == LINK_NONE:
+        return
+
+    for path in other_paths:
+        if os.path.lexists(path):
+            continue
+
+        if link_mode == LINK_HARDLINK:
+            try:
+                os.link(primary_path, path)
+                continue
+            except OSError:
+                pass
+
+        # relative, so the split directory can be moved around as a whole
+        os.symlink(os.path.relpath(primary_path, path.parent), path)
@@ -0,0 +1,114 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+import os
+import struct
+
+"""
+Script to define the checks a clip has to pass before it is moved into its label
+directory. Only the headers are read: a WAV whose data chunk claims more bytes
+than the file holds, or a FLAC whose STREAMINFO has no sample count, was cut
+short while it was being written.
+"""
+
+# a clip may come out a little longer than asked for, since yt-dlp and ffmpeg
+# cut on packet boundaries
+DURATION_TOLERANCE: float = 1.0
+
+
+@dataclass
+class ClipHeader:
+    """
+    What the header of a clip says about its audio.
+    """
+    sample_rate: int
+    channels: int
+    bits_per_sample: int
+    num_frames: int
+
+    @property
+    def duration(self) -> float:
+        return self.num_frames / self.sample_rate if self.sample_rate > 0 else 0.0
+
+
+class InvalidClipError(Exception):
+    """
+    Raised when a clip file is not a complete WAV or FLAC file.
+    """
+
+
+def read_wav_header(path: Path) -> ClipHeader:
+    """Reads the fmt and data chunk headers of a WAV file."""
+    file_size: int = os.path.getsize(path)
+    with open(path, "rb") as f:
+        riff: bytes = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            raise InvalidClipError(f"{path} is not a RIFF/WAVE file")
+
+        fmt: Optional[tuple] = None
+        while True:
+            chunk_header: bytes = f.read(8)
+            if len(chunk_header) < 8:
+                raise InvalidClipError(f"{path} has no data chunk")
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                f.seek(chunk_size - 16 + (chunk_size & 1), os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    raise InvalidClipError(f"{path} has its data chunk before the fmt chunk")
+                _, channels, sample_rate, _, block_align, bits_per_sample = fmt
+                if f.tell() + chunk_size > file_size:
+                    raise InvalidClipError(
+                        f"{path} is truncated, its data chunk claims {chunk_size} bytes but only {file_size - f.tell()} are there"
+                    )
+                if block_align == 0:
+                    raise InvalidClipError(f"{path} has a block alignment of 0")
+                return ClipHeader(sample_rate, channels, bits_per_sample, chunk_size // block_align)
+            else:
+                f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def read_flac_header(path: Path) -> ClipHeader:
+    """Reads the STREAMINFO block of a FLAC file."""
+    with open(path, "rb") as f:
+        head: bytes = f.read(8 + 34)
+    if len(head) < 42 or head[:4] != b"fLaC" or head[4] & 0x7F != 0:
+        raise InvalidClipError(f"{path} is not a FLAC file")
+
+    # sample rate (20 bits), channels - 1 (3), bits per sample - 1 (5), total samples (36)
+    packed: int = int.from_bytes(head[18:26], "big")
+    sample_rate: int = packed >> 44
+    channels: int = ((packed >> 41) & 0x7) + 1
+    bits_per_sample: int = ((packed >> 36) & 0x1F) + 1
+    num_frames: int = packed & 0xFFFFFFFFF
+    return ClipHeader(sample_rate, channels, bits_per_sample, num_frames)
+
+
+def read_clip_header(path: Path) -> ClipHeader:
+    """Reads the header of a WAV or FLAC clip, by its extension."""
+    suffix: str = Path(path).suffix.lower()
+    if suffix == ".wav":
+        return read_wav_header(path)
+    if suffix == ".flac":
+        return read_flac_header(path)
+    raise InvalidClipError(f"{path} is neither a WAV nor a FLAC file")
+
+
+def validate_clip(path: Path, expected_duration: float) -> ClipHeader:
+    """
+    Checks that a freshly written clip is complete and no longer than the
+    segment it was cut from, raising an InvalidClipError otherwise. It may be
+    shorter, when the video ends before the segment does.
+    """
+    header: ClipHeader = read_clip_header(path)
+    if header.sample_rate <= 0 or header.channels <= 0:
+        raise InvalidClipError(f"{path} has {header.channels} channels at {header.sample_rate} Hz")
+    if header.num_frames == 0:
+        raise InvalidClipError(f"{path} holds no audio")
+    if header.duration > expected_duration + DURATION_TOLERANCE:
+        raise InvalidClipError(
+            f"{path} is {header.duration:.2f} seconds long, the segment is only {expected_duration:.2f}"
+        )
+    return header
@@ -1,14 +1,409 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+import glob
 import multiprocessing as mp
-from multiprocessing.managers import DictProxy
-from typing import Dict
+import os
+import queue
+import threading
+import time
+import traceback
+from backends import DownloadBackend
+from errors import ERROR_PERMANENT, ERROR_THROTTLED, ERROR_TRANSIENT, classify_error
+from metrics import STAGE_WAIT, STAGE_WRITE, record_stage, take_stage_times, timed_stage
+from plan import DownloadPlan, PlanHandle, attach_plan, release_plan
+from progress import ProgressEvent, STATUS_DEFERRED, STATUS_DOWNLOADED, STATUS_ERRORED
+from rate_limit import AdaptiveRateLimiter, backoff_delay
+from scheduler import WorkBatch
+from storage import link_label_copies
+from validation import InvalidClipError, validate_clip
+
+"""
+Script to define the worker processes of a download. A worker only gets the
+settings below and a handle to the plan in shared memory, never the downloader
+itself, so starting one doesn't copy the metadata DataFrames or ID lists.
+"""
+
+# how often a worker waiting on its inbox checks that the parent process is
+# still there, a parent that was killed never sends the final None
+INBOX_POLL_SECONDS: float = 5.0
 
 @dataclass
 class Worker:
     """
-    Simple class for bundling a dictionary proxy, a lock object, and a job ID.
+    Simple class for bundling a job ID with the process running it.
     """
-    dict_proxy: DictProxy
-    lock: mp.Lock
     job_id: int
     process : mp.Process
+
+
+@dataclass
+class WorkerSettings:
+    """
+    Everything a worker process needs besides the plan, kept small since it is
+    sent to every worker.
+    """
+    concurrency: int
+    max_retries: int
+    sleep_amount: int
+    codec_type: str
+    sample_rate: Optional[int]
+    channels: Optional[int]
+    link_mode: str
+    staging_dir: Path
+    # shared by every worker, so they back off together when throttled
+    rate_limiter: AdaptiveRateLimiter
+    backend: DownloadBackend
+    # transcode threads and spool slots of the pipeline, no transcoders means
+    # each download fetches and transcodes in one go
+    transcoders: int = 0
+    spool_size: int = 0
+
+
+@dataclass
+class SpoolItem:
+    """
+    A row whose raw audio has been fetched, waiting in the spool for a transcode
+    thread. The timings and counts of the fetch travel along with it.
+    """
+    row_idx: int
+    raw_path: Path
+    row_start: float
+    num_attempts: int
+    num_throttled: int
+    stage_times: dict[str, float]
+
+
+class DownloadWorker:
+    """
+    Downloads the rows handed to one worker process, with `concurrency` threads.
+
+    If the settings ask for transcoders and the backend supports it, the
+    download is split into two stages: the `concurrency` threads only fetch the
+    raw audio into a bounded spool, and `transcoders` threads, each driving one
+    ffmpeg process, transcode it. A full spool blocks the fetch threads, so the
+    network and the CPUs are both kept busy without one running away from the
+    other.
+    """
+
+    def __init__(self, settings: WorkerSettings, plan: DownloadPlan, job_id: int):
+        self.settings: WorkerSettings = settings
+        self.plan: DownloadPlan = plan
+        self.job_id: int = job_id
+        # the worker stops taking batches once it is reparented
+        self.parent_pid: int = os.getppid()
+        self.orphaned: bool = False
+        self.pipelined: bool = settings.transcoders > 0 and settings.backend.supports_pipeline
+        self.spool_dir: Path = settings.staging_dir / Path("spool")
+        # the spool itself is unbounded, its size is enforced by the slots a
+        # fetch thread takes before it hands a row over, so the time spent
+        # waiting for one is known before the row leaves the thread
+        self.spool: queue.Queue = queue.Queue()
+        self.spool_slots: threading.Semaphore = threading.Semaphore(max(settings.spool_size, 1))
+        if self.pipelined:
+            self.spool_dir.mkdir(parents=True, exist_ok=True)
+
+    def run(self, inbox: mp.Queue, progress_queue: mp.Queue) -> None:
+        """
+        Runs `concurrency` download threads, since each download spends nearly
+        all of its time waiting on the network or on ffmpeg, plus the transcode
+        threads when the download is pipelined.
+        """
+        num_transcoders: int = self.settings.transcoders if self.pipelined else 0
+        with ThreadPoolExecutor(max_workers=self.settings.concurrency + num_transcoders) as executor:
+            transcoders: list[Future] = [
+                executor.submit(self.transcode_loop, progress_queue)
+                for _ in range(num_transcoders)
+            ]
+            fetchers: list[Future] = [
+                executor.submit(self.download_loop, inbox, progress_queue)
+                for _ in range(self.settings.concurrency)
+            ]
+            try:
+                for future in fetchers:
+                    future.result()
+            finally:
+                # the transcoders finish what is left in the spool, then stop
+                for _ in transcoders:
+                    self.spool.put(None)
+            for future in transcoders:
+                future.result()
+
+    def download_loop(self, inbox: mp.Queue, progress_queue: mp.Queue) -> None:
+        """
+        Keeps pulling batches of row positions from the inbox until the
+        scheduler sends None.
+        """
+        while True:
+            batch: Optional[WorkBatch] = self.next_batch(inbox)
+            if batch is None:
+                # let the other threads of this job see the sentinel too
+                inbox.put(None)
+                break
+            for row_idx in batch.rows:
+                if self.orphaned:
+                    break
+                try:
+                    self.download_row(row_idx, progress_queue)
+                except Exception:
+                    # a thread that dies leaves its rows outstanding while the
+                    # process lives on, so nothing would ever requeue them
+                    self.report_failure(row_idx, progress_queue, traceback.format_exc())
+
+    def next_batch(self, inbox: mp.Queue) -> Optional[WorkBatch]:
+        """
+        Waits for the next batch of the inbox. Returns None once the scheduler
+        sends it, or once the parent process is gone.
+        """
+        while not self.orphaned:
+            try:
+                return inbox.get(timeout=INBOX_POLL_SECONDS)
+            except queue.Empty:
+                if os.getppid() != self.parent_pid:
+                    print(f"Job {self.job_id}: parent process {self.parent_pid} is gone, stopping")
+                    self.orphaned = True
+        return None
+
+    def transcode_loop(self, progress_queue: mp.Queue) -> None:
+        """Keeps transcoding fetched rows from the spool until it gets None."""
+        while True:
+            item: Optional[SpoolItem] = self.spool.get()
+            if item is None:
+                break
+            self.spool_slots.release()
+            try:
+                self.transcode_row(item, progress_queue)
+            except Exception:
+                # a dead transcoder would let the spool fill up and block every
+                # fetch thread, so the row is reported and the loop goes on
+                item.raw_path.unlink(missing_ok=True)
+                self.report_failure(item.row_idx, progress_queue, traceback.format_exc())
+
+    def report_failure(self, index: int, progress_queue: mp.Queue, error: str) -> None:
+        """
+        Reports a row whose download raised something unexpected as a transient
+        failure, so it is retried by a later run, and cleans up after it.
+        """
+        print(f"Job number {self.job_id} failed on row {index}:\n{error}")
+        self.remove_staged(self.staging_path(index))
+        event: ProgressEvent = ProgressEvent(
+            self.job_id, str(self.plan.ytid[index]), STATUS_DEFERRED, error, 0.0, index,
+            error_class=ERROR_TRANSIENT,
+        )
+        event.stage_times = take_stage_times()
+        progress_queue.put(event)
+
+    def download_row(self, index: int, progress_queue: mp.Queue) -> None:
+        """
+        Downloads the clip of row `index` of the download plan and saves it to
+        the specified directory. The label directories already exist, they are
+        created once when the download starts. When pipelined, only fetches the
+        raw audio and puts the row into the spool.
+
+        The clip is written to the staging directory first, and only moved into
+        its label directory once its header checks out, so a worker killed
+        halfway never leaves a partial clip where it would count as downloaded.
+        """
+        settings: WorkerSettings = self.settings
+        row_start: float = time.time()
+        ytid: str = str(self.plan.ytid[index])
+        start_time: float = float(self.plan.start_seconds[index])
+        end_time: float = float(self.plan.end_seconds[index])
+        staging_path: Path = self.staging_path(index)
+
+        take_stage_times()
+        # a clip that a killed run finished writing but never moved into place
+        if self.recover_staged(staging_path, end_time - start_time):
+            self.finish_row(index, progress_queue, row_start, None, None, 0, 0, recovered=True)
+            return
+
+        if self.pipelined:
+            fetch: Callable[[], tuple[int, Optional[Exception], Optional[Path]]] = lambda: settings.backend.fetch(
+                ytid, start_time, end_time, self.spool_dir / Path(staging_path.stem), True
+            )
+        else:
+            fetch = lambda: (
+                *settings.backend.download(
+                    ytid, start_time, end_time, [staging_path], settings.codec_type, True,
+                    settings.sample_rate, settings.channels,
+                ),
+                None,
+            )
+        error_class, error, raw_path, num_attempts, num_throttled = self.fetch_with_retries(ytid, fetch)
+
+        if self.pipelined and error_class is None:
+            # blocks while the spool is full, which is what keeps the fetch
+            # threads from getting ahead of the transcoders
+            with timed_stage(STAGE_WAIT):
+                self.spool_slots.acquire()
+            # the row's timings go along with it, a transcoder may pick it up
+            # the moment it is in the spool
+            self.spool.put(SpoolItem(index, raw_path, row_start, num_attempts, num_throttled, take_stage_times()))
+            return
+
+        self.finish_row(index, progress_queue, row_start, error_class, error, num_attempts, num_throttled)
+
+    def fetch_with_retries(
+        self, ytid: str, fetch: Callable[[], tuple[int, Optional[Exception], Optional[Path]]]
+    ) -> tuple[Optional[str], Optional[Exception], Optional[Path], int, int]:
+        """
+        Runs a fetch through the rate limiter, retrying it with backoff while it
+        gets throttled. Returns the error class (None on success), the error,
+        the path of the raw audio if any, and the number of attempts and of
+        throttled attempts.
+        """
+        settings: WorkerSettings = self.settings
+        attempt: int = 0
+        num_throttled: int = 0
+        while True:
+            with timed_stage(STAGE_WAIT):
+                settings.rate_limiter.acquire(self.job_id)
+            # a fetch that raises still gives its slot back, or every such row
+            # would shrink the number of downloads allowed in flight for good
+            bot_sniped: bool = False
+            try:
+                ret: tuple[int, Optional[Exception], Optional[Path]] = fetch()
+                assert ret is not None, f"Error downloading {ytid}"
+
+                failed: bool = ret[0] == 1 or ret[1] is not None
+                error_class: Optional[str] = classify_error(ret[1]) if failed else None
+                bot_sniped = error_class == ERROR_THROTTLED
+            finally:
+                settings.rate_limiter.release(self.job_id, throttled=bot_sniped)
+            if not bot_sniped:
+                return error_class, ret[1], ret[2], attempt + 1, num_throttled
+            num_throttled += 1
+
+            # while we still keep getting bot sniped (or a 429), back off and try
+            # again, up to max_retries times before leaving the row for a later run
+            if attempt >= settings.max_retries:
+                return error_class, ret[1], ret[2], attempt + 1, num_throttled
+            delay: float = backoff_delay(attempt, settings.sleep_amount)
+            print(
+                f"Job number {self.job_id} got bot sniped. Retrying download for ytid={ytid} after sleeping for {delay:.1f} seconds"
+            )
+            with timed_stage(STAGE_WAIT):
+                time.sleep(delay)
+            attempt += 1
+
+    def transcode_row(self, item: SpoolItem, progress_queue: mp.Queue) -> None:
+        """Transcodes a fetched row into its staging path and finishes it."""
+        settings: WorkerSettings = self.settings
+        take_stage_times()
+        for stage, seconds in item.stage_times.items():
+            record_stage(stage, seconds)
+
+        ret_pair: tuple[int, Optional[Exception]] = settings.backend.transcode(
+            item.raw_path, self.staging_path(item.row_idx), settings.codec_type,
+            settings.sample_rate, settings.channels,
+        )
+        item.raw_path.unlink(missing_ok=True)
+
+        failed: bool = ret_pair[0] == 1 or ret_pair[1] is not None
+        self.finish_row(
+            item.row_idx, progress_queue, item.row_start,
+            ERROR_TRANSIENT if failed else None, ret_pair[1], item.num_attempts, item.num_throttled,
+        )
+
+    def staging_path(self, index: int) -> Path:
+        # the staging path only depends on the row, so a later run finds the
+        # .part files an interrupted one left behind and yt-dlp resumes them
+        return self.settings.staging_dir / Path(str(self.plan.file_names[index]))
+
+    def finish_row(
+        self,
+        index: int,
+        progress_queue: mp.Queue,
+        row_start: float,
+        error_class: Optional[str],
+        error: Optional[Exception],
+        num_attempts: int,
+        num_throttled: int,
+        recovered: bool = False,
+    ) -> None:
+        """
+        Moves a row's clip from its staging path into its label directories if
+        it was downloaded, and reports the row to the parent.
+        """
+        settings: WorkerSettings = self.settings
+        ytid: str = str(self.plan.ytid[index])
+        download_paths: list[Path] = self.plan.output_paths(index)
+        staging_path: Path = self.staging_path(index)
+        expected_duration: float = float(self.plan.end_seconds[index] - self.plan.start_seconds[index])
+
+        if error_class is None:
+            try:
+                with timed_stage(STAGE_WRITE):
+                    if not recovered:
+                        validate_clip(staging_path, expected_duration)
+                    # a rename within the split directory, so the clip shows up
+                    # in its label directory complete or not at all
+                    os.replace(staging_path, download_paths[0])
+            except (InvalidClipError, OSError) as e:
+                error_class, error = ERROR_TRANSIENT, e
+                self.remove_staged(staging_path)
+
+        if error_class is not None:
+            # only videos that are gone for good count as errored, throttled and
+            # transient failures are left for a later run to retry
+            status: str = STATUS_ERRORED if error_class == ERROR_PERMANENT else STATUS_DEFERRED
+            if error_class == ERROR_PERMANENT:
+                self.remove_staged(staging_path)
+            event: ProgressEvent = ProgressEvent(
+                self.job_id, ytid, status, str(error), time.time() - row_start, index,
+                error_class=error_class,
+            )
+        else:
+            # the clip was only written to its first label directory
+            with timed_stage(STAGE_WRITE):
+                link_label_copies(download_paths[0], download_paths[1:], settings.link_mode)
+            num_bytes: int = download_paths[0].stat().st_size
+            event: ProgressEvent = ProgressEvent(
+                self.job_id, ytid, STATUS_DOWNLOADED, None, time.time() - row_start, index,
+                paths=[str(p) for p in download_paths], num_bytes=num_bytes,
+            )
+        event.num_attempts = num_attempts
+        event.num_throttled = num_throttled
+        event.stage_times = take_stage_times()
+        progress_queue.put(event)
+
+    def recover_staged(self, staging_path: Path, expected_duration: float) -> bool:
+        """
+        Returns whether a complete clip is already waiting at the staging path,
+        removing it if it was cut short.
+        """
+        if not staging_path.exists():
+            return False
+        try:
+            validate_clip(staging_path, expected_duration)
+            return True
+        except InvalidClipError:
+            staging_path.unlink()
+            return False
+
+    def remove_staged(self, staging_path: Path) -> None:
+        """Removes whatever a download left in the staging directory for a clip."""
+        for path in self.settings.staging_dir.glob(f"{glob.escape(staging_path.stem)}.*"):
+            path.unlink(missing_ok=True)
+
+
+def run_worker(
+    settings: WorkerSettings,
+    plan_handle: PlanHandle,
+    inbox: mp.Queue,
+    progress_queue: mp.Queue,
+    job_id: int,
+) -> None:
+    """Entry point of a worker process: maps the shared plan and downloads what the inbox hands it."""
+    plan, memories = attach_plan(plan_handle)
+    worker: DownloadWorker = DownloadWorker(settings, plan, job_id)
+    orphaned: bool = False
+    try:
+        worker.run(inbox, progress_queue)
+        orphaned = worker.orphaned
+    finally:
+        # the plan's arrays point into the blocks, so they go first
+        del worker, plan
+        # the parent frees the blocks once its workers are done, unless it is gone
+        release_plan(memories, unlink=orphaned)
@@ -1,10 +1,16 @@
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional
 from pathlib import Path
+import copy
+import subprocess
+import threading
 import yt_dlp
 import shutil
 import time
 import traceback
 from yt_dlp.utils import YoutubeDLError
+from errors import is_stale_info_error
+from metrics import STAGE_FETCH, STAGE_POSTPROCESS, STAGE_PROBE, record_stage, timed_stage
 
 """
 Script for definining mostly static functions for downloading youtube videos using youtube-dlp
@@ -27,48 +33,300 @@ class loggerOutputs:
         # print("Captured Log: "+msg)
         3
 
-def download_audio_section(
-    ytid: str,
-    start_time: int,
-    end_time: int,
-    dwnld_paths: list[Path],
-    codec_type: str = "wav",
-    quiet: bool = True,
-) -> tuple[int, Optional[Exception]]:
+class InfoCache:
+    """
+    Small thread-safe LRU cache of the info extracted for a video, keyed by YTID.
+    Entries expire after `ttl` seconds since the stream URLs inside them do.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600.0):
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self.lock: threading.Lock = threading.Lock()
+
+    def get(self, ytid: str) -> Optional[dict]:
+        with self.lock:
+            entry: Optional[tuple[float, dict]] = self.entries.get(ytid)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self.entries[ytid]
+                return None
+            self.entries.move_to_end(ytid)
+            # processing an info dict mutates it, so every caller gets its own copy
+            return copy.deepcopy(entry[1])
+
+    def drop(self, ytid: str) -> None:
+        with self.lock:
+            self.entries.pop(ytid, None)
+
+    def put(self, ytid: str, info: dict) -> None:
+        with self.lock:
+            self.entries[ytid] = (time.time(), info)
+            self.entries.move_to_end(ytid)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+# shared by every session in the process, so a video that shows up in several
+# segments, or gets retried, is only probed once
+info_cache: InfoCache = InfoCache()
+
+
+class YtdlpSession:
+    """
+    Long-lived wrapper around a single `yt_dlp.YoutubeDL`, so the extractors and
+    options are only set up once. The clip range and output path are passed per
+    call. A YoutubeDL object is not thread-safe, so each thread needs its own.
+    """
+
+    def __init__(self, codec_type: str = "wav", quiet: bool = True, extract_audio: bool = True):
+        ydl_opts = {
+            "quiet": quiet,
+            "no_warnings": quiet,  # Suppress warnings if quiet is True
+            "format": "bestaudio/best",
+            # keep the .part file of an interrupted transfer and pick it up from
+            # where it stopped. Range downloads go through ffmpeg, which can't
+            # resume, but they are only a few seconds of audio
+            "continuedl": True,
+            "nopart": False,
+            # "logger" : loggerOutputs,
+            "postprocessors": [
+                {
+                    "key": "FFmpegExtractAudio",
+                    "preferredcodec": codec_type,
+                    "preferredquality": "192",
+                }
+            ],
+        }
+        if not extract_audio:
+            # the fetch stage of the pipeline keeps the source's audio as is and
+            # leaves transcoding to the transcode stage
+            del ydl_opts["postprocessors"]
+        self.ydl: yt_dlp.YoutubeDL = yt_dlp.YoutubeDL(ydl_opts)
+        # time spent in ffmpeg postprocessors during the current download
+        self.postprocess_seconds: float = 0.0
+        self.postprocess_started: float = 0.0
+        self.ydl.add_postprocessor_hook(self.on_postprocess)
 
-    url: str = f"https://www.youtube.com/watch?v={ytid}"
-    ydl_opts = {
-        "quiet": quiet,
-        "no_warnings": quiet,  # Suppress warnings if quiet is True
-        "format": "bestaudio/best",
-        # "logger" : loggerOutputs,
-        "postprocessors": [
+    def on_postprocess(self, d: dict) -> None:
+        if d["status"] == "started":
+            self.postprocess_started = time.perf_counter()
+        elif d["status"] == "finished":
+            self.postprocess_seconds += time.perf_counter() - self.postprocess_started
+
+    def extract_info(self, ytid: str) -> dict:
+        """Returns the unprocessed info of a video, probing it only on a cache miss."""
+        info: Optional[dict] = info_cache.get(ytid)
+        if info is None:
+            url: str = f"https://www.youtube.com/watch?v={ytid}"
+            with timed_stage(STAGE_PROBE):
+                info = self.ydl.extract_info(url, download=False, process=False)
+            info_cache.put(ytid, copy.deepcopy(info))
+        return info
+
+    def download(
+        self, ytid: str, start_time: int, end_time: int, dwnld_paths: list[Path]
+    ) -> tuple[int, Optional[Exception]]:
+        self.ydl.params["outtmpl"]["default"] = str(dwnld_paths[0].with_suffix(".%(ext)s"))
+        self.ydl.params["download_ranges"] = lambda info, _: [
             {
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": codec_type,
-                "preferredquality": "192",
+                "start_time": start_time,
+                "end_time": end_time,
             }
-        ],
-        "outtmpl": str(dwnld_paths[0].with_suffix(".%(ext)s")),
-        "download_ranges": lambda info, _: [
+        ]
+        # the return code is sticky inside a YoutubeDL object
+        self.ydl._download_retcode = 0
+
+        try:
+            info: dict = self.extract_info(ytid)
+            # the download and the postprocessing both happen in here, the
+            # postprocessor hook tells them apart
+            self.postprocess_seconds = 0.0
+            start: float = time.perf_counter()
+            try:
+                self.ydl.process_ie_result(info, download=True)
+            finally:
+                record_stage(STAGE_FETCH, time.perf_counter() - start - self.postprocess_seconds)
+                record_stage(STAGE_POSTPROCESS, self.postprocess_seconds)
+            return (self.ydl._download_retcode, None)
+
+        except YoutubeDLError as e:
+            # NOTE: the lack of exception need not imply the video downloaded successfully
+            return (1, e)
+
+    def fetch(
+        self, ytid: str, start_time: int, end_time: int, spool_stem: Path
+    ) -> tuple[int, Optional[Exception], Optional[Path]]:
+        """
+        Downloads a section of a video's audio as is, without transcoding it.
+        Returns the return code, the error and the path the raw audio went to,
+        `spool_stem` with the extension of the source's container.
+        """
+        self.ydl.params["outtmpl"]["default"] = str(spool_stem) + ".%(ext)s"
+        self.ydl.params["download_ranges"] = lambda info, _: [
             {
                 "start_time": start_time,
                 "end_time": end_time,
             }
-        ],
-    }
+        ]
+        self.ydl._download_retcode = 0
 
-    ex: Exception = None
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
         try:
-            retcode: int = ydl.download([url])
-            return (retcode, None)
+            info: dict = self.extract_info(ytid)
+            with timed_stage(STAGE_FETCH):
+                info = self.ydl.process_ie_result(info, download=True)
+        except YoutubeDLError as e:
+            return (1, e, None)
 
+        downloads: list[dict] = info.get("requested_downloads") or []
+        if self.ydl._download_retcode != 0 or not downloads:
+            return (1, YoutubeDLError(f"Nothing was downloaded for {ytid}"), None)
+        return (0, None, Path(downloads[0]["filepath"]))
+
+    def stream_url(self, ytid: str) -> tuple[str, dict]:
+        """Returns the URL and HTTP headers of the audio stream yt-dlp would pick."""
+        info: dict = self.ydl.process_ie_result(self.extract_info(ytid), download=False)
+        audio_format: dict = info.get("requested_formats", [info])[0]
+        return audio_format["url"], audio_format.get("http_headers", {})
+
+    def download_decoded(
+        self,
+        ytid: str,
+        start_time: int,
+        end_time: int,
+        dwnld_path: Path,
+        codec_type: str,
+        sample_rate: Optional[int],
+        channels: Optional[int],
+    ) -> tuple[int, Optional[Exception]]:
+        """
+        Downloads a section of a video's audio through a single ffmpeg process that
+        reads the range straight off the stream and decodes it to the requested
+        sample rate, channel count and codec, with no intermediate file.
+        """
+        try:
+            url, http_headers = self.stream_url(ytid)
         except YoutubeDLError as e:
-            # raise e
-            ex = e
-            # traceback.print_exc()
-            # NOTE: the lack of exception need not imply the video downloaded successfully
-            # print("No errors")
-            return (1, e)
\ No newline at end of file
+            return (1, e)
+
+        command: list[str] = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y"]
+        if http_headers:
+            command += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in http_headers.items())]
+        # seeking before the input only fetches the byte ranges that are needed
+        command += ["-ss", str(start_time), "-to", str(end_time), "-i", url, "-vn"]
+        if sample_rate is not None:
+            command += ["-ar", str(sample_rate)]
+        if channels is not None:
+            command += ["-ac", str(channels)]
+        command += ["-c:a", ffmpeg_codecs[codec_type], str(dwnld_path.with_suffix(f".{codec_type}"))]
+
+        # fetching and decoding happen in the same ffmpeg pass, so they are
+        # timed together as the fetch
+        with timed_stage(STAGE_FETCH):
+            result: subprocess.CompletedProcess = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            return (1, YoutubeDLError(f"ffmpeg failed for {ytid}: {result.stderr.strip()}"))
+        return (0, None)
+
+
+# ffmpeg encoder used for every codec the clips can be decoded to
+ffmpeg_codecs: dict[str, str] = {
+    "wav": "pcm_s16le",
+    "flac": "flac",
+}
+
+
+def transcode_audio(
+    raw_path: Path,
+    dwnld_path: Path,
+    codec_type: str = "wav",
+    sample_rate: Optional[int] = None,
+    channels: Optional[int] = None,
+) -> tuple[int, Optional[Exception]]:
+    """
+    Transcodes raw audio fetched by `fetch_audio_section` to the clip's codec,
+    and to the given sample rate and channel count if there are any.
+    """
+    command: list[str] = ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", str(raw_path), "-vn"]
+    if sample_rate is not None:
+        command += ["-ar", str(sample_rate)]
+    if channels is not None:
+        command += ["-ac", str(channels)]
+    command += ["-c:a", ffmpeg_codecs[codec_type], str(dwnld_path.with_suffix(f".{codec_type}"))]
+
+    with timed_stage(STAGE_POSTPROCESS):
+        result: subprocess.CompletedProcess = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return (1, YoutubeDLError(f"ffmpeg failed to transcode {raw_path}: {result.stderr.strip()}"))
+    return (0, None)
+
+
+def reprobe_on_stale_info(ytid: str, attempt: Callable[[], tuple]) -> tuple:
+    """
+    Runs a download, and runs it once more with a fresh probe of the video if
+    it failed in a way the cached info may be to blame for, e.g. a 403 on a
+    stream URL that expired.
+    """
+    ret: tuple = attempt()
+    if is_stale_info_error(ret[1]):
+        info_cache.drop(ytid)
+        ret = attempt()
+    return ret
+
+
+# one session per thread and per set of options
+_sessions: threading.local = threading.local()
+
+
+def get_session(codec_type: str = "wav", quiet: bool = True, extract_audio: bool = True) -> YtdlpSession:
+    """Returns the calling thread's session for the given options, creating it if needed."""
+    if not hasattr(_sessions, "by_opts"):
+        _sessions.by_opts = {}
+
+    key: tuple[str, bool, bool] = (codec_type, quiet, extract_audio)
+    if key not in _sessions.by_opts:
+        _sessions.by_opts[key] = YtdlpSession(codec_type, quiet, extract_audio)
+    return _sessions.by_opts[key]
+
+
+def download_audio_section(
+    ytid: str,
+    start_time: int,
+    end_time: int,
+    dwnld_paths: list[Path],
+    codec_type: str = "wav",
+    quiet: bool = True,
+    sample_rate: Optional[int] = None,
+    channels: Optional[int] = None,
+) -> tuple[int, Optional[Exception]]:
+    """
+    Downloads a section of a video's audio, reusing the calling thread's YoutubeDL.
+    When a sample rate or channel count is given, the section is decoded straight
+    to it by ffmpeg instead of going through yt-dlp's postprocessor.
+    """
+    session: YtdlpSession = get_session(codec_type, quiet)
+    if sample_rate is not None or channels is not None:
+        return reprobe_on_stale_info(
+            ytid,
+            lambda: session.download_decoded(
+                ytid, start_time, end_time, dwnld_paths[0], codec_type, sample_rate, channels
+            ),
+        )
+    return reprobe_on_stale_info(ytid, lambda: session.download(ytid, start_time, end_time, dwnld_paths))
+
+
+def fetch_audio_section(
+    ytid: str,
+    start_time: int,
+    end_time: int,
+    spool_stem: Path,
+    quiet: bool = True,
+) -> tuple[int, Optional[Exception], Optional[Path]]:
+    """
+    Fetches a section of a video's audio without transcoding it, reusing the
+    calling thread's YoutubeDL. See `YtdlpSession.fetch`.
+    """
+    session: YtdlpSession = get_session(quiet=quiet, extract_audio=False)
+    return reprobe_on_stale_info(ytid, lambda: session.fetch(ytid, start_time, end_time, spool_stem))